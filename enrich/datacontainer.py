@@ -110,6 +110,16 @@ class DataContainer(object):
         self.log_memory_usage()
 
 
+    def index_labels(self, key):
+        """
+        Return the labels written by :py:meth:`write_data` for the index of 
+        the :py:class:`pandas.DataFrame` *key*. By default, this is the index 
+        itself. Subclasses that use an internal representation for the 
+        index should override this method.
+        """
+        return self.df_dict[key].index
+
+
     def write_data(self, subdirectory=None, keys=None):
         """
         Save the :py:class:`pandas.DataFrame` objects as tab-separated files 
@@ -138,7 +148,12 @@ class DataContainer(object):
 
         for key in keys:
             fname = os.path.join(directory, fix_filename(key + ".tsv"))
-            self.df_dict[key].to_csv(fname, 
+            df = self.df_dict[key]
+            labels = self.index_labels(key)
+            if labels is not df.index:
+                df = df.copy(deep=False)
+                df.index = labels
+            df.to_csv(fname, 
                     sep="\t", na_rep="NaN", float_format="%.4g", 
                     index_label="sequence")
             fname_dict[key] = fname
@@ -6,7 +6,28 @@ import string
 import itertools
 import bz2
 import gzip
+import zlib
+import struct
+import mmap
+import threading
+import Queue
+import collections
+import bisect
+import io
+from multiprocessing.pool import ThreadPool
 from array import array
+import numpy as np
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # The following regex is referenced by line number in the class documentation.
 # Matches FASTQ headers based on the following pattern (modify as needed):
@@ -24,19 +45,171 @@ header_pattern = re.compile("@(?P<MachineName>.+)"
 BUFFER_SIZE = 100000 # empirically optimized for reading FASTQ files
 
 
+BATCH_SIZE = 10000 # number of records in each FQBatch
+
+
+QUEUE_SIZE = 16 # maximum number of buffers held by each background thread
+
+
+PREFETCH_SIZE = 1000 # number of records in each block read ahead by threads
+
+
+INDEX_INTERVAL = 10000 # number of records between FASTQ index checkpoints
+
+
+INDEX_EXTENSION = ".fqi" # file extension for FASTQ index sidecar files
+
+
+# leading bytes that identify each supported compression format
+compression_magic = (("gz", "\x1f\x8b"),
+                     ("bz2", "BZh"),
+                     ("xz", "\xfd7zXZ\x00"),
+                     ("zst", "\x28\xb5\x2f\xfd"))
+
+
+# file extensions for compressed files
+compression_extensions = (".gz", ".bz2", ".xz", ".zst")
+
+
 dna_trans = string.maketrans("actgACTG", "tgacTGAC")
 
 
+# complement lookup table for uint8 sequence arrays
+dna_comp_table = np.frombuffer(string.maketrans("", "").translate(dna_trans), 
+                               dtype=np.uint8)
+
+
+# header fields in the pre-1.8 Illumina format, see header_pattern
+legacy_header_fields = dict((name, i) for i, name in 
+        enumerate(("MachineName", "Lane", "Tile", "X", "Y", "Chastity", 
+                   "IndexRead", "ReadNumber")))
+
+
+# header fields in the Casava 1.8 Illumina format
+casava_header_fields = dict((name, i) for i, name in 
+        enumerate(("MachineName", "RunNumber", "FlowcellID", "Lane", "Tile", 
+                   "X", "Y", "ReadNumber", "Filtered", "ControlNumber", 
+                   "IndexSequence")))
+
+
+def split_header(header):
+    """
+    Split the first FASTQ_ header (@ header) *header* into its fields 
+    without using regular expressions. Two Illumina header formats are 
+    recognized, the pre-1.8 format matched by ``header_pattern``::
+
+        @<MachineName>:<Lane>:<Tile>:<X>:<Y>:<Chastity>#<IndexRead>/<ReadNumber>
+
+    and the Casava 1.8 format::
+
+        @<MachineName>:<RunNumber>:<FlowcellID>:<Lane>:<Tile>:<X>:<Y> <ReadNumber>:<Filtered>:<ControlNumber>:<IndexSequence>
+
+    Returns a tuple containing the list of field strings and a dictionary 
+    mapping field names to positions in the list (``legacy_header_fields`` 
+    or ``casava_header_fields``), or ``None`` if the format is not 
+    recognized.
+    """
+    space = header.find(' ')
+    if space >= 0: # Casava 1.8
+        fields = header[1:space].split(':')
+        if len(fields) != 7:
+            return None
+        fields.extend(header[space + 1:].split(':', 3))
+        if len(fields) != 11:
+            return None
+        return fields, casava_header_fields
+    else:
+        body, sep, tail = header[1:].rpartition('#')
+        if len(sep) == 0:
+            return None
+        fields = body.rsplit(':', 5)
+        if len(fields) != 6:
+            return None
+        index_read, sep, read_number = tail.partition('/')
+        if len(sep) == 0:
+            return None
+        fields.append(index_read)
+        fields.append(read_number)
+        return fields, legacy_header_fields
+
+
+def header_field(header, field):
+    """
+    Return the value of *field* from the first FASTQ_ header (@ header) 
+    *header*, or ``None`` if the header format is not recognized or does not 
+    contain *field*. Field names are those given in :py:func:`split_header`. 
+    Integer values are converted from strings to integers.
+
+    The ``'Chastity'`` field is also available for Casava 1.8 headers, and 
+    is ``1`` unless the read was filtered.
+    """
+    parsed = split_header(header)
+    if parsed is None:
+        return None
+    fields, names = parsed
+    if field == "Chastity" and names is casava_header_fields:
+        value = '0' if fields[names["Filtered"]] == 'Y' else '1'
+    elif field in names:
+        value = fields[names[field]]
+    else:
+        return None
+    if value.isdigit():
+        return int(value)
+    else:
+        return value
+
+
+# set once the warning for an unrecognized header has been printed
+_header_warning_printed = False
+
+
+def header_chastity(header):
+    """
+    Returns ``True`` if the first FASTQ_ header (@ header) *header* 
+    describes a chaste read. Only the chastity field is converted, so this 
+    is faster than :py:func:`header_field`, but the same fields are checked 
+    as in :py:func:`split_header` and the result is the same as testing the 
+    ``'Chastity'`` field for ``1``. Both header formats described in 
+    :py:func:`split_header` are supported.
+
+    Reads with headers in other formats are not chaste, and a warning is 
+    printed the first time one is found.
+    """
+    global _header_warning_printed
+
+    space = header.find(' ')
+    if space >= 0: # Casava 1.8: <ReadNumber>:<Filtered>:...
+        if header.count(':', 1, space) == 6:
+            fields = header[space + 1:].split(':', 3)
+            if len(fields) == 4:
+                return fields[1] != 'Y'
+    else: # pre-1.8: ...:<Chastity>#<IndexRead>/<ReadNumber>
+        body, sep, tail = header[1:].rpartition('#')
+        if len(sep) > 0 and '/' in tail:
+            fields = body.rsplit(':', 5)
+            if len(fields) == 6:
+                return fields[5].isdigit() and int(fields[5]) == 1
+    if not _header_warning_printed:
+        print("Warning: unrecognized FASTQ header format, reads will fail "
+              "the chastity filter ('{header}')".format(header=header), 
+              file=stderr)
+        _header_warning_printed = True
+    return False
+
+
 class FQRead(object):
     """
     Stores a single record from a FASTQ_ file. Quality values are stored 
-    internally as a list of integer `Phred quality scores \
-    <http://www.phrap.com/phred/#qualityscores>`_. The *qbase* parameter is 
-    the ASCII value that correponds to Phred score of 0. The *sequence* and 
-    *quality* strings must be the same length. 
+    internally as the original quality string, and are only decoded into a 
+    list of integer `Phred quality scores \
+    <http://www.phrap.com/phred/#qualityscores>`_ when the :py:attr:`quality` 
+    list is accessed. The *qbase* parameter is the ASCII value that 
+    correponds to Phred score of 0. The *sequence* and *quality* strings 
+    must be the same length. 
     """
     # use slots for memory efficiency
-    __slots__ = ('header', 'sequence', 'header2', 'quality', 'qbase')
+    __slots__ = ('header', 'sequence', 'header2', '_quality', 
+                 '_quality_string', 'qbase')
 
 
     def __init__(self, header, sequence, header2, quality, qbase=33):
@@ -48,18 +221,51 @@ class FQRead(object):
             self.header = header
             self.sequence = sequence
             self.header2 = header2
-            # quality is a list of integers
-            self.quality = [x - qbase for x in array('b', quality).tolist()]
+            # quality string is decoded into a list of integers on demand
+            self._quality_string = quality
+            self._quality = None
             self.qbase = qbase
 
 
+    @property
+    def quality(self):
+        """
+        List of integer quality values. The quality string is decoded the 
+        first time this is accessed. Assigning a new list replaces the 
+        quality string.
+        """
+        if self._quality is None:
+            self._quality = [x - self.qbase for x in 
+                             array('b', self._quality_string).tolist()]
+            self._quality_string = None
+        return self._quality
+
+
+    @quality.setter
+    def quality(self, value):
+        self._quality = value
+        self._quality_string = None
+
+
+    def quality_string(self):
+        """
+        Return the quality values as a FASTQ_ quality string. If the quality 
+        values have not been decoded, the original string is returned.
+        """
+        if self._quality is None:
+            return self._quality_string
+        else:
+            return array('b', [x + self.qbase for x in self._quality]).tostring()
+
+
     def __str__(self):
         """
-        Reformat as a four-line FASTQ_ record. This method converts the 
-        integer quality values back into a string.
+        Reformat as a four-line FASTQ_ record. The original quality string 
+        is used unless the integer quality values have been decoded, in which 
+        case they are converted back into a string.
         """
         return '\n'.join([self.header, self.sequence, self.header2, 
-                array('b', [x + self.qbase for x in self.quality]).tostring()])
+                          self.quality_string()])
 
 
     def __len__(self):
@@ -75,7 +281,10 @@ class FQRead(object):
         *start* and *end* (inclusive). Bases are numbered starting at 1.
         """
         self.sequence = self.sequence[start - 1:end]
-        self.quality = self.quality[start - 1:end]
+        if self._quality is None:
+            self._quality_string = self._quality_string[start - 1:end]
+        else:
+            self._quality = self._quality[start - 1:end]
 
 
     def trim_length(self, length, start=1):
@@ -92,7 +301,10 @@ class FQRead(object):
         quality values.
         """
         self.sequence = self.sequence.translate(dna_trans)[::-1]
-        self.quality = self.quality[::-1]
+        if self._quality is None:
+            self._quality_string = self._quality_string[::-1]
+        else:
+            self._quality = self._quality[::-1]
 
 
     def header_information(self, pattern=header_pattern):
@@ -121,83 +333,354 @@ class FQRead(object):
 
     def min_quality(self):
         """
-        Return the minimum Phred-like quality score.
+        Return the minimum Phred-like quality score, or 0 for a zero-length 
+        read.
         """
-        return min(self.quality)
+        if len(self) == 0:
+            return 0
+        elif self._quality is None:
+            return ord(min(self._quality_string)) - self.qbase
+        else:
+            return min(self._quality)
 
 
     def mean_quality(self):
         """
-        Return the average Phred-like quality score.
+        Return the average Phred-like quality score, or 0 for a zero-length 
+        read.
         """
-        return float(sum(self.quality)) / len(self)
+        if len(self) == 0:
+            return 0.0
+        elif self._quality is None:
+            return float(sum(bytearray(self._quality_string)) - 
+                         self.qbase * len(self._quality_string)) / len(self)
+        else:
+            return float(sum(self._quality)) / len(self)
 
 
     def is_chaste(self):
         """
-        Returns ``True`` if the chastity bit is set in the header. The 
-        regular experession used by :py:meth:`header_information` must  
-        include a ``'Chastity'`` match that equals ``1`` if the read is 
-        chaste.
+        Returns ``True`` if the chastity bit is set in the header. Headers 
+        are parsed by :py:func:`header_chastity`, which supports the 
+        pre-1.8 and Casava 1.8 Illumina formats.
         """
-        try:
-            if self.header_information()['Chastity'] == 1:
-                return True
-            else:
-                return False
-        except KeyError, TypeError: # no 'Chastity' in pattern or no match
-            return False
+        return header_chastity(self.header)
+
+
+
+class FQBatch(object):
+    """
+    Stores a block of FASTQ_ records in columnar form. The *records* are 
+    sequences of four strings (header, sequence, header2, quality), such as 
+    those produced while reading a FASTQ_ file.
+
+    Bases are stored as a two-dimensional ``uint8`` array with one row per 
+    record and quality values are stored as a matching ``int8`` array of 
+    `Phred quality scores <http://www.phrap.com/phred/#qualityscores>`_. 
+    Reads shorter than the longest read in the batch are padded with ``'N'`` 
+    bases and quality values of 0, and the true read lengths are stored in 
+    the *lengths* array. Headers are stored as a single string with an array 
+    of start offsets. The *qbase* parameter is the ASCII value that 
+    correponds to Phred score of 0.
+    """
+    # use slots for memory efficiency
+    __slots__ = ('headers', 'header_offsets', 'header2s', 'header2_offsets', 
+                 'sequence', 'quality', 'lengths', 'qbase')
+
+
+    def __init__(self, records, qbase=33):
+        headers = [r[0] for r in records]
+        sequences = [r[1] for r in records]
+        header2s = [r[2] for r in records]
+        qualities = [r[3] for r in records]
+
+        self.lengths = np.fromiter((len(x) for x in sequences), 
+                                   dtype=np.int32, count=len(records))
+        if len(records) > 0:
+            if not np.array_equal(self.lengths, 
+                    np.fromiter((len(x) for x in qualities), dtype=np.int32, 
+                                count=len(records))):
+                raise ValueError('different lengths for sequence and quality')
+            if any(x[:1] != '@' for x in headers) or \
+                    any(x[:1] != '+' for x in header2s):
+                raise ValueError('improperly formatted FASTQ record')
+            width = self.lengths.max()
+        else:
+            width = 0
+
+        self.headers = ''.join(headers)
+        self.header_offsets = np.cumsum([0] + [len(x) for x in headers])
+        self.header2s = ''.join(header2s)
+        self.header2_offsets = np.cumsum([0] + [len(x) for x in header2s])
+        if len(records) == 0 or self.lengths.min() == width:
+            sequences = ''.join(sequences)
+            qualities = ''.join(qualities)
+        else: # pad the shorter reads
+            sequences = ''.join(x.ljust(width, 'N') for x in sequences)
+            qualities = ''.join(x.ljust(width, chr(qbase)) for x in qualities)
+        self.sequence = np.frombuffer(sequences, 
+                dtype=np.uint8).reshape(len(records), width)
+        self.quality = (np.frombuffer(qualities, 
+                dtype=np.int8) - qbase).astype(np.int8).reshape(len(records), 
+                                                                width)
+        self.qbase = qbase
+
+
+    def __len__(self):
+        """
+        Object length is the number of records.
+        """
+        return len(self.lengths)
+
+
+    def is_uniform(self):
+        """
+        Return ``True`` if all reads in the batch are the same length.
+        """
+        return len(self) == 0 or self.lengths.min() == self.sequence.shape[1]
+
+
+    def valid_mask(self):
+        """
+        Return a boolean array that is ``True`` for each base that is part 
+        of a read and ``False`` for padding.
+        """
+        return np.arange(self.sequence.shape[1]) < self.lengths[:, np.newaxis]
+
+
+    def header(self, i):
+        """
+        Return the first FASTQ_ header (@ header) for record *i*.
+        """
+        return self.headers[self.header_offsets[i]:self.header_offsets[i + 1]]
+
+
+    def header2(self, i):
+        """
+        Return the second FASTQ_ header (+ header) for record *i*.
+        """
+        return self.header2s[self.header2_offsets[i]:
+                             self.header2_offsets[i + 1]]
+
+
+    def sequences(self, mask=None):
+        """
+        Return a list of sequence strings. If *mask* is provided, only the 
+        sequences for records where *mask* is ``True`` are returned.
+        """
+        if mask is None:
+            sequence = self.sequence
+            lengths = self.lengths
+        else:
+            sequence = self.sequence[mask]
+            lengths = self.lengths[mask]
+        width = sequence.shape[1]
+        data = sequence.tostring()
+        if width == 0:
+            return [''] * len(lengths)
+        elif self.is_uniform():
+            return [data[i:i + width] for i in xrange(0, len(data), width)]
+        else:
+            return [data[i * width:i * width + lengths[i]] 
+                    for i in xrange(len(lengths))]
+
+
+    def record(self, i):
+        """
+        Return record *i* as an :py:class:`~fqread.FQRead` object.
+        """
+        length = self.lengths[i]
+        return FQRead(self.header(i), self.sequence[i, :length].tostring(), 
+                      self.header2(i), (self.quality[i, :length] + 
+                          self.qbase).astype(np.uint8).tostring(), 
+                      qbase=self.qbase)
+
+
+    def trim(self, start=1, end=None):
+        """
+        Trims all reads in this :py:class:`~fqread.FQBatch` to contain bases 
+        between *start* and *end* (inclusive). Bases are numbered starting at 
+        1.
+        """
+        self.sequence = self.sequence[:, start - 1:end]
+        self.quality = self.quality[:, start - 1:end]
+        self.lengths = np.clip(self.lengths - (start - 1), 0, 
+                               self.sequence.shape[1]).astype(np.int32)
+
+
+    def trim_length(self, length, start=1):
+        """
+        Trims all reads in this :py:class:`~fqread.FQBatch` to contain 
+        *length* bases, beginning with *start*. Bases are numbered starting 
+        at 1.
+        """
+        self.trim(start=start, end=start + length - 1)
+
+
+    def revcomp(self):
+        """
+        Reverse-complement all sequences in place. Also reverses the arrays 
+        of quality values.
+        """
+        if self.is_uniform():
+            self.sequence = dna_comp_table[self.sequence[:, ::-1]]
+            self.quality = self.quality[:, ::-1]
+        else:
+            width = self.sequence.shape[1]
+            index = self.lengths[:, np.newaxis] - 1 - np.arange(width)
+            padding = index < 0
+            index[padding] = 0
+            rows = np.arange(len(self))[:, np.newaxis]
+            self.sequence = dna_comp_table[self.sequence[rows, index]]
+            self.sequence[padding] = ord('N')
+            self.quality = self.quality[rows, index]
+            self.quality[padding] = 0
+
+
+    def min_quality(self):
+        """
+        Return an array of the minimum Phred-like quality score for each 
+        read. Zero-length reads have a minimum of 0, as in 
+        :py:meth:`FQRead.min_quality`.
+        """
+        if self.quality.shape[1] == 0:
+            return np.zeros(len(self), dtype=self.quality.dtype)
+        elif self.is_uniform():
+            return self.quality.min(axis=1)
+        else:
+            minimum = np.where(self.valid_mask(), self.quality, 
+                               np.iinfo(np.int8).max).min(axis=1)
+            minimum[self.lengths == 0] = 0
+            return minimum
+
+
+    def mean_quality(self):
+        """
+        Return an array of the average Phred-like quality score for each 
+        read. Zero-length reads have an average of 0, as in 
+        :py:meth:`FQRead.mean_quality`.
+        """
+        if self.is_uniform():
+            total = self.quality.sum(axis=1, dtype=np.int64)
+        else:
+            total = np.where(self.valid_mask(), self.quality, 
+                             0).sum(axis=1, dtype=np.int64)
+        return total / np.maximum(self.lengths, 1).astype(np.float64)
+
+
+    def is_chaste(self):
+        """
+        Return a boolean array that is ``True`` for each read with the 
+        chastity bit set in the header. See :py:meth:`FQRead.is_chaste`.
+        """
+        return np.fromiter((header_chastity(self.header(i)) 
+                            for i in xrange(len(self))), dtype=bool, 
+                           count=len(self))
+
+
+
+def detect_compression(fname):
+    """
+    Returns the compression format of *fname* (``"gz"``, ``"bz2"``, 
+    ``"xz"``, ``"zst"``, or ``None`` if the file is not compressed), based 
+    on the first bytes of the file rather than the file extension.
+    """
+    with open(fname, "rb") as handle:
+        header = handle.read(6)
+    for compression, magic in compression_magic:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+
+class _ZstdRaw(io.RawIOBase):
+    """
+    Raw stream of the decompressed data in the zstd file *fname*. Used by 
+    :py:func:`open_compressed`.
+    """
+    def __init__(self, fname):
+        self.handle = open(fname, "rb")
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.handle, 
+                read_across_frames=True)
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, b):
+        data = self.reader.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+    def close(self):
+        if not self.closed:
+            self.handle.close()
+        io.RawIOBase.close(self)
+
+
+
+def open_compressed(fname, compression=None):
+    """
+    Open the file *fname* for reading and return a file object for the 
+    decompressed data. The compression format is given by *compression* 
+    (see :py:func:`detect_compression`), which is detected from the file if 
+    it is ``None``. Plain text and bz2 files are opened with universal 
+    newline support. The ``xz`` format requires the ``lzma`` module (or 
+    ``backports.lzma``), and the ``zst`` format requires the ``zstandard`` 
+    module. Raises an ``IOError`` if the file cannot be opened.
+    """
+    if compression is None:
+        compression = detect_compression(fname)
+    if compression is None:
+        return open(fname, "rU")
+    elif compression == "gz":
+        return gzip.GzipFile(fname, "rb")
+    elif compression == "bz2":
+        return bz2.BZ2File(fname, "rU")
+    elif compression == "xz":
+        if lzma is None:
+            raise IOError("reading '{fname}' requires the lzma module".format(fname=fname))
+        return lzma.LZMAFile(fname, "rb")
+    elif compression == "zst":
+        if zstandard is None:
+            raise IOError("reading '{fname}' requires the zstandard module".format(fname=fname))
+        return io.BufferedReader(_ZstdRaw(fname), BUFFER_SIZE)
+    else:
+        raise IOError("unrecognized compression mode '{mode}'".format(mode=compression))
 
 
 
 def check_fastq(fname):
     """
     Check that *fname* exists and has a valid FASTQ_ file extension. Valid 
-    file extensions are ``.fastq`` or ``.fq``, optionally followed by ``.gz`` 
-    or ``.bz2`` if the file is compressed. Returns the compression format 
-    (``"gz"``, ``"bz2"``, or ``None``) if the file exists and the extension 
-    is recognized, otherwise raise an ``IOError``.
+    file extensions are ``.fastq`` or ``.fq``, optionally followed by 
+    ``.gz``, ``.bz2``, ``.xz`` or ``.zst`` if the file is compressed. 
+    Returns the compression format detected by 
+    :py:func:`detect_compression` if the file exists (printing a warning if 
+    the extension is not recognized), otherwise raise an ``IOError``.
     """
-    compression = None
     if os.path.isfile(fname):
         path, ext = os.path.splitext(fname)
         ext = ext.lower()
-        if ext in (".bz2"):
-            compression = "bz2"
+        if ext in compression_extensions:
             ext = os.path.splitext(path)[-1].lower()
-        elif ext in (".gz"):
-            compression = "gz"
-            ext = os.path.splitext(path)[-1].lower()
-        if ext in (".fq", ".fastq"):
-            return compression
-        else:
+        if ext not in (".fq", ".fastq"):
             print("Warning: unexpected file extension for '{fname}'".format(fname=fname), file=stderr)
+        return detect_compression(fname)
     else:
         raise IOError("file '{fname}' doesn't exist".format(fname=fname))
 
 
 
-def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE, qbase=33):
+def _buffered_records(handle, buffer_size=BUFFER_SIZE):
     """
-    Generator function for reading from FASTQ_ file *fname*. Yields an 
-    :py:class:`~fqread.FQRead` object for each FASTQ_ record in the file. The 
-    *filter_function* must operate on an :py:class:`~fqread.FQRead` object 
-    and return ``True`` or ``False``. If the result is ``False``, the record 
-    will be skipped silently.
-
-    .. note:: To read multiple files in parallel (such as index or \
-        forward/reverse reads), use :py:func:`read_fastq_multi` instead.
+    Generator function that splits the contents of the open file *handle* 
+    into FASTQ_ records. The file is read in chunks of *buffer_size* bytes. 
+    Yields a list containing the four lines of each record.
     """
-    compression = check_fastq(fname)
-    if compression is None: # raw FASTQ
-        handle = open(fname, "rU")
-    elif compression == "bz2":
-        handle = bz2.BZ2File(fname, "rU")
-    elif compression == "gz":
-        handle = gzip.GzipFile(fname, "rU")
-    else:
-        raise IOError("unrecognized compression mode '{mode}'".format(mode=compression))
-
     eof = False
     leftover = ''
 
@@ -221,20 +704,770 @@ def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE, qbase=33):
         # index into the list of lines to pull out the FASTQ records
         for i in xrange(fastq_count):
             # (header, sequence, header2, quality)
-            fq = FQRead(*lines[i * 4:(i + 1) * 4], qbase=qbase)
-            if filter_function is None: # no filtering
-                yield fq
-            elif filter_function(fq):   # passes filtering
-                yield fq
-            else:                       # fails filtering
+            yield lines[i * 4:(i + 1) * 4]
+
+
+
+def _mmap_records(mm, pos=0):
+    """
+    Generator function that finds the FASTQ_ record boundaries in the 
+    memory-mapped file *mm* without reading it into intermediate buffers. 
+    Each line is copied exactly once, directly from the map. Reading begins 
+    at byte offset *pos*, which must be the start of a record. Yields a tuple 
+    containing the four lines of each record.
+    """
+    size = len(mm)
+    find = mm.find
+    while pos < size:
+        header_end = find('\n', pos)
+        sequence_end = find('\n', header_end + 1)
+        header2_end = find('\n', sequence_end + 1)
+        if header_end == -1 or sequence_end == -1 or header2_end == -1:
+            break # trailing partial record or blank lines
+        quality_end = find('\n', header2_end + 1)
+        if quality_end == -1: # no newline at the end of the file
+            quality_end = size
+        yield (mm[pos:header_end], mm[header_end + 1:sequence_end], 
+               mm[sequence_end + 1:header2_end], 
+               mm[header2_end + 1:quality_end])
+        pos = quality_end + 1
+
+
+
+def _open_mmap(fname):
+    """
+    Memory-map the uncompressed file *fname* for reading. Returns ``None`` 
+    if the file is empty or uses Windows line endings, which must be 
+    translated by the buffered reader.
+    """
+    with open(fname, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return None
+        mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    newline = mm.find('\n')
+    if newline > 0 and mm[newline - 1] == '\r':
+        mm.close()
+        return None
+    return mm
+
+
+
+def is_bgzf(fname):
+    """
+    Returns ``True`` if *fname* is compressed using BGZF (blocked gzip, as 
+    written by ``bgzip``). BGZF files consist of independent gzip members 
+    with the compressed size of each member stored in its header, so they 
+    can be decompressed by several threads.
+    """
+    with open(fname, "rb") as handle:
+        header = handle.read(18)
+    return len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04' and \
+            header[12:14] == 'BC'
+
+
+
+def _bgzf_blocks(handle):
+    """
+    Generator function that reads the BGZF file object *handle* one block at 
+    a time. Yields a tuple containing the offset of the block in the file, 
+    the raw deflate data, CRC32, and uncompressed size for each block.
+    """
+    while True:
+        offset = handle.tell()
+        header = handle.read(12)
+        if len(header) == 0:
+            break
+        if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+            raise IOError("invalid BGZF block header")
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = handle.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == 'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise IOError("BGZF block size missing from header")
+        cdata = handle.read(bsize - xlen - 19)
+        trailer = handle.read(8)
+        if len(trailer) < 8:
+            raise IOError("truncated BGZF block")
+        crc, isize = struct.unpack('<II', trailer)
+        yield offset, cdata, crc, isize
+
+
+
+def _inflate_bgzf_block(block):
+    """
+    Decompress and verify a single block from :py:func:`_bgzf_blocks`. 
+    Called from the worker threads.
+    """
+    offset, cdata, crc, isize = block
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or (zlib.crc32(data) & 0xffffffff) != crc:
+        raise IOError("corrupt BGZF block")
+    return data
+
+
+
+def _bgzf_chunks(handle, threads, queue_size=QUEUE_SIZE):
+    """
+    Generator function that decompresses the BGZF file object *handle* using 
+    a pool of *threads* worker threads. Yields the decompressed blocks in 
+    order. At most *threads* times *queue_size* blocks are in memory at once.
+    """
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        for block in _bgzf_blocks(handle):
+            pending.append(pool.apply_async(_inflate_bgzf_block, (block,)))
+            if len(pending) >= threads * queue_size:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+
+def _file_chunks(handle, buffer_size=BUFFER_SIZE):
+    """
+    Generator function that reads the file object *handle* in chunks of 
+    *buffer_size* bytes.
+    """
+    while True:
+        chunk = handle.read(buffer_size)
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+
+class BackgroundIterator(object):
+    """
+    Iterator that consumes *iterable* in a background thread. Items are 
+    passed to the calling thread through a queue holding at most 
+    *queue_size* items, so the background thread can continue working 
+    (for example, decompressing or parsing a file) while the calling thread 
+    processes the previous items. zlib and bz2 release the Python global 
+    interpreter lock while decompressing. Exceptions raised in the 
+    background thread are raised again by :py:meth:`next`.
+    """
+    _END = None # sentinel that marks the end of the data
+
+    def __init__(self, iterable, queue_size=QUEUE_SIZE):
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=self._fill, args=(iterable,))
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _put(self, item):
+        """
+        Add *item* to the queue, unless :py:meth:`close` has been called. 
+        Returns ``False`` if the thread should stop.
+        """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
                 continue
+        return False
+
+
+    def _fill(self, iterable):
+        """
+        Background thread target.
+        """
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+        except Exception as err:
+            self._put(err)
+        self._put(BackgroundIterator._END)
+
+
+    def __iter__(self):
+        return self
+
+
+    def next(self):
+        """
+        Return the next item from the queue.
+        """
+        if self.done:
+            raise StopIteration
+        item = self.queue.get()
+        if item is BackgroundIterator._END:
+            self.done = True
+            raise StopIteration
+        elif isinstance(item, Exception):
+            self.done = True
+            raise item
+        else:
+            return item
+
+
+    def close(self):
+        """
+        Stop the background thread.
+        """
+        self.stop.set()
+        self.thread.join()
+
+
+
+class BackgroundReader(object):
+    """
+    File-like object that reads the iterable *chunks* (strings of 
+    decompressed data) using a :py:class:`~fqread.BackgroundIterator`. The 
+    file object *handle* that the chunks are read from is closed by 
+    :py:meth:`close`.
 
-    handle.close()
+    Only the :py:meth:`read` and :py:meth:`close` methods are supported.
+    """
+    def __init__(self, chunks, handle, queue_size=QUEUE_SIZE):
+        self.handle = handle
+        self.chunks = BackgroundIterator(chunks, queue_size)
+        self.buffer = ''
+
+
+    def read(self, size):
+        """
+        Return a string containing the next *size* bytes. The string will be 
+        shorter than *size* only at the end of the data.
+        """
+        parts = [self.buffer]
+        available = len(self.buffer)
+        for chunk in self.chunks:
+            parts.append(chunk)
+            available += len(chunk)
+            if available >= size:
+                break
+        data = ''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+    def close(self):
+        """
+        Stop the background thread and close the underlying file object.
+        """
+        self.chunks.close()
+        self.handle.close()
+
+
+
+class FastqWriter(object):
+    """
+    Writes FASTQ_ records to the file *fname*. Records are collected and 
+    written in blocks of about *buffer_size* bytes instead of one record at 
+    a time. If *fname* ends in ``.gz`` or ``.bz2``, the output is compressed 
+    at the given *compresslevel*.
+
+    If *threads* is greater than 0, blocks are compressed and written in a 
+    background thread, so the calling thread can continue preparing records. 
+    Blocks are passed to the background thread through a queue holding at 
+    most *queue_size* blocks. Exceptions raised in the background thread are 
+    raised again by the next call to :py:meth:`flush` or :py:meth:`close`.
+
+    :py:class:`~fqread.FastqWriter` objects can be used in ``with`` 
+    statements, and the file is closed at the end of the block.
+    """
+    _END = None # sentinel that marks the end of the data
+
+    def __init__(self, fname, buffer_size=BUFFER_SIZE, threads=0, 
+                 compresslevel=6, queue_size=QUEUE_SIZE):
+        ext = os.path.splitext(fname)[-1].lower()
+        if ext == ".gz":
+            self.handle = gzip.GzipFile(fname, "wb", compresslevel)
+        elif ext == ".bz2":
+            self.handle = bz2.BZ2File(fname, "wb", compresslevel=compresslevel)
+        else:
+            self.handle = open(fname, "wb")
+        self.buffer_size = buffer_size
+        self.buffer = list()
+        self.buffered = 0
+        self.error = None
+        if threads > 0:
+            self.queue = Queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self._drain)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.queue = None
+            self.thread = None
+
+
+    def _drain(self):
+        """
+        Background thread target.
+        """
+        while True:
+            data = self.queue.get()
+            if data is FastqWriter._END:
+                return
+            if self.error is None:
+                try:
+                    self.handle.write(data)
+                except Exception as err:
+                    self.error = err # keep draining so writers don't block
+
+
+    def _check_error(self):
+        """
+        Raise the exception from the background thread, if there was one.
+        """
+        if self.error is not None:
+            err = self.error
+            self.error = None
+            raise err
+
+
+    def write(self, read):
+        """
+        Write the :py:class:`~fqread.FQRead` *read*. The original quality 
+        string is written unchanged unless the quality values have been 
+        modified (see :py:meth:`FQRead.__str__`).
+        """
+        self.write_record((read.header, read.sequence, read.header2, 
+                           read.quality_string()))
+
+
+    def write_record(self, lines):
+        """
+        Write a record given as the four strings *lines* (header, sequence, 
+        header2, quality) without newlines, such as those produced while 
+        reading a FASTQ_ file.
+        """
+        record = '\n'.join(lines) + '\n'
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write the buffered records to the file (or pass them to the 
+        background thread).
+        """
+        self._check_error()
+        if self.buffered > 0:
+            data = ''.join(self.buffer)
+            self.buffer = list()
+            self.buffered = 0
+            if self.queue is not None:
+                self.queue.put(data)
+            else:
+                self.handle.write(data)
+
+
+    def close(self):
+        """
+        Write any buffered records, wait for the background thread to finish, 
+        and close the file.
+        """
+        try:
+            self.flush()
+        finally:
+            if self.thread is not None:
+                self.queue.put(FastqWriter._END)
+                self.thread.join()
+                self.thread = None
+            self.handle.close()
+        self._check_error()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+class FastqIndex(object):
+    """
+    Index of record offsets for the FASTQ_ file *fname*, created by 
+    :py:func:`index_fastq`. The index stores a checkpoint for every 
+    *interval* records, allowing reading to begin at any record without 
+    parsing the preceding records. The *size* and *mtime* of the FASTQ_ file 
+    are stored so that out of date indexes can be detected. The total number 
+    of records in the file is stored as *records*.
+
+    Each checkpoint consists of a restart offset in the file (*restarts*) and 
+    the number of decompressed bytes to discard after restarting (*skips*). 
+    For uncompressed files, the restart offset is the position of the 
+    record. For BGZF files (see :py:func:`is_bgzf`), it is the position of 
+    the block containing the record. Other compressed files cannot be 
+    restarted in the middle, so they are decompressed from the beginning 
+    and the decompressed data before the record are discarded without being 
+    parsed.
+    """
+    _MAGIC = "FQI\x01"
+    _HEADER = struct.Struct('<QdQQQ') # size, mtime, interval, records, count
+
+    def __init__(self, fname, size, mtime, interval, records, restarts, skips):
+        self.fname = fname
+        self.size = size
+        self.mtime = mtime
+        self.interval = interval
+        self.records = records
+        self.restarts = restarts
+        self.skips = skips
+
+
+    def locate(self, record):
+        """
+        Return a tuple containing the restart offset, number of bytes to 
+        discard, and the record number of the last checkpoint at or before 
+        *record*. Records are numbered starting at 0.
+        """
+        k = min(record // self.interval, len(self.restarts) - 1)
+        if k < 0:
+            return 0, 0, 0
+        else:
+            return self.restarts[k], self.skips[k], k * self.interval
+
+
+    def is_current(self):
+        """
+        Return ``True`` if the size and modification time of the FASTQ_ file 
+        match the values stored in the index.
+        """
+        return os.path.getsize(self.fname) == self.size and \
+                os.path.getmtime(self.fname) == self.mtime
+
+
+    def write(self, iname=None):
+        """
+        Save the index to the file *iname*. By default, the index is saved 
+        next to the FASTQ_ file with the ``INDEX_EXTENSION`` added.
+        """
+        if iname is None:
+            iname = self.fname + INDEX_EXTENSION
+        count = len(self.restarts)
+        with open(iname, "wb") as handle:
+            handle.write(FastqIndex._MAGIC)
+            handle.write(FastqIndex._HEADER.pack(self.size, self.mtime, 
+                         self.interval, self.records, count))
+            handle.write(struct.pack('<{n}Q'.format(n=count), *self.restarts))
+            handle.write(struct.pack('<{n}Q'.format(n=count), *self.skips))
+
+
+
+def load_fastq_index(fname, iname=None):
+    """
+    Load the :py:class:`~fqread.FastqIndex` for FASTQ_ file *fname* from 
+    the file *iname* (by default, the sidecar file written by 
+    :py:func:`index_fastq`). Returns ``None`` if there is no index file or 
+    the index is out of date.
+    """
+    if iname is None:
+        iname = fname + INDEX_EXTENSION
+    if not os.path.isfile(iname):
+        return None
+    with open(iname, "rb") as handle:
+        if handle.read(len(FastqIndex._MAGIC)) != FastqIndex._MAGIC:
+            raise IOError("invalid FASTQ index file '{iname}'".format(iname=iname))
+        size, mtime, interval, records, count = \
+                FastqIndex._HEADER.unpack(handle.read(FastqIndex._HEADER.size))
+        fmt = struct.Struct('<{n}Q'.format(n=count))
+        restarts = list(fmt.unpack(handle.read(fmt.size)))
+        skips = list(fmt.unpack(handle.read(fmt.size)))
+    index = FastqIndex(fname, size, mtime, interval, records, restarts, skips)
+    if not index.is_current():
+        print("Warning: ignoring out of date index '{iname}'".format(iname=iname), file=stderr)
+        return None
+    return index
+
+
+
+def _scan_record_offsets(chunks, interval):
+    """
+    Find the byte offset of every *interval* th FASTQ_ record in the 
+    iterable of decompressed data *chunks*. Returns a tuple containing the 
+    list of offsets and the total number of records.
+    """
+    offsets = list()
+    step = 4 * interval # lines between checkpoints
+    next_line = 0       # line number of the next checkpoint
+    lines = 0           # number of lines before the current chunk
+    position = 0        # offset of the current chunk
+    last = '\n'
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if position == 0:
+            newline = chunk.find('\n')
+            if newline > 0 and chunk[newline - 1] == '\r':
+                raise IOError("cannot index FASTQ file with Windows line endings")
+        n = chunk.count('\n')
+        while next_line <= lines + n:
+            # next checkpoint starts after newline number next_line
+            pos = -1
+            for _ in xrange(next_line - lines):
+                pos = chunk.find('\n', pos + 1)
+            offsets.append(position + pos + 1)
+            next_line += step
+        lines += n
+        position += len(chunk)
+        last = chunk[-1]
+    if last != '\n': # no newline at the end of the file
+        lines += 1
+    records = lines / 4
+    return offsets[:(records + interval - 1) / interval], records
+
+
+
+def _indexed_bgzf_chunks(handle, coffsets, uoffsets):
+    """
+    Generator function that decompresses the BGZF file object *handle* one 
+    block at a time. The compressed and decompressed offset of each block 
+    are appended to *coffsets* and *uoffsets*.
+    """
+    uoffset = 0
+    for block in _bgzf_blocks(handle):
+        data = _inflate_bgzf_block(block)
+        coffsets.append(block[0])
+        uoffsets.append(uoffset)
+        uoffset += len(data)
+        yield data
+
+
+
+def index_fastq(fname, interval=INDEX_INTERVAL, write=True):
+    """
+    Scan FASTQ_ file *fname* once and create a 
+    :py:class:`~fqread.FastqIndex` with a checkpoint for every *interval* 
+    records. If *write* is ``True``, the index is saved next to the FASTQ_ 
+    file (see :py:meth:`FastqIndex.write`), where it will be found by 
+    :py:func:`read_fastq` and :py:func:`read_fastq_multi`. Returns the 
+    :py:class:`~fqread.FastqIndex`.
+    """
+    compression = check_fastq(fname)
+    size = os.path.getsize(fname)
+    mtime = os.path.getmtime(fname)
+    bgzf = compression == "gz" and is_bgzf(fname)
+    if compression is None:
+        handle = open(fname, "rb")
+        chunks = _file_chunks(handle)
+    elif bgzf:
+        handle = open(fname, "rb")
+        coffsets = list()
+        uoffsets = list()
+        chunks = _indexed_bgzf_chunks(handle, coffsets, uoffsets)
+    else:
+        handle = open_compressed(fname, compression)
+        chunks = _file_chunks(handle)
+
+    try:
+        offsets, records = _scan_record_offsets(chunks, interval)
+    finally:
+        handle.close()
+
+    if compression is None:
+        restarts = offsets
+        skips = [0] * len(offsets)
+    elif bgzf:
+        restarts = list()
+        skips = list()
+        for offset in offsets:
+            i = bisect.bisect_right(uoffsets, offset) - 1
+            restarts.append(coffsets[i])
+            skips.append(offset - uoffsets[i])
+    else:
+        restarts = [0] * len(offsets)
+        skips = offsets
+
+    index = FastqIndex(fname, size, mtime, interval, records, restarts, skips)
+    if write:
+        index.write()
+    return index
+
+
+
+def _discard(handle, nbytes, buffer_size=BUFFER_SIZE):
+    """
+    Read and discard *nbytes* bytes from the file object *handle*.
+    """
+    while nbytes > 0:
+        data = handle.read(min(buffer_size, nbytes))
+        if len(data) == 0:
+            break
+        nbytes -= len(data)
+
+
+
+def _fastq_records(fname, buffer_size=BUFFER_SIZE, use_mmap=True, threads=0,
+                   start=None, stop=None, index=None):
+    """
+    Generator function that opens the FASTQ_ file *fname* and yields the 
+    four lines of each record. Used by :py:func:`read_fastq` and 
+    :py:func:`read_fastq_batches`.
+
+    Only the records numbered from *start* up to (but not including) *stop* 
+    are yielded. Records are numbered starting at 0. If *start* is set, 
+    the :py:class:`~fqread.FastqIndex` *index* (or the index file next to 
+    *fname*, if there is one) is used to skip the preceding records.
+    """
+    compression = check_fastq(fname)
+    if start is None:
+        start = 0
+    restart, skip, first = 0, 0, 0
+    if start > 0:
+        if index is None:
+            index = load_fastq_index(fname)
+        if index is not None:
+            restart, skip, first = index.locate(start)
+    bgzf = compression == "gz" and (threads > 1 or restart > 0) and \
+            is_bgzf(fname)
+
+    mm = None
+    raw = None # compressed file object for BGZF files
+    if compression is None: # raw FASTQ
+        if use_mmap:
+            mm = _open_mmap(fname)
+        if mm is None:
+            handle = open(fname, "rU")
+            handle.seek(restart)
+    elif bgzf: # blocks are read and decompressed separately
+        raw = open(fname, "rb")
+        raw.seek(restart)
+        if threads > 1:
+            handle = raw
+        else:
+            handle = gzip.GzipFile(fileobj=raw, mode="rb")
+    else:
+        handle = open_compressed(fname, compression)
+
+    if mm is None and threads > 0: # decompress in the background
+        if bgzf and threads > 1:
+            chunks = _bgzf_chunks(raw, threads)
+        else:
+            chunks = _file_chunks(handle, buffer_size)
+        handle = BackgroundReader(chunks, handle)
+
+    try:
+        if mm is not None:
+            records = _mmap_records(mm, restart)
+        else:
+            _discard(handle, skip, buffer_size)
+            records = _buffered_records(handle, buffer_size)
+        if start > first or stop is not None:
+            if stop is not None:
+                stop = max(stop, start) - first
+            records = itertools.islice(records, start - first, stop)
+        for record in records:
+            yield record
+    finally:
+        if mm is not None:
+            mm.close()
+        else:
+            handle.close()
+        if raw is not None:
+            raw.close()
+
+
+
+def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE, qbase=33,
+               use_mmap=True, threads=0, start=None, stop=None, index=None):
+    """
+    Generator function for reading from FASTQ_ file *fname*. Yields an 
+    :py:class:`~fqread.FQRead` object for each FASTQ_ record in the file. The 
+    *filter_function* must operate on an :py:class:`~fqread.FQRead` object 
+    and return ``True`` or ``False``. If the result is ``False``, the record 
+    will be skipped silently.
+
+    If *use_mmap* is ``True``, uncompressed files are memory-mapped and 
+    records are sliced directly from the map instead of being read in 
+    chunks of *buffer_size* bytes.
+
+    If *threads* is greater than 0, decompression is performed in a 
+    background thread while the records are parsed. If *threads* is 
+    greater than 1 and the file is BGZF-compressed (see 
+    :py:func:`is_bgzf`), blocks are decompressed by *threads* worker 
+    threads. Other compressed formats cannot be split into independent 
+    blocks, so they use a single background thread.
+
+    If *start* or *stop* are set, only the records numbered from *start* up 
+    to (but not including) *stop* are read. Records are numbered starting 
+    at 0. If *start* is set, the :py:class:`~fqread.FastqIndex` *index* is 
+    used to begin reading near *start* without parsing the preceding 
+    records. If *index* is ``None``, the index file created by 
+    :py:func:`index_fastq` is used if it exists.
+
+    .. note:: To read multiple files in parallel (such as index or \
+        forward/reverse reads), use :py:func:`read_fastq_multi` instead.
+    """
+    for record in _fastq_records(fname, buffer_size, use_mmap, threads, start, 
+                                 stop, index):
+        fq = FQRead(*record, qbase=qbase)
+        if filter_function is None: # no filtering
+            yield fq
+        elif filter_function(fq):   # passes filtering
+            yield fq
+        else:                       # fails filtering
+            continue
+
+
+
+def read_fastq_batches(fname, batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE, 
+                       qbase=33, use_mmap=True, threads=0, start=None, 
+                       stop=None, index=None):
+    """
+    Generator function for reading from FASTQ_ file *fname* in blocks. 
+    Yields an :py:class:`~fqread.FQBatch` object for each block of 
+    *batch_size* FASTQ_ records in the file (the last block may be smaller). 
+    Filtering is performed on the whole :py:class:`~fqread.FQBatch`, so 
+    there is no *filter_function*.
+
+    The *buffer_size*, *qbase*, *use_mmap*, *threads*, *start*, *stop*, and 
+    *index* arguments are the same as for :py:func:`read_fastq`.
+    """
+    records = _fastq_records(fname, buffer_size, use_mmap, threads, start, 
+                             stop, index)
+    while True:
+        block = list(itertools.islice(records, batch_size))
+        if len(block) == 0:
+            break
+        yield FQBatch(block, qbase=qbase)
+
+
+
+def _prefetch_fastq(fname, buffer_size=BUFFER_SIZE, qbase=33, use_mmap=True,
+                    threads=0, start=None, stop=None, index=None):
+    """
+    Generator function that reads FASTQ_ file *fname* in a background 
+    thread. The records are read ahead in blocks of ``PREFETCH_SIZE`` using a 
+    :py:class:`~fqread.BackgroundIterator`. Yields an 
+    :py:class:`~fqread.FQRead` object for each FASTQ_ record in the file.
+    """
+    records = _fastq_records(fname, buffer_size, use_mmap, threads, start, 
+                             stop, index)
+    blocks = BackgroundIterator(iter(lambda: list(itertools.islice(records, 
+                                    PREFETCH_SIZE)), []))
+    try:
+        for block in blocks:
+            for record in block:
+                yield FQRead(*record, qbase=qbase)
+    finally:
+        blocks.close()
+        records.close()
 
 
 
 def read_fastq_multi(fnames, filter_function=None, buffer_size=BUFFER_SIZE,
-                     match_lengths=True, qbase=33):
+                     match_lengths=True, qbase=33, use_mmap=True, threads=0,
+                     prefetch=False, start=None, stop=None, indexes=None):
     """
     Generator function for reading from multiple FASTQ_ files in parallel. 
     The argument *fnames* is an iterable of FASTQ_ file names. Yields a 
@@ -246,24 +1479,49 @@ def read_fastq_multi(fnames, filter_function=None, buffer_size=BUFFER_SIZE,
     If *match_lengths* is ``True``, the generator will yield ``None`` if the 
     files do not contain the same number of FASTQ_ records. Otherwise, it 
     will silently ignore partial records.
+
+    If *prefetch* is ``True``, each file is read and decompressed by its own 
+    background thread, which reads ahead into a bounded buffer. The files 
+    are then decompressed concurrently instead of one after another, so the 
+    reader only waits for the slowest file.
+
+    The *buffer_size*, *qbase*, *use_mmap*, *threads*, *start*, and *stop* 
+    arguments are passed to :py:func:`read_fastq` for each file. If 
+    *indexes* is set, it must be a list containing a 
+    :py:class:`~fqread.FastqIndex` (or ``None``) for each file.
     """
+    fnames = list(fnames)
+    if indexes is None:
+        indexes = [None] * len(fnames)
     fq_generators = list()
-    for f in fnames:
-        fq_generators.append(read_fastq(f, filter_function=None,
-                             buffer_size=BUFFER_SIZE, qbase=qbase))
-
-    for records in itertools.izip_longest(*fq_generators, fillvalue=None):
-        if None in records: # mismatched file lengths
-            if match_lengths:
-                yield None
-            else:
-                break # shortest FASTQ file is empty, so we're done
-        if filter_function is None:                     # no filtering
-            yield records
-        elif all(filter_function(x) for x in records):  # pass filtering
-            yield records
-        else:                                           # fail filtering
-            continue
+    for f, index in zip(fnames, indexes):
+        if prefetch:
+            fq_generators.append(_prefetch_fastq(f, buffer_size=buffer_size, 
+                                 qbase=qbase, use_mmap=use_mmap, 
+                                 threads=threads, start=start, stop=stop, 
+                                 index=index))
+        else:
+            fq_generators.append(read_fastq(f, filter_function=None,
+                                 buffer_size=buffer_size, qbase=qbase, 
+                                 use_mmap=use_mmap, threads=threads, 
+                                 start=start, stop=stop, index=index))
+
+    try:
+        for records in itertools.izip_longest(*fq_generators, fillvalue=None):
+            if None in records: # mismatched file lengths
+                if match_lengths:
+                    yield None
+                else:
+                    break # shortest FASTQ file is empty, so we're done
+            if filter_function is None:                     # no filtering
+                yield records
+            elif all(filter_function(x) for x in records):  # pass filtering
+                yield records
+            else:                                           # fail filtering
+                continue
+    finally:
+        for g in fq_generators:
+            g.close()
 
 
 
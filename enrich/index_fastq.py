@@ -0,0 +1,37 @@
+from __future__ import print_function
+from sys import stderr
+import argparse
+from fqread import index_fastq, INDEX_INTERVAL
+
+
+def index_fastq_files(files, interval):
+    """
+    Create a record offset index next to each FASTQ file in *files*, with a 
+    checkpoint every *interval* records.
+    """
+    if len(files) == 0:
+        print("Error: no files provided", file=stderr)
+        return
+
+    for f in files:
+        try:
+            index = index_fastq(f, interval=interval)
+        except IOError as err:
+            print("Error: could not index '{fname}': {err}".format(fname=f, 
+                  err=err), file=stderr)
+            continue
+        print("{fname}: {n} records".format(fname=f, n=index.records))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index records in FASTQ files.")
+    parser.add_argument("files", metavar="FQ", nargs="+",
+                        help="FASTQ files to index")
+    parser.add_argument("-n", "--interval", metavar="N", type=int,
+                        default=INDEX_INTERVAL, 
+                        help="number of records between index entries")
+
+    args = parser.parse_args()
+
+    index_fastq_files(args.files, args.interval)
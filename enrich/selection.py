@@ -2,10 +2,10 @@ from __future__ import print_function
 from enrich_error import EnrichError
 from scipy import stats
 from seqlib.basic import BasicSeqLib
-from seqlib.barcodevariant import BarcodeVariantSeqLib, BarcodeMap
+from seqlib.barcodevariant import BarcodeVariantSeqLib, load_barcode_map
 from seqlib.barcode import BarcodeSeqLib
 from seqlib.overlap import OverlapSeqLib
-from seqlib.variant import WILD_TYPE_VARIANT
+from seqlib.variant import VariantSeqLib, WILD_TYPE_VARIANT
 from config_check import seqlib_type
 from datacontainer import DataContainer
 import os
@@ -21,13 +21,21 @@ import copy
 
 from sys import stderr
 
-def nonsense_ns_carryover_apply_fn(row, position):
+def nonsense_ns_carryover_apply_fn(row, position, library=None):
     """
     :py:meth:`pandas.DataFrame.apply` function for determining which rows 
     contribute counts to nonspecific carryover calculations. Returns ``True`` 
     if the variant has a change to stop at or before amino acid number 
     *position*.
+
+    If *library* is a :py:class:`~seqlib.variant.VariantSeqLib` that 
+    created the variant string, the variant is checked using its integer 
+    code (see :py:meth:`~seqlib.variant.VariantSeqLib.nonsense_position`). 
+    Otherwise, the variant string is parsed.
     """
+    if library is not None and library.variant_code(row.name) is not None:
+        nonsense = library.nonsense_position(row.name)
+        return nonsense is not None and nonsense <= position
     m = re.search("p\.[A-Z][a-z][a-z](\d+)Ter", row.name)
     if m is not None:
         if int(m.group(1)) <= position:
@@ -160,8 +168,10 @@ class Selection(DataContainer):
         try:
             if 'barcodes' in config:
                 if 'map file' in config['barcodes']:
-                    self.barcode_map = BarcodeMap(config['barcodes']
-                                                        ['map file'])
+                    self.barcode_map = load_barcode_map(
+                            config['barcodes']['map file'],
+                            config['barcodes'].get('packed map', False),
+                            config['barcodes'].get('map cache', False))
                 else:
                     self.barcode_map = None
             else:
@@ -217,9 +227,12 @@ class Selection(DataContainer):
                                       'max barcode variation' : None})
 
             if 'carryover correction' in config:
-                if config['carrover correction']['method'] == "nonsense":
+                if config['carryover correction']['method'] == "nonsense":
                     self.ns_carryover_fn = nonsense_ns_carryover_apply_fn
                     self.ns_carryover_kwargs = {'position' : int(config['carryover correction']['position'])}
+                    library = self.libraries[self.timepoints[0]][0]
+                    if isinstance(library, VariantSeqLib):
+                        self.ns_carryover_kwargs['library'] = library
                 # add additional methods here using "elif" blocks
                 else:
                     raise EnrichError("Unrecognized nonspecific carryover correction", self.name)
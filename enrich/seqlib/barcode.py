@@ -3,7 +3,9 @@ import re
 import logging
 from seqlib import SeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq, check_fastq
+from fqread import read_fastq_batches, check_fastq
+from packed import PackedCounter, CountMinSketch, SKETCH_WIDTH
+import numpy as np
 import pandas as pd
 
 # debugging
@@ -37,6 +39,17 @@ class BarcodeSeqLib(SeqLib):
     dataset. Setting the ``"min count"`` option appropriately can 
     dramatically improve execution time and reduce memory usage.
 
+    If the ``"sketch"`` entry in ``"barcodes"`` is ``true`` and 
+    ``"min count"`` is set, the reads are counted in two passes. The first 
+    pass estimates the count of every barcode using a 
+    :py:class:`~seqlib.packed.CountMinSketch` (with ``"sketch width"`` 
+    counters per row, if given), and the second pass only counts the 
+    barcodes whose estimate is at least ``"min count"`` (or that are kept by 
+    :py:meth:`keep_rare_barcodes`). This limits memory usage to the 
+    barcodes that are likely to be retained, but the low-abundance barcodes 
+    written to disk only include those that were overestimated by the 
+    sketch.
+
     .. note:: The :py:class:`~seqlib.barcodevariant.BarcodeVariantSeqLib` \
     class implements an alternative method for removing artifactual barcodes \
     that may be more appropriate for users of that module.
@@ -71,11 +84,17 @@ class BarcodeSeqLib(SeqLib):
             else:
                 self.min_count = 0
 
+            self.use_sketch = config['barcodes'].get('sketch', False)
+            self.sketch_width = int(config['barcodes'].get('sketch width', 
+                                                           SKETCH_WIDTH))
+
             self.set_filters(config['filters'], {'min quality' : 0,
                                       'avg quality' : 0,
                                       'chastity' : False})
         except KeyError as key:
             raise EnrichError("Missing required config value {key}".format(key=key), self.name)
+        except ValueError as value:
+            raise EnrichError("Invalid parameter value {value}".format(value=value), self.name)
 
         try:
             check_fastq(self.reads)
@@ -83,62 +102,158 @@ class BarcodeSeqLib(SeqLib):
             raise EnrichError("FASTQ file error: {error}".format(error=fqerr), self.name)
 
         self.df_dict['barcodes'] = None
+        self.barcode_counter = None
+        self.sketch = None
+        self.sketch_pass = False
         if self.min_count > 0:
             self.df_dict['barcodes_low_abundance'] = None
 
 
+    def reset_counts(self):
+        """
+        Remove the barcode counts made by :py:meth:`count_records`. During 
+        the first pass of sketch mode, the 
+        :py:class:`~seqlib.packed.CountMinSketch` is reset instead.
+        """
+        if self.sketch_pass:
+            self.sketch = CountMinSketch(self.sketch_width)
+        else:
+            self.barcode_counter = PackedCounter(self.count_budget, 
+                                                 self.spill_directory())
+
+
+    def shard_counts(self):
+        """
+        Return the :py:class:`~seqlib.packed.PackedCounter` (or 
+        :py:class:`~seqlib.packed.CountMinSketch` during the first pass of 
+        sketch mode) used by :py:meth:`count_records`.
+        """
+        if self.sketch_pass:
+            return self.sketch
+        else:
+            return self.barcode_counter
+
+
+    def merge_counts(self, counts):
+        """
+        Add the barcode counts *counts* from a worker process (see 
+        :py:meth:`shard_counts`).
+        """
+        if self.sketch_pass:
+            self.sketch.update(counts)
+        else:
+            self.barcode_counter.update(counts)
+
+
+    def count_records(self, start=None, stop=None, indexes=None):
+        """
+        Reads the forward or reverse FASTQ file (reverse reads are 
+        reverse-complemented), performs quality-based filtering, and counts 
+        the barcodes. See :py:meth:`SeqLib.count_records 
+        <seqlib.seqlib.SeqLib.count_records>`.
+        """
+        index = indexes[0] if indexes is not None else None
+        for batch in read_fastq_batches(self.reads, threads=self.threads, 
+                                        start=start, stop=stop, index=index):
+            batch.trim_length(self.bc_length, start=self.bc_start)
+            if self.revcomp_reads:
+                batch.revcomp()
+
+            # filter the barcodes based on specified quality settings
+            filter_flags = self.filter_batch(batch)
+            self.report_filtered_batch(batch, filter_flags)
+            passed = np.ones(len(batch), dtype=bool)
+            for key in filter_flags:
+                passed &= np.invert(filter_flags[key])
+
+            if self.sketch_pass:
+                self.sketch.add_matrix(batch.sequence, batch.lengths, passed)
+            else:
+                if self.sketch is not None: # skip low-abundance barcodes
+                    rare = passed & (self.sketch.estimate_matrix(
+                            batch.sequence, batch.lengths) < self.min_count)
+                    rare[rare] = np.invert(self.keep_rare_barcodes(batch, rare))
+                    passed &= np.invert(rare)
+                self.barcode_counter.add_matrix(batch.sequence, 
+                                                batch.lengths, passed)
+
+
+    def count_all(self):
+        """
+        Count all the records, using :py:meth:`count_sharded 
+        <seqlib.seqlib.SeqLib.count_sharded>` if there is more than one 
+        worker process.
+        """
+        if self.processes > 1:
+            self.count_sharded([self.reads])
+        else:
+            self.count_records()
+
+
+    def keep_rare_barcodes(self, batch, mask):
+        """
+        Return a boolean array that is ``True`` for each read in the 
+        :py:class:`~fqread.FQBatch` *batch* selected by *mask* whose barcode 
+        should be counted in the second pass of sketch mode even though its 
+        estimated count is below ``"min count"``. Returns all ``False`` for a 
+        :py:class:`~seqlib.barcode.BarcodeSeqLib`, but can be overridden by 
+        derived classes that need these barcodes in 
+        :py:meth:`correct_barcodes`.
+        """
+        return np.zeros(np.count_nonzero(mask), dtype=bool)
+
+
+    def correct_barcodes(self):
+        """
+        Correct sequencing errors in the counted barcodes before the 
+        ``"min count"`` filter is applied. Does nothing for a 
+        :py:class:`~seqlib.barcode.BarcodeSeqLib`, but can be overridden by 
+        derived classes.
+        """
+        pass
+
+
     def calculate(self):
         """
         Reads the forward or reverse FASTQ file (reverse reads are 
         reverse-complemented), performs quality-based filtering, and counts 
         the barcodes.
         """
-        self.df_dict['barcodes'] = dict()
+        if self.use_sketch and self.min_count > 0:
+            # estimate barcode abundance without reporting filtered reads
+            logging.info("Estimating barcode counts [{name}]".format(name=self.name))
+            report_filtered = self.report_filtered
+            self.report_filtered = False
+            self.sketch_pass = True
+            self.reset_counts()
+            self.count_all()
+            self.sketch_pass = False
+            self.report_filtered = report_filtered
+            for key in self.filter_stats: # filters are applied again
+                self.filter_stats[key] = 0
 
-        filter_flags = dict()
-        for key in self.filters:
-            filter_flags[key] = False
+        self.reset_counts()
 
         # count all the barcodes
         logging.info("Counting barcodes [{name}]".format(name=self.name))
-        for fq in read_fastq(self.reads):
-            fq.trim_length(self.bc_length, start=self.bc_start)
-            if self.revcomp_reads:
-                fq.revcomp()
+        self.count_all()
+        self.sketch = None
 
-            for key in filter_flags:
-                filter_flags[key] = False
-
-            # filter the barcode based on specified quality settings
-            if self.filters['chastity']:
-                if not fq.is_chaste():
-                    self.filter_stats['chastity'] += 1
-                    filter_flags['chastity'] = True
-            if self.filters['min quality'] > 0:
-                if fq.min_quality() < self.filters['min quality']:
-                    self.filter_stats['min quality'] += 1
-                    filter_flags['min quality'] = True
-            if self.filters['avg quality'] > 0:
-                if fq.mean_quality() < self.filters['avg quality']:
-                    self.filter_stats['avg quality'] += 1
-                    filter_flags['avg quality'] = True
-            if any(filter_flags.values()): # failed quality filtering
-                self.filter_stats['total'] += 1
-                if self.report_filtered:
-                    self.report_filtered_read(fq, filter_flags)
-            else: # passed quality filtering
-                try:
-                    self.df_dict['barcodes'][fq.sequence.upper()] += 1
-                except KeyError:
-                    self.df_dict['barcodes'][fq.sequence.upper()] = 1
-
-        self.df_dict['barcodes'] = \
-                pd.DataFrame.from_dict(self.df_dict['barcodes'], 
-                                       orient="index", dtype="int32")
-        if len(self.df_dict['barcodes']) == 0:
+        # barcodes are only decoded into strings once they are all counted, 
+        # one partition at a time
+        frames = [pd.DataFrame({'count' : counts}, index=barcodes, 
+                               dtype="int32") for barcodes, counts in 
+                  self.barcode_counter.iter_partitions() if len(barcodes) > 0]
+        self.barcode_counter = None
+        if len(frames) == 0:
             raise EnrichError("Failed to count barcodes", self.name)
-        self.df_dict['barcodes'].columns = ['count']
+        elif len(frames) == 1:
+            self.df_dict['barcodes'] = frames[0]
+        else:
+            self.df_dict['barcodes'] = pd.concat(frames)
+        del frames
         self.df_dict['barcodes'].sort('count', ascending=False, inplace=True)
+        self.correct_barcodes()
         if 'barcodes_low_abundance' in self.df_dict: # min count is set
             self.df_dict['barcodes_low_abundance'] = self.df_dict['barcodes'][self.df_dict['barcodes']['count'] < self.min_count]
             logging.info("Writing counts for {n} unique low-abundance barcodes to disk [{name}]".format(n=len(self.df_dict['barcodes_low_abundance']), name=self.name))
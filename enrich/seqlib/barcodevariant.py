@@ -1,14 +1,20 @@
 from __future__ import print_function
-import re
 import logging
-import gzip
-import bz2
+import os
 import os.path
+import struct
+import tempfile
+import marshal
+import hashlib
+import itertools
 from variant import VariantSeqLib
 from barcode import BarcodeSeqLib
 from seqlib import SeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq, check_fastq
+from fqread import read_fastq, check_fastq, open_compressed
+from packed import pack_strings, unpack_keys, find_unique_neighbours, \
+        MAX_PACKED_LENGTH
+import numpy as np
 import pandas as pd
 
 
@@ -16,60 +22,696 @@ import pandas as pd
 FILTERED_VARIANT = "~filtered"
 
 
+# file extension for packed barcode map files
+PACKED_MAP_EXTENSION = ".bcm"
+
+
+# file extension for barcode map cache files
+MAP_CACHE_EXTENSION = ".bcc"
+
+
+# format version stored in barcode map cache files
+_MAP_CACHE_VERSION = 1
+
+
+# number of bytes of the barcode map file parsed at a time
+MAP_CHUNK_SIZE = 1 << 24
+
+
+def _char_table(chars):
+    """
+    Return a boolean array indexed by byte value that is ``True`` for each 
+    character in *chars*.
+    """
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(chars, dtype=np.uint8)] = True
+    return table
+
+
+# characters allowed in barcode map lines (other than comments)
+_map_chars = "ACGTNacgtn \t\n\r\x0b\x0c"
+
+
+# whitespace other than newlines (same as str.split)
+_space_chars = _char_table(" \t\r\x0b\x0c")
+_barcode_chars = _char_table("ACGT")
+_variant_chars = _char_table("ACGTN")
+
+
+# uppercase character for each byte value
+_upper_chars = np.frombuffer(''.join(chr(i) for i in xrange(256)).upper(), 
+                             dtype=np.uint8)
+
+
 class BarcodeMap(dict):
     """
     Dictionary-derived class for storing the relationship between barcodes 
     and variants. Requires the path to a *mapfile*, containing lines in the 
     format ``'barcode<tab>variant'`` for each barcode expected in the library. 
-    This file can be plain text or compressed (``.bz2`` or ``.gz``).
+    This file can be plain text or compressed (see 
+    :py:func:`~fqread.open_compressed`).
 
     Barcodes must only contain the characters ``ACGT`` and variants must only 
     contain the characters ``ACGTN`` (lowercase characters are also accepted). 
+
+    If *cache* is ``True``, the parsed map is saved to a cache file next to 
+    *mapfile* with ``MAP_CACHE_EXTENSION`` added, and later objects for the 
+    same *mapfile* load the cache instead of parsing and validating the 
+    file again. The cache is used if the path, size, and modification time 
+    of *mapfile* match the values stored in the cache. If only the 
+    modification time differs, the cache is still used if the SHA-1 digest 
+    of the file is unchanged.
     """
-    def __init__(self, mapfile):
+    def __init__(self, mapfile, cache=False):
         self.name = "barcodemap_{fname}".format(fname=os.path.basename(mapfile))
         self.filename = mapfile
         self.variants = dict()
         self.bc_variant_strings = dict()
+        self._key_index = None
+        if cache:
+            self.cache_filename = mapfile + MAP_CACHE_EXTENSION
+        else:
+            self.cache_filename = None
+
+        if self.cache_filename is not None and self.load_cache():
+            logging.info("Loaded barcode map from cache '{fname}'".format(fname=self.cache_filename))
+            return
+        self.read_mapfile()
+        if self.cache_filename is not None:
+            self.write_cache()
+
 
+    def read_mapfile(self):
+        """
+        Parse and validate the barcode map file. The file is read in chunks 
+        of ``MAP_CHUNK_SIZE`` bytes that are each parsed by 
+        :py:meth:`_parse_chunk`, and barcodes that appear more than once are 
+        checked for conflicting variants using arrays. Errors are reported 
+        for the first invalid line in the file.
+        """
         try:
-            ext = os.path.splitext(mapfile)[-1].lower()
-            if ext in (".bz2"):
-                handle = bz2.BZ2File(mapfile, "rU")
-            elif ext in (".gz"):
-                handle = gzip.GzipFile(mapfile, "rU")
-            else:
-                handle = open(mapfile, "rU")
+            handle = open_compressed(self.filename)
         except IOError:
-            raise EnrichError("Could not open barcode map file '{fname}'".format(fname=mapfile), self.name)
+            raise EnrichError("Could not open barcode map file '{fname}'".format(fname=self.filename), self.name)
 
-        for line in handle:
-            # skip comments and whitespace-only lines
-            if len(line.strip()) == 0 or line[0] == '#':
-                continue
-
-            try:
-                barcode, variant = line.strip().split()
-            except ValueError:
-                raise EnrichError("Unexpected barcode-variant line format", 
-                                  self.name)
-
-            if not re.match("^[ACGTacgt]+$", barcode):
-                raise EnrichError("Barcode DNA sequence contains unexpected "
-                                  "characters", self.name)
-            if not re.match("^[ACGTNacgtn]+$", variant):
-                raise EnrichError("Variant DNA sequence contains unexpected "
-                                  "characters", self.name)
-
-            barcode = barcode.upper()
-            variant = variant.upper()
-            if barcode in self:
-                if self[barcode] != variant:
-                    raise EnrichError("Barcode '{bc}' assigned to multiple unique variants".format(bc=barcode), self.name)
+        barcodes = list()
+        variants = list()
+        remainder = ""
+        error = None
+        while error is None:
+            chunk = handle.read(MAP_CHUNK_SIZE)
+            if len(chunk) == 0:
+                chunk = remainder
+                remainder = None
             else:
-                self[barcode] = variant
+                chunk = remainder + chunk
+                end = chunk.rfind("\n") + 1
+                chunk, remainder = chunk[:end], chunk[end:]
+            chunk_barcodes, chunk_variants, error = self._parse_chunk(chunk)
+            barcodes.extend(chunk_barcodes)
+            variants.extend(chunk_variants)
+            if remainder is None:
+                break
         handle.close()
 
+        # conflicts on lines before the first invalid line are reported first
+        barcode_ids, unique_barcodes = pd.factorize(barcodes)
+        if len(unique_barcodes) < len(barcode_ids): # duplicate barcodes
+            variant_array = np.empty(len(variants), dtype=object)
+            variant_array[:] = variants
+            _, first = np.unique(barcode_ids, return_index=True)
+            conflicts = np.flatnonzero(variant_array != 
+                                       variant_array[first[barcode_ids]])
+            if len(conflicts) > 0:
+                raise EnrichError("Barcode '{bc}' assigned to multiple unique variants".format(bc=barcodes[conflicts[0]]), self.name)
+        if error is not None:
+            raise EnrichError(error, self.name)
+        self.update(itertools.izip(barcodes, variants))
+
+
+    def _parse_chunk(self, chunk):
+        """
+        Parse the complete lines of the barcode map file in the string 
+        *chunk*. Returns a tuple containing a list of the uppercase barcodes, 
+        a list of their uppercase variants, and the error message for the 
+        first invalid line (or ``None``). If there is an invalid line, only 
+        the lines before it are returned.
+
+        Comment lines (beginning with ``'#'``) and whitespace-only lines 
+        are skipped, and every other line must contain exactly two fields. 
+        Chunks that only contain whitespace and ``ACGTN`` characters are 
+        checked using the positions of the fields and newlines. Other chunks 
+        (with comments or errors) are checked using arrays of the characters 
+        in *chunk*, which is slower.
+        """
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        if len(buf) == 0:
+            return list(), list(), None
+
+        if len(chunk.translate(None, _map_chars)) == 0:
+            spaces = buf <= ord(" ")
+            field_starts = np.invert(spaces)
+            field_starts[1:] &= spaces[:-1]
+            field_lines = np.searchsorted(np.flatnonzero(buf == ord("\n")), 
+                                          np.flatnonzero(field_starts))
+            if len(field_lines) % 2 == 0 and \
+                    np.all(field_lines[0::2] == field_lines[1::2]) and \
+                    np.all(field_lines[2::2] != field_lines[1:-1:2]):
+                tokens = chunk.upper().split()
+                barcodes = tokens[0::2]
+                if "N" not in ''.join(barcodes):
+                    return barcodes, tokens[1::2], None
+
+        newlines = buf == ord("\n")
+        line_ids = np.cumsum(newlines) - newlines
+        nlines = int(line_ids[-1]) + 1
+        line_starts = np.zeros(nlines, dtype=np.intp)
+        line_starts[1:] = np.flatnonzero(newlines)[:nlines - 1] + 1
+        comments = buf[line_starts] == ord("#")
+
+        # number each field within its line
+        fields = np.invert(_space_chars[buf] | newlines)
+        field_starts = fields.copy()
+        field_starts[1:] &= np.invert(fields[:-1])
+        field_lines = line_ids[field_starts]
+        if len(field_lines) == 0: # only whitespace
+            return list(), list(), None
+        field_counts = np.bincount(field_lines, minlength=nlines)
+        field_numbers = np.arange(len(field_lines)) - \
+                (np.cumsum(field_counts) - field_counts)[field_lines]
+        byte_numbers = field_numbers[np.cumsum(field_starts) - 1]
+
+        # find the lines with invalid characters in each field
+        upper = _upper_chars[buf]
+        bad_barcode = fields & (byte_numbers == 0) & \
+                np.invert(_barcode_chars[upper])
+        bad_variant = fields & (byte_numbers == 1) & \
+                np.invert(_variant_chars[upper])
+        checked = np.invert(comments) & (field_counts != 0)
+        line_errors = [
+            (checked & (field_counts != 2), 
+             "Unexpected barcode-variant line format"),
+            (checked & (np.bincount(line_ids[bad_barcode], 
+                                    minlength=nlines) > 0),
+             "Barcode DNA sequence contains unexpected characters"),
+            (checked & (np.bincount(line_ids[bad_variant], 
+                                    minlength=nlines) > 0),
+             "Variant DNA sequence contains unexpected characters")]
+
+        error = None
+        error_line = nlines
+        for invalid, message in line_errors:
+            invalid = np.flatnonzero(invalid[:error_line])
+            if len(invalid) > 0:
+                error_line = invalid[0]
+                error = message
+        if error is not None:
+            keep = line_ids < error_line
+            buf = buf[keep]
+            line_ids = line_ids[keep]
+            upper = upper[keep]
+
+        upper = upper[np.invert(comments[line_ids])]
+        tokens = upper.tostring().split()
+        return tokens[0::2], tokens[1::2], error
+
+
+    def digest(self):
+        """
+        Return the SHA-1 digest of the (possibly compressed) barcode map file.
+        """
+        sha1 = hashlib.sha1()
+        with open(self.filename, "rb") as handle:
+            for block in iter(lambda: handle.read(1 << 20), ''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+
+    def _cache_key(self):
+        """
+        Return a tuple containing the cache format version and the absolute 
+        path, size, and modification time of the barcode map file.
+        """
+        return (_MAP_CACHE_VERSION, os.path.abspath(self.filename), 
+                os.path.getsize(self.filename), 
+                os.path.getmtime(self.filename))
+
+
+    def load_cache(self):
+        """
+        Load the barcode-variant pairs from the cache file. Returns ``True`` 
+        if the cache was loaded, or ``False`` if there is no usable cache 
+        for the current barcode map file.
+        """
+        if not os.path.isfile(self.cache_filename) or \
+                not os.path.isfile(self.filename):
+            return False
+        key = self._cache_key()
+        refresh = False
+        try:
+            with open(self.cache_filename, "rb") as handle:
+                cached_key, cached_digest = marshal.load(handle)
+                if cached_key != key:
+                    if cached_key[:3] != key[:3] or \
+                            cached_digest != self.digest():
+                        return False
+                    refresh = True # contents unchanged, update the key
+                self.update(marshal.load(handle))
+        except (EOFError, ValueError, TypeError):
+            logging.warning("Ignoring invalid barcode map cache '{fname}' [{name}]".format(fname=self.cache_filename, name=self.name))
+            self.clear()
+            return False
+        if refresh:
+            self.write_cache()
+        return True
+
+
+    def write_cache(self):
+        """
+        Save the barcode-variant pairs to the cache file. The file is written 
+        under a temporary name and renamed when it is complete. Failure to 
+        write the cache is not an error.
+        """
+        tmpname = None
+        try:
+            fd, tmpname = tempfile.mkstemp(prefix=".bcc_", 
+                    dir=os.path.dirname(os.path.abspath(self.cache_filename)))
+            with os.fdopen(fd, "wb") as handle:
+                marshal.dump((self._cache_key(), self.digest()), handle)
+                marshal.dump(dict(self), handle)
+            os.rename(tmpname, self.cache_filename)
+        except (IOError, OSError) as err:
+            logging.warning("Could not write barcode map cache '{fname}': {error} [{name}]".format(fname=self.cache_filename, error=err, name=self.name))
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+
+
+    def contains_many(self, barcodes):
+        """
+        Return a boolean array that is ``True`` for each barcode in the 
+        sequence *barcodes* that is in the map.
+        """
+        return np.fromiter((bc in self for bc in barcodes), dtype=bool, 
+                           count=len(barcodes))
+
+
+    def lookup_many(self, barcodes):
+        """
+        Return an object array containing the variant for each barcode in the 
+        sequence *barcodes*. All the barcodes must be in the map.
+        """
+        variants = np.empty(len(barcodes), dtype=object)
+        variants[:] = [self[bc] for bc in barcodes]
+        return variants
+
+
+    def key_index(self):
+        """
+        Return a dictionary containing a sorted array of packed keys (see 
+        :py:func:`~seqlib.packed.pack_matrix`) for the barcodes of each 
+        length. Barcodes longer than ``MAX_PACKED_LENGTH`` are not included. 
+        The index is built the first time it is needed.
+        """
+        if self._key_index is None:
+            barcodes = np.empty(len(self), dtype=object)
+            barcodes[:] = self.keys()
+            lengths = np.fromiter((len(bc) for bc in barcodes), dtype=np.intp, 
+                                  count=len(barcodes))
+            self._key_index = dict()
+            for length in np.unique(lengths):
+                length = int(length)
+                if length <= MAX_PACKED_LENGTH:
+                    keys, _ = pack_strings(barcodes[lengths == length], length)
+                    keys.sort()
+                    self._key_index[length] = keys
+        return self._key_index
+
+
+    def rescue_many(self, barcodes):
+        """
+        Return an object array containing the barcode in the map that is a 
+        single substitution away from each barcode in the sequence 
+        *barcodes*, or ``None`` if there is not exactly one such barcode. 
+        See :py:func:`rescue_barcodes`.
+        """
+        return rescue_barcodes(barcodes, self.key_index())
+
+
+
+def _align8(n):
+    """
+    Round *n* up to a multiple of 8.
+    """
+    return (n + 7) & ~7
+
+
+class PackedBarcodeMap(object):
+    """
+    Read-only alternative to :py:class:`BarcodeMap` that is stored in the 
+    packed map file *fname* (created by :py:func:`pack_barcode_map`) and 
+    memory-mapped instead of being loaded into a dictionary. Because the 
+    file is mapped read-only, all the 
+    :py:class:`~seqlib.barcodevariant.BarcodeVariantSeqLib` objects and 
+    worker processes using the same file share a single copy of the data.
+
+    Barcodes are packed into integer keys (see 
+    :py:func:`~seqlib.packed.pack_matrix`) and sorted separately for each 
+    barcode length. Each key has the index of its variant in a table 
+    containing each unique variant sequence once. Membership and lookup 
+    use binary searches on the keys, and are fastest when done for many 
+    barcodes at once with :py:meth:`contains_many` and 
+    :py:meth:`lookup_many`.
+
+    *mapfile* is the barcode map file the packed file was created from. 
+    The ``variants`` and ``bc_variant_strings`` dictionaries are the same 
+    as for a :py:class:`BarcodeMap`, and are not stored in the packed file.
+    """
+    _MAGIC = "BCM\x01"
+    # source size, source mtime, groups, barcodes, variants, variant bytes
+    _HEADER = struct.Struct('<QdQQQQ')
+
+    def __init__(self, fname, mapfile):
+        self.name = "barcodemap_{fname}".format(fname=os.path.basename(mapfile))
+        self.filename = mapfile
+        self.packed_filename = fname
+        self.variants = dict()
+        self.bc_variant_strings = dict()
+        self._open()
+
+
+    def _open(self):
+        """
+        Memory-map the packed map file and set up the arrays.
+        """
+        header_size = _align8(len(PackedBarcodeMap._MAGIC) + 
+                              PackedBarcodeMap._HEADER.size)
+        try:
+            raw = np.memmap(self.packed_filename, dtype=np.uint8, mode='r')
+        except (IOError, ValueError):
+            raise EnrichError("Could not open packed barcode map file '{fname}'".format(fname=self.packed_filename), self.name)
+        if len(raw) < header_size or \
+                raw[:len(PackedBarcodeMap._MAGIC)].tostring() != \
+                PackedBarcodeMap._MAGIC:
+            raise EnrichError("Invalid packed barcode map file '{fname}'".format(fname=self.packed_filename), self.name)
+        self.size, self.mtime, ngroups, nbarcodes, nvariants, nbytes = \
+                PackedBarcodeMap._HEADER.unpack(raw[len(PackedBarcodeMap._MAGIC):
+                        len(PackedBarcodeMap._MAGIC) + 
+                        PackedBarcodeMap._HEADER.size].tostring())
+
+        arrays = list()
+        offset = header_size
+        for dtype, count in ((np.uint64, 2 * ngroups), 
+                             (np.uint64, nbarcodes),
+                             (np.uint64, nvariants + 1),
+                             (np.int32, nbarcodes),
+                             (np.uint8, nbytes)):
+            size = count * np.dtype(dtype).itemsize
+            arrays.append(raw[offset:offset + size].view(dtype))
+            offset = _align8(offset + size)
+        groups, self.packed_keys, self.variant_offsets, self.variant_ids, \
+                self.variant_data = arrays
+
+        # (length, start, stop) of the keys for each barcode length
+        self.groups = list()
+        start = 0
+        for length, count in groups.reshape(ngroups, 2):
+            self.groups.append((int(length), start, start + int(count)))
+            start += int(count)
+
+
+    def __getstate__(self):
+        """
+        Pickle the map without the memory-mapped arrays, which are mapped 
+        again when the object is unpickled.
+        """
+        state = self.__dict__.copy()
+        for key in ('packed_keys', 'variant_offsets', 'variant_ids', 
+                    'variant_data'):
+            del state[key]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+    def is_current(self):
+        """
+        Return ``True`` if the size and modification time of the barcode map 
+        file match the values stored in the packed file.
+        """
+        return os.path.getsize(self.filename) == self.size and \
+                os.path.getmtime(self.filename) == self.mtime
+
+
+    def __len__(self):
+        return len(self.packed_keys)
+
+
+    def __iter__(self):
+        for length, start, stop in self.groups:
+            for barcode in unpack_keys(self.packed_keys[start:stop], length):
+                yield str(barcode)
+
+
+    def iterkeys(self):
+        """
+        Return an iterator over the barcodes, as for a 
+        :py:class:`BarcodeMap`.
+        """
+        return iter(self)
+
+
+    def keys(self):
+        """
+        Return a list of the barcodes, as for a :py:class:`BarcodeMap`.
+        """
+        return list(self)
+
+
+    def __contains__(self, barcode):
+        return self._find([barcode])[0] >= 0
+
+
+    def __getitem__(self, barcode):
+        position = self._find([barcode])[0]
+        if position < 0:
+            raise KeyError(barcode)
+        return self.variant(self.variant_ids[position])
+
+
+    def get(self, barcode, default=None):
+        try:
+            return self[barcode]
+        except KeyError:
+            return default
+
+
+    def variant(self, i):
+        """
+        Return the variant sequence with index *i* in the variant table.
+        """
+        return self.variant_data[self.variant_offsets[i]:
+                                 self.variant_offsets[i + 1]].tostring()
+
+
+    def _find(self, barcodes):
+        """
+        Return an array containing the position of each barcode in the 
+        sequence *barcodes* in the packed keys, or -1 for barcodes that 
+        are not in the map.
+        """
+        barcodes = np.asarray(barcodes, dtype=object)
+        positions = np.empty(len(barcodes), dtype=np.int64)
+        positions.fill(-1)
+        lengths = np.fromiter((len(bc) for bc in barcodes), dtype=np.intp, 
+                              count=len(barcodes))
+        for length, start, stop in self.groups:
+            rows = np.flatnonzero(lengths == length)
+            if len(rows) == 0:
+                continue
+            keys, valid = pack_strings(barcodes[rows], length)
+            group_keys = self.packed_keys[start:stop]
+            found = np.minimum(np.searchsorted(group_keys, keys), 
+                               len(group_keys) - 1)
+            hits = valid & (group_keys[found] == keys)
+            positions[rows[hits]] = start + found[hits]
+        return positions
+
+
+    def contains_many(self, barcodes):
+        """
+        Return a boolean array that is ``True`` for each barcode in the 
+        sequence *barcodes* that is in the map.
+        """
+        return self._find(barcodes) >= 0
+
+
+    def lookup_many(self, barcodes):
+        """
+        Return an object array containing the variant for each barcode in the 
+        sequence *barcodes*. All the barcodes must be in the map. Each 
+        unique variant is only decoded once.
+        """
+        positions = self._find(barcodes)
+        missing = np.flatnonzero(positions < 0)
+        if len(missing) > 0:
+            raise KeyError(barcodes[missing[0]])
+        variant_ids, inverse = np.unique(self.variant_ids[positions], 
+                                         return_inverse=True)
+        variants = np.empty(len(variant_ids), dtype=object)
+        variants[:] = [self.variant(i) for i in variant_ids]
+        return variants[inverse]
+
+
+    def key_index(self):
+        """
+        Return a dictionary containing the sorted array of packed keys for the 
+        barcodes of each length. The arrays are part of the memory-mapped 
+        file.
+        """
+        return dict((length, self.packed_keys[start:stop]) 
+                    for length, start, stop in self.groups)
+
+
+    def rescue_many(self, barcodes):
+        """
+        Return an object array containing the barcode in the map that is a 
+        single substitution away from each barcode in the sequence 
+        *barcodes*, or ``None`` if there is not exactly one such barcode. 
+        See :py:func:`rescue_barcodes`.
+        """
+        return rescue_barcodes(barcodes, self.key_index())
+
+
+
+def rescue_barcodes(barcodes, key_index):
+    """
+    Return an object array containing the mapped barcode that is a single 
+    substitution away from each barcode in the sequence *barcodes*, or 
+    ``None`` if there is not exactly one. *key_index* is a dictionary 
+    containing a sorted array of packed keys for the mapped barcodes of 
+    each length, as returned by :py:meth:`BarcodeMap.key_index`.
+
+    Instead of comparing each barcode to all the mapped barcodes, the 
+    possible substitutions of each barcode are looked up in the sorted keys 
+    using binary searches, which takes O(*L* log *n*) time for barcodes of 
+    length *L* and *n* mapped barcodes (see 
+    :py:func:`~seqlib.packed.find_unique_neighbours`). Barcodes that can't 
+    be packed are never rescued.
+    """
+    barcodes = np.asarray(barcodes, dtype=object)
+    targets = np.empty(len(barcodes), dtype=object)
+    lengths = np.fromiter((len(bc) for bc in barcodes), dtype=np.intp, 
+                          count=len(barcodes))
+    for length, sorted_keys in key_index.iteritems():
+        rows = np.flatnonzero(lengths == length)
+        if len(rows) == 0:
+            continue
+        keys, valid = pack_strings(barcodes[rows], length)
+        rows = rows[valid]
+        positions = find_unique_neighbours(keys[valid], length, sorted_keys)
+        found = positions >= 0
+        targets[rows[found]] = unpack_keys(sorted_keys[positions[found]], 
+                                           length).astype(object)
+    return targets
+
+
+
+def pack_barcode_map(barcode_map, fname):
+    """
+    Save the :py:class:`BarcodeMap` *barcode_map* as the packed map file 
+    *fname* that can be opened as a :py:class:`PackedBarcodeMap`. Barcodes 
+    can contain at most ``MAX_PACKED_LENGTH`` bases.
+
+    The file is written under a temporary name and renamed when it is 
+    complete, so other processes never see a partial file.
+    """
+    barcodes = np.empty(len(barcode_map), dtype=object)
+    values = np.empty(len(barcode_map), dtype=object)
+    barcodes[:] = barcode_map.keys()
+    values[:] = barcode_map.values()
+    variant_ids, variants = pd.factorize(values)
+    lengths = np.fromiter((len(bc) for bc in barcodes), dtype=np.intp, 
+                          count=len(barcodes))
+
+    groups = list()
+    key_list = list()
+    id_list = list()
+    for length in np.unique(lengths):
+        length = int(length)
+        if length > MAX_PACKED_LENGTH:
+            raise EnrichError("Cannot pack barcodes longer than {n} bases".format(n=MAX_PACKED_LENGTH), barcode_map.name)
+        rows = np.flatnonzero(lengths == length)
+        keys, _ = pack_strings(barcodes[rows], length)
+        order = np.argsort(keys, kind="mergesort")
+        groups.extend((length, len(rows)))
+        key_list.append(keys[order])
+        id_list.append(variant_ids[rows[order]].astype(np.int32))
+
+    variant_offsets = np.zeros(len(variants) + 1, dtype=np.uint64)
+    variant_offsets[1:] = np.cumsum([len(v) for v in variants])
+    variant_data = ''.join(variants)
+
+    arrays = [np.array(groups, dtype=np.uint64),
+              np.concatenate(key_list) if len(key_list) > 0 else 
+                    np.zeros(0, dtype=np.uint64),
+              variant_offsets,
+              np.concatenate(id_list) if len(id_list) > 0 else 
+                    np.zeros(0, dtype=np.int32),
+              np.frombuffer(variant_data, dtype=np.uint8)]
+
+    directory = os.path.dirname(os.path.abspath(fname))
+    fd, tmpname = tempfile.mkstemp(prefix=".bcm_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            header = PackedBarcodeMap._MAGIC + PackedBarcodeMap._HEADER.pack(
+                    os.path.getsize(barcode_map.filename), 
+                    os.path.getmtime(barcode_map.filename), len(groups) // 2, 
+                    len(barcode_map), len(variants), len(variant_data))
+            handle.write(header)
+            offset = len(header)
+            for a in arrays:
+                handle.write("\0" * (_align8(offset) - offset))
+                offset = _align8(offset)
+                handle.write(a.tostring())
+                offset += a.nbytes
+        os.rename(tmpname, fname)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+
+def load_barcode_map(mapfile, packed=False, cache=False):
+    """
+    Return the barcode map for the barcode map file *mapfile*. If *packed* 
+    is ``False``, this is a :py:class:`BarcodeMap`. Otherwise, it is a 
+    :py:class:`PackedBarcodeMap` using the packed file next to *mapfile* 
+    with ``PACKED_MAP_EXTENSION`` added, which is created from a 
+    :py:class:`BarcodeMap` if it does not exist or is out of date. *cache* 
+    is passed to :py:class:`BarcodeMap`.
+    """
+    if not packed:
+        return BarcodeMap(mapfile, cache)
+    fname = mapfile + PACKED_MAP_EXTENSION
+    if os.path.exists(fname):
+        barcode_map = PackedBarcodeMap(fname, mapfile)
+        if barcode_map.is_current():
+            return barcode_map
+        logging.info("Packed barcode map '{fname}' is out of date".format(fname=fname))
+        del barcode_map
+    barcode_map = BarcodeMap(mapfile, cache)
+    logging.info("Writing packed barcode map '{fname}'".format(fname=fname))
+    try:
+        pack_barcode_map(barcode_map, fname)
+    except (IOError, OSError) as err:
+        raise EnrichError("Could not write packed barcode map file '{fname}': {error}".format(fname=fname, error=err), barcode_map.name)
+    del barcode_map
+    return PackedBarcodeMap(fname, mapfile)
+
 
 class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
     """
@@ -85,7 +727,8 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
     :download:`Download this JSON file <config_examples/barcodevariant.json>`
 
     The ``barcode_map`` keyword argument can be used to pass an existing 
-    :py:class:`~seqlib.barcodevariant.BarcodeMap`, but only if the 
+    :py:class:`~seqlib.barcodevariant.BarcodeMap` (or 
+    :py:class:`~seqlib.barcodevariant.PackedBarcodeMap`), but only if the 
     ``"map file"`` entry is absent from *config*.
     """
     def __init__(self, config, barcode_map=None):
@@ -93,10 +736,16 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
         BarcodeSeqLib.__init__(self, config, barcodevariant=True)
         try:
             if 'map file' in config['barcodes']:
-                self.barcode_map = BarcodeMap(config['barcodes']['map file'])
+                self.barcode_map = load_barcode_map(
+                        config['barcodes']['map file'],
+                        config['barcodes'].get('packed map', False),
+                        config['barcodes'].get('map cache', False))
             else:
                 self.barcode_map = None
 
+            self.rescue_mismatches = config['barcodes'].get(
+                    'rescue mismatches', False)
+
             self.set_filters(config['filters'], {'min quality' : 0,
                                       'avg quality' : 0,
                                       'chastity' : False,
@@ -115,6 +764,77 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
         self.filter_unmapped = True
 
 
+    def reset_counts(self):
+        """
+        Remove the barcode counts (see 
+        :py:meth:`BarcodeSeqLib.reset_counts 
+        <seqlib.barcode.BarcodeSeqLib.reset_counts>`). Reads are always 
+        counted by barcode, so the ``'collapse reads'`` option is ignored.
+        """
+        BarcodeSeqLib.reset_counts(self)
+        if self.rescue_mismatches and self.sketch is not None:
+            # build before worker processes are forked
+            self.barcode_map.key_index()
+
+
+    def shard_counts(self):
+        return BarcodeSeqLib.shard_counts(self)
+
+
+    def merge_counts(self, counts):
+        BarcodeSeqLib.merge_counts(self, counts)
+
+
+    def keep_rare_barcodes(self, batch, mask):
+        """
+        If the ``"rescue mismatches"`` option is set, keep the barcodes 
+        selected by *mask* that are in the map or a single substitution away 
+        from a mapped barcode in the second pass of sketch mode, so that 
+        :py:meth:`correct_barcodes` has the same counts as without the 
+        sketch. See :py:meth:`BarcodeSeqLib.keep_rare_barcodes 
+        <seqlib.barcode.BarcodeSeqLib.keep_rare_barcodes>`.
+        """
+        if not self.rescue_mismatches:
+            return BarcodeSeqLib.keep_rare_barcodes(self, batch, mask)
+        barcodes = np.asarray(batch.sequences(mask), dtype=object)
+        keep = self.barcode_map.contains_many(barcodes)
+        unmapped = np.flatnonzero(np.invert(keep))
+        targets = self.barcode_map.rescue_many(barcodes[unmapped])
+        keep[unmapped] = np.fromiter((t is not None for t in targets), 
+                                     dtype=bool, count=len(targets))
+        return keep
+
+
+    def correct_barcodes(self):
+        """
+        If the ``"rescue mismatches"`` option is set, add the counts for 
+        unmapped barcodes to the mapped barcode a single substitution away 
+        (see :py:meth:`BarcodeMap.rescue_many`). Barcodes with more than one 
+        mapped neighbour are left unmapped. This is done before the 
+        ``"min count"`` filter is applied.
+        """
+        if not self.rescue_mismatches:
+            return
+        barcodes = np.asarray(self.df_dict['barcodes'].index, dtype=object)
+        unmapped = np.flatnonzero(np.invert(
+                self.barcode_map.contains_many(barcodes)))
+        targets = self.barcode_map.rescue_many(barcodes[unmapped])
+        rescued = np.fromiter((t is not None for t in targets), dtype=bool, 
+                              count=len(targets))
+        if not np.any(rescued):
+            return
+        rows = unmapped[rescued]
+        counts = self.df_dict['barcodes']['count']
+        rescued_counts = pd.Series(counts.values[rows], 
+                                   index=targets[rescued]).groupby(level=0).sum()
+        logging.info("Rescued {n} unmapped barcodes ({u} unique) [{name}]".format(
+                n=rescued_counts.sum(), u=len(rows), name=self.name))
+        counts = counts.drop(barcodes[rows]).add(rescued_counts, fill_value=0)
+        self.df_dict['barcodes'] = pd.DataFrame({'count' : counts}, 
+                                                dtype="int32")
+        self.df_dict['barcodes'].sort('count', ascending=False, inplace=True)
+
+
     def calculate(self):
         """
         Counts the barcodes using :py:meth:`BarcodeSeqLib.count` and combines them into 
@@ -125,30 +845,52 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
 
         logging.info("Converting barcodes to variants [{name}]".format(name=self.name))
         if self.filter_unmapped:
-            map_mask = self.df_dict['barcodes'].index.isin(self.barcode_map)
-            self.df_dict['barcodes_unmapped'] = self.df_dict['barcodes'][-map_mask]
+            map_mask = self.barcode_map.contains_many(self.df_dict['barcodes'].index)
+            self.df_dict['barcodes_unmapped'] = self.df_dict['barcodes'][np.invert(map_mask)]
             self.df_dict['barcodes'] = self.df_dict['barcodes'][map_mask]
             del map_mask
             logging.info("Writing counts for {n} unique unmapped barcodes to disk [{name}]".format(n=len(self.df_dict['barcodes_unmapped']), name=self.name))
             self.dump_data(keys=['barcodes_unmapped']) # save memory
 
-        # count variants associated with the barcodes
-        for bc, count in self.df_dict['barcodes'].iterrows():
-            count = count['count']
-            variant = self.barcode_map[bc]
+        # count variants associated with the barcodes, calling each unique 
+        # variant sequence once using the total count of its barcodes
+        barcodes = np.asarray(self.df_dict['barcodes'].index, dtype=object)
+        bc_counts = self.df_dict['barcodes']['count'].values.astype(np.int64)
+        variant_ids, variant_dna = \
+                pd.factorize(self.barcode_map.lookup_many(barcodes))
+        variant_counts = np.bincount(variant_ids, weights=bc_counts, 
+                                     minlength=len(variant_dna))
+        variant_strings = np.empty(len(variant_dna), dtype=object)
+        variant_filtered = np.zeros(len(variant_dna), dtype=bool)
+        for i, variant in enumerate(variant_dna):
+            count = int(variant_counts[i])
             mutations = self.count_variant(variant, copies=count)
             if mutations is None: # variant has too many mutations
                 self.filter_stats['max mutations'] += count
                 self.filter_stats['total'] += count
                 if self.report_filtered:
                     self.report_filtered_variant(variant, count)
-                if bc not in self.barcode_map.bc_variant_strings:
-                    self.barcode_map.bc_variant_strings[bc] = FILTERED_VARIANT
+                variant_filtered[i] = True
             else:
+                variant_strings[i] = self.variant_label(mutations)
+
+        # update the barcode map in bulk
+        bc_variant_strings = self.barcode_map.bc_variant_strings
+        bc_strings = variant_strings[variant_ids]
+        filtered = variant_filtered[variant_ids]
+        for bc in barcodes[filtered]:
+            if bc not in bc_variant_strings:
+                bc_variant_strings[bc] = FILTERED_VARIANT
+        retained = np.flatnonzero(np.invert(filtered))
+        bc_variant_strings.update(zip(barcodes[retained], bc_strings[retained]))
+        retained = retained[np.argsort(variant_ids[retained], kind="mergesort")]
+        boundaries = np.flatnonzero(np.diff(variant_ids[retained])) + 1
+        for group in np.split(retained, boundaries):
+            if len(group) > 0:
+                mutations = bc_strings[group[0]]
                 if mutations not in self.barcode_map.variants:
                     self.barcode_map.variants[mutations] = set()
-                self.barcode_map.variants[mutations].update([bc])
-                self.barcode_map.bc_variant_strings[bc] = mutations
+                self.barcode_map.variants[mutations].update(barcodes[group])
 
 
         self.df_dict['variants'] = \
@@ -166,13 +908,3 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
             self.aligner_cache = None
         self.report_filter_stats()
 
-
-    def report_filtered_variant(self, variant, count):
-        """
-        Outputs a summary of the filtered variant to *handle*. Internal filter 
-        names are converted to messages using the ``DataContainer._filter_messages`` 
-        dictionary. Related to :py:meth:`SeqLib.report_filtered`.
-        """
-        logging.debug("Filtered variant (quantity={n}) ({messages}) [{name}]\n{read!s}".format(
-                    n=count, messages=DataContainer._filter_messages['max mutations'], name=self.name, read=variant), file=handle)
-
@@ -1,7 +1,7 @@
 from variant import VariantSeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq, check_fastq
-import pandas as pd
+from fqread import read_fastq_batches, check_fastq
+import numpy as np
 import logging
 
 
@@ -38,54 +38,54 @@ class BasicSeqLib(VariantSeqLib):
             raise EnrichError("FASTQ file error: {error}".format(error=fqerr), self.name)
 
 
-    def calculate(self):
+    def count_records(self, start=None, stop=None, indexes=None):
         """
-        Reads the forward or reverse FASTQ file (reverse reads are reverse-complemented),
-        performs quality-based filtering, and counts the variants.
+        Reads the forward or reverse FASTQ file (reverse reads are 
+        reverse-complemented), performs quality-based filtering, and counts 
+        the variants. See :py:meth:`SeqLib.count_records 
+        <seqlib.seqlib.SeqLib.count_records>`.
         """
-        self.df_dict['variants'] = dict()
-
-        filter_flags = dict()
-        for key in self.filters:
-            filter_flags[key] = False
-
-        logging.info("Counting variants [{name}]".format(name=self.name))
-        for fq in read_fastq(self.reads):
+        index = indexes[0] if indexes is not None else None
+        for batch in read_fastq_batches(self.reads, threads=self.threads, 
+                                        start=start, stop=stop, index=index):
             if self.revcomp_reads:
-                fq.revcomp()
+                batch.revcomp()
 
+            # filter the reads based on specified quality settings
+            filter_flags = self.filter_batch(batch)
+            passed = np.ones(len(batch), dtype=bool)
             for key in filter_flags:
-                filter_flags[key] = False
+                passed &= np.invert(filter_flags[key])
 
-            # filter the read based on specified quality settings
-            if self.filters['chastity']:
-                if not fq.is_chaste():
-                    self.filter_stats['chastity'] += 1
-                    filter_flags['chastity'] = True
-            if self.filters['min quality'] > 0:
-                if fq.min_quality() < self.filters['min quality']:
-                    self.filter_stats['min quality'] += 1
-                    filter_flags['min quality'] = True
-            if self.filters['avg quality'] > 0:
-                if fq.mean_quality() < self.filters['avg quality']:
-                    self.filter_stats['avg quality'] += 1
-                    filter_flags['avg quality'] = True
-            if not any(filter_flags.values()): # passed quality filtering
-                mutations = self.count_variant(fq.sequence)
+            for i, sequence in zip(np.flatnonzero(passed), 
+                                   batch.sequences(passed)):
+                mutations = self.count_sequence(sequence)
                 if mutations is None: # read has too many mutations
                     self.filter_stats['max mutations'] += 1
-                    filter_flags['max mutations'] = True
-            if any(filter_flags.values()):
-                self.filter_stats['total'] += 1
-                if self.report_filtered:
-                    self.report_filtered_read(fq, filter_flags)
+                    filter_flags['max mutations'][i] = True
+            self.report_filtered_batch(batch, filter_flags)
+            self.check_budget()
+
+
+    def calculate(self):
+        """
+        Reads the forward or reverse FASTQ file (reverse reads are reverse-complemented),
+        performs quality-based filtering, and counts the variants.
+        """
+        self.reset_counts()
+
+        logging.info("Counting variants [{name}]".format(name=self.name))
+        if self.processes > 1:
+            self.count_sharded([self.reads])
+        else:
+            self.count_records()
+        if self.collapse_reads:
+            self.count_collapsed()
 
         self.df_dict['variants'] = \
-                pd.DataFrame.from_dict(self.df_dict['variants'], 
-                                       orient="index", dtype="int32")
+                self.counts_dataframe(self.df_dict['variants'])
         if len(self.df_dict['variants']) == 0:
             raise EnrichError("Failed to count variants", self.name)
-        self.df_dict['variants'].columns = ['count']
         self.df_dict['variants'].sort('count', ascending=False, inplace=True)
 
         logging.info("Counted {n} variants ({u} unique) [{name}]".format(
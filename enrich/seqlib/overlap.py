@@ -3,7 +3,6 @@ from sys import stderr
 from variant import VariantSeqLib
 from enrich_error import EnrichError
 from fqread import read_fastq_multi, check_fastq, FQRead
-import pandas as pd
 import logging
 
 
@@ -133,19 +132,21 @@ class OverlapSeqLib(VariantSeqLib):
         return merge
 
 
-    def calculate(self):
+    def count_records(self, start=None, stop=None, indexes=None):
         """
         Reads the forward and reverse reads, merges them, performs 
-        quality-based filtering, and counts the variants.
+        quality-based filtering, and counts the variants. See 
+        :py:meth:`SeqLib.count_records <seqlib.seqlib.SeqLib.count_records>`.
         """
-        self.df_dict['variants'] = dict()
-
         filter_flags = dict()
         for key in self.filters:
             filter_flags[key] = False
 
-        logging.info("Counting variants [{name}]".format(name=self.name))
-        for fwd, rev in read_fastq_multi([self.forward, self.reverse]):
+        for fwd, rev in read_fastq_multi([self.forward, self.reverse], 
+                                         threads=self.threads, prefetch=True,
+                                         start=start, stop=stop, 
+                                         indexes=indexes):
+            self.check_budget()
             for key in filter_flags:
                 filter_flags[key] = False
 
@@ -185,7 +186,7 @@ class OverlapSeqLib(VariantSeqLib):
                         self.filter_stats['avg quality'] += 1
                         filter_flags['avg quality'] = True
                 if not any(filter_flags.values()): # passed quality filtering
-                    mutations = self.count_variant(merge.sequence)
+                    mutations = self.count_sequence(merge.sequence)
                     if mutations is None: # merge read has too many mutations
                         self.filter_stats['max mutations'] += 1
                         filter_flags['max mutations'] = True
@@ -194,12 +195,26 @@ class OverlapSeqLib(VariantSeqLib):
                     if self.report_filtered:
                         self.report_filtered_read(merge, filter_flags)
 
+
+    def calculate(self):
+        """
+        Reads the forward and reverse reads, merges them, performs 
+        quality-based filtering, and counts the variants.
+        """
+        self.reset_counts()
+
+        logging.info("Counting variants [{name}]".format(name=self.name))
+        if self.processes > 1:
+            self.count_sharded([self.forward, self.reverse])
+        else:
+            self.count_records()
+        if self.collapse_reads:
+            self.count_collapsed()
+
         self.df_dict['variants'] = \
-                pd.DataFrame.from_dict(self.df_dict['variants'], 
-                                       orient="index", dtype="int32")
+                self.counts_dataframe(self.df_dict['variants'])
         if len(self.df_dict['variants']) == 0:
             raise EnrichError("Failed to count variants", self.name)
-        self.df_dict['variants'].columns = ['count']
         self.df_dict['variants'].sort('count', ascending=False, inplace=True)
 
         logging.info("Counted {n} variants ({u} unique) [{name}]".format(
@@ -0,0 +1,527 @@
+from __future__ import print_function
+import os
+import os.path
+import numpy as np
+from spill import SpillCounter, SPILL_PARTITIONS, make_run_directory, \
+        remove_run_directory
+
+
+# longest sequence that can be packed into a single uint64
+MAX_PACKED_LENGTH = 32
+
+
+# number of pending keys that are always allowed before merging
+MIN_PENDING_SIZE = 1000000
+
+
+# number of keys whose neighbours are searched for at a time
+NEIGHBOUR_BLOCK_SIZE = 100000
+
+
+# default number of counters in each row of a CountMinSketch
+SKETCH_WIDTH = 1 << 22
+
+
+# default number of rows (hash functions) in a CountMinSketch
+SKETCH_DEPTH = 4
+
+
+# mixed into the hash keys so that packed sequences of different lengths
+# don't share keys
+_LENGTH_SALT = 0x9E3779B97F4A7C15
+
+
+_UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+# 2-bit codes for each byte value, upper and lower case bases share a code
+# and all other characters are marked as invalid with 4
+_base_codes = np.empty(256, dtype=np.uint8)
+_base_codes.fill(4)
+for _code, _bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for _b in _bases:
+        _base_codes[ord(_b)] = _code
+del _code, _bases, _b
+
+
+# byte values for each 2-bit code
+_code_bases = np.frombuffer("ACGT", dtype=np.uint8)
+
+
+def pack_matrix(matrix, length):
+    """
+    Pack the first *length* bases of each row of the ``uint8`` array
+    *matrix* into a ``uint64`` array, using two bits per base. *length* must
+    not be greater than ``MAX_PACKED_LENGTH``. Lowercase bases are packed
+    as uppercase.
+
+    Returns a tuple containing the array of packed keys and a boolean array
+    that is ``False`` for each row containing a character other than
+    ``ACGT``. Keys for these rows are not meaningful.
+    """
+    if length > MAX_PACKED_LENGTH:
+        raise ValueError("cannot pack sequences longer than {n} bases".format(n=MAX_PACKED_LENGTH))
+    codes = _base_codes[matrix[:, :length]]
+    valid = np.all(codes < 4, axis=1)
+    keys = np.zeros(len(matrix), dtype=np.uint64)
+    for j in xrange(length):
+        keys <<= np.uint64(2)
+        keys |= codes[:, j]
+    return keys, valid
+
+
+def pack_strings(sequences, length):
+    """
+    Pack the list of DNA strings *sequences*, which must all contain
+    *length* bases. Returns the same tuple as :py:func:`pack_matrix`.
+    """
+    matrix = np.frombuffer(''.join(sequences), dtype=np.uint8)
+    return pack_matrix(matrix.reshape(len(sequences), length), length)
+
+
+def unpack_keys(keys, length):
+    """
+    Decode the ``uint64`` array of packed *keys* (see
+    :py:func:`pack_matrix`) into a NumPy array of uppercase DNA strings
+    containing *length* bases.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+    codes = (keys[:, np.newaxis] >> shifts) & np.uint64(3)
+    matrix = _code_bases[codes.astype(np.intp)]
+    return np.ascontiguousarray(matrix).view("S{n}".format(n=length)).ravel()
+
+
+def substitution_masks(length):
+    """
+    Return a ``uint64`` array of masks that change one base of a packed key 
+    for a sequence of *length* bases into a different base when combined 
+    with the key using exclusive or. There are three masks for each 
+    position.
+    """
+    shifts = np.uint64(2) * np.arange(length, dtype=np.uint64)
+    return (np.arange(1, 4, dtype=np.uint64)[:, np.newaxis] << shifts).ravel()
+
+
+def find_unique_neighbours(keys, length, sorted_keys):
+    """
+    For each packed key in *keys* (sequences of *length* bases), search the 
+    sorted ``uint64`` array *sorted_keys* for keys that differ from it by a 
+    single substitution. Returns an array containing the position in 
+    *sorted_keys* of the neighbouring key, or -1 if there is no neighbour or 
+    more than one.
+
+    Each of the 3 x *length* possible neighbours of a key is looked up with 
+    a binary search, so each key takes O(*length* x log *n*) time for *n* 
+    keys in *sorted_keys*. This is used instead of a hash index of the 
+    neighbours of every key in *sorted_keys*, which would give constant-time 
+    lookups but use 3 x *length* times as much memory as the keys.
+    """
+    positions = np.empty(len(keys), dtype=np.int64)
+    positions.fill(-1)
+    if len(sorted_keys) == 0:
+        return positions
+    masks = substitution_masks(length)
+    for start in xrange(0, len(keys), NEIGHBOUR_BLOCK_SIZE):
+        neighbours = keys[start:start + NEIGHBOUR_BLOCK_SIZE, np.newaxis] ^ \
+                masks
+        found = np.minimum(np.searchsorted(sorted_keys, neighbours), 
+                           len(sorted_keys) - 1)
+        hits = sorted_keys[found] == neighbours
+        unique = np.flatnonzero(hits.sum(axis=1) == 1)
+        positions[start + unique] = found[unique][hits[unique]]
+    return positions
+
+
+
+class PackedCounter(object):
+    """
+    Counts DNA sequences using packed integer keys instead of a dictionary
+    of strings. Sequences of up to ``MAX_PACKED_LENGTH`` bases containing
+    only ``ACGT`` are packed with :py:func:`pack_matrix` and stored
+    separately for each sequence length. Counts are accumulated by sorting
+    the keys and combining duplicates, which is done whenever the number of
+    keys waiting to be merged exceeds the number of unique keys already
+    counted (or ``MIN_PENDING_SIZE``). Other sequences are counted in a
+    dictionary.
+
+    Sequences are counted as uppercase and are only decoded back to strings
+    by :py:meth:`iter_partitions` and :py:meth:`results`.
+
+    The dictionary of sequences that can't be packed is a 
+    :py:class:`~seqlib.spill.SpillCounter` with the given *budget* and 
+    *directory*. Packed keys use 16 bytes per unique sequence. When 
+    :py:meth:`check_budget` finds more than *budget* unique packed keys, 
+    they are divided among *partitions* run files by their hash in the same 
+    way as a :py:class:`~seqlib.spill.SpillCounter`, and combined one 
+    partition at a time by :py:meth:`iter_partitions`.
+    """
+    def __init__(self, budget=None, directory=None, 
+                 partitions=SPILL_PARTITIONS):
+        self.unique = dict()   # sorted unique keys for each length
+        self.counts = dict()   # counts for each unique key
+        self.pending = dict()  # lists of key arrays waiting to be merged
+        self.pending_size = 0
+        self.other = SpillCounter(budget, directory, partitions) # unpackable sequences
+        self.budget = budget
+        self.directory = directory
+        self.partitions = partitions
+        self.run_directory = None
+        self.runs = [0] * partitions # number of runs in each run file
+        self.spills = 0
+
+
+    def add_matrix(self, matrix, lengths, mask=None):
+        """
+        Count the sequences in the ``uint8`` array *matrix* (one sequence per
+        row), where *lengths* is an array containing the length of each
+        sequence. If the boolean array *mask* is given, only rows where it
+        is ``True`` are counted.
+        """
+        if mask is not None:
+            matrix = matrix[mask]
+            lengths = lengths[mask]
+        if len(lengths) == 0:
+            return
+        unique_lengths = np.unique(lengths)
+        for length in unique_lengths:
+            length = int(length)
+            if len(unique_lengths) == 1:
+                rows = matrix
+            else:
+                rows = matrix[lengths == length]
+            if length == 0:
+                self.add_string('', len(rows))
+                continue
+            elif length > MAX_PACKED_LENGTH:
+                for row in rows:
+                    self.add_string(row[:length].tostring())
+                continue
+            keys, valid = pack_matrix(rows, length)
+            if not np.all(valid):
+                for row in rows[np.invert(valid)]:
+                    self.add_string(row[:length].tostring())
+                keys = keys[valid]
+            self.pending.setdefault(length, list()).append(keys)
+            self.pending_size += len(keys)
+        if self.pending_size >= max(MIN_PENDING_SIZE, self.unique_size()):
+            self._merge()
+            self.check_budget()
+        self.other.check_budget()
+
+
+    def add_string(self, sequence, count=1):
+        """
+        Count *count* copies of *sequence* in the dictionary of sequences
+        that can't be packed.
+        """
+        sequence = sequence.upper()
+        try:
+            self.other[sequence] += count
+        except KeyError:
+            self.other[sequence] = count
+
+
+    def unique_size(self):
+        """
+        Return the number of unique packed keys that have been merged.
+        """
+        return sum(len(k) for k in self.unique.itervalues())
+
+
+    def _combine(self, length, keys, counts):
+        """
+        Add the sorted unique *keys* of the given *length* and their 
+        *counts* to the merged keys and counts.
+        """
+        if length in self.unique:
+            keys = np.concatenate([self.unique[length], keys])
+            counts = np.concatenate([self.counts[length], counts])
+            order = np.argsort(keys, kind="mergesort")
+            keys = keys[order]
+            counts = counts[order]
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            starts = np.flatnonzero(first)
+            keys = keys[starts]
+            counts = np.add.reduceat(counts, starts)
+        self.unique[length] = keys
+        self.counts[length] = counts
+
+
+    def _merge(self):
+        """
+        Combine the pending keys with the merged keys and counts.
+        """
+        for length, key_list in self.pending.iteritems():
+            keys, counts = np.unique(np.concatenate(key_list),
+                                     return_counts=True)
+            self._combine(length, keys, counts.astype(np.int64))
+        self.pending = dict()
+        self.pending_size = 0
+
+
+    def check_budget(self):
+        """
+        Call :py:meth:`spill` if the number of unique packed keys in memory 
+        exceeds the budget.
+        """
+        if self.budget is not None and self.unique_size() > self.budget:
+            self.spill()
+
+
+    def is_spilled(self):
+        """
+        Returns ``True`` if any packed keys have been written to disk.
+        """
+        return self.run_directory is not None
+
+
+    def _run_file(self, i):
+        """
+        Return the name of the run file for partition *i*.
+        """
+        return os.path.join(self.run_directory, "run{i}".format(i=i))
+
+
+    def spill(self):
+        """
+        Append the packed keys and counts in memory to the run files and 
+        remove them from memory. Each run contains the length, keys, and 
+        counts for one sequence length.
+        """
+        self._merge()
+        if self.run_directory is None:
+            self.run_directory = make_run_directory(self.directory)
+        for length, keys in self.unique.iteritems():
+            counts = self.counts[length]
+            parts = ((keys * np.uint64(_LENGTH_SALT)) >> np.uint64(32)) % \
+                    np.uint64(self.partitions)
+            order = np.argsort(parts, kind="mergesort") # keys stay sorted
+            parts = parts[order]
+            bounds = np.searchsorted(parts, 
+                    np.arange(self.partitions + 1, dtype=np.uint64))
+            for i in xrange(self.partitions):
+                rows = order[bounds[i]:bounds[i + 1]]
+                if len(rows) == 0:
+                    continue
+                with open(self._run_file(i), "ab") as handle:
+                    np.save(handle, np.array([length], dtype=np.int64))
+                    np.save(handle, keys[rows])
+                    np.save(handle, counts[rows])
+                self.runs[i] += 1
+        self.unique = dict()
+        self.counts = dict()
+        self.spills += 1
+
+
+    def _iter_key_partitions(self):
+        """
+        Generator function that yields a tuple containing dictionaries of 
+        the sorted unique keys and their counts for each length, for each 
+        partition. If the keys were never written to disk, the merged keys 
+        in memory are the only partition. Otherwise the run files are read 
+        one partition at a time and removed.
+        """
+        self._merge()
+        if not self.is_spilled():
+            yield self.unique, self.counts
+            return
+        self.spill()
+        try:
+            for i in xrange(self.partitions):
+                if self.runs[i] == 0:
+                    continue
+                part = PackedCounter()
+                with open(self._run_file(i), "rb") as handle:
+                    for _ in xrange(self.runs[i]):
+                        length = int(np.load(handle)[0])
+                        keys = np.load(handle)
+                        part._combine(length, keys, np.load(handle))
+                os.remove(self._run_file(i))
+                yield part.unique, part.counts
+        finally:
+            self.discard()
+
+
+    def discard(self):
+        """
+        Remove the run files and the packed keys in memory.
+        """
+        self.unique = dict()
+        self.counts = dict()
+        self.pending = dict()
+        self.pending_size = 0
+        self.runs = [0] * self.partitions
+        if self.run_directory is not None:
+            remove_run_directory(self.run_directory, self.directory)
+            self.run_directory = None
+
+
+    def update(self, other):
+        """
+        Add the counts from the :py:class:`~seqlib.packed.PackedCounter` 
+        *other*.
+        """
+        self._merge()
+        for unique, counts in other._iter_key_partitions():
+            for length in unique:
+                self._combine(length, unique[length], counts[length])
+            self.check_budget()
+        for part in other.other.iter_partitions():
+            for sequence, count in part.iteritems():
+                self.add_string(sequence, count)
+            self.other.check_budget()
+
+
+    def iter_partitions(self):
+        """
+        Generator function that yields a tuple containing a NumPy object 
+        array of counted sequence strings and a matching ``int64`` array of 
+        counts for each partition of the packed keys, followed by each 
+        partition of the sequences that can't be packed. Only one partition 
+        is decoded at a time. If the counts were written to disk, the run 
+        files are removed and the object is left empty.
+        """
+        for unique, counts in self._iter_key_partitions():
+            for length in sorted(unique):
+                yield unpack_keys(unique[length], length).astype(object), \
+                        counts[length]
+        for part in self.other.iter_partitions():
+            if len(part) > 0:
+                yield np.array(part.keys(), dtype=object), \
+                        np.array(part.values(), dtype=np.int64)
+
+
+    def results(self):
+        """
+        Return a tuple containing a NumPy object array of the counted
+        sequence strings and a matching ``int64`` array of counts.
+        """
+        sequences = list()
+        counts = list()
+        for part_sequences, part_counts in self.iter_partitions():
+            sequences.append(part_sequences)
+            counts.append(part_counts)
+        if len(sequences) == 0:
+            return np.array([], dtype=object), np.array([], dtype=np.int64)
+        return np.concatenate(sequences), np.concatenate(counts)
+
+
+
+def sequence_hashes(matrix, lengths):
+    """
+    Return a ``uint64`` array of hash keys for the sequences in the 
+    ``uint8`` array *matrix* (one sequence per row), where *lengths* is an 
+    array containing the length of each sequence. Sequences that can be 
+    packed use their packed key (see :py:func:`pack_matrix`) combined with 
+    the sequence length, and other sequences use Python's string hash of the 
+    uppercase sequence. Lowercase bases are treated as uppercase.
+    """
+    keys = np.zeros(len(lengths), dtype=np.uint64)
+    unique_lengths = np.unique(lengths)
+    for length in unique_lengths:
+        length = int(length)
+        if len(unique_lengths) == 1:
+            rows = np.ones(len(lengths), dtype=bool)
+        else:
+            rows = lengths == length
+        submatrix = matrix[rows]
+        if 0 < length <= MAX_PACKED_LENGTH:
+            length_keys, valid = pack_matrix(submatrix, length)
+        else:
+            length_keys = np.zeros(len(submatrix), dtype=np.uint64)
+            valid = np.zeros(len(submatrix), dtype=bool)
+        length_keys ^= np.uint64((length * _LENGTH_SALT) & _UINT64_MASK)
+        for i in np.flatnonzero(np.invert(valid)):
+            length_keys[i] = hash(submatrix[i, :length].tostring().upper()) & \
+                    _UINT64_MASK
+        keys[rows] = length_keys
+    return keys
+
+
+
+class CountMinSketch(object):
+    """
+    `Count-min sketch <http://en.wikipedia.org/wiki/Count%E2%80%93min_sketch>`_ 
+    for estimating the number of times each DNA sequence occurs using a 
+    fixed amount of memory. The sketch has *depth* rows of *width* counters 
+    (rounded up to a power of two). Estimates are never lower than the true 
+    count, and are higher only when sequences share counters in every row.
+
+    Sketches with the same *width*, *depth*, and *seed* can be combined with 
+    :py:meth:`update`.
+    """
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=0):
+        self.bits = max(1, int(np.ceil(np.log2(width))))
+        self.table = np.zeros((depth, 1 << self.bits), dtype=np.uint32)
+        rng = np.random.RandomState(seed)
+        high = rng.randint(0, 1 << 31, size=depth).astype(np.uint64)
+        low = rng.randint(0, 1 << 31, size=depth).astype(np.uint64)
+        # odd multipliers for multiply-shift hashing
+        self.multipliers = (high << np.uint64(33)) | (low << np.uint64(1)) | \
+                np.uint64(1)
+        self.pending = list()
+        self.pending_size = 0
+
+
+    def _columns(self, keys, row):
+        """
+        Return the counter positions in *row* for the array of hash *keys*.
+        """
+        return ((keys * self.multipliers[row]) >> 
+                np.uint64(64 - self.bits)).astype(np.intp)
+
+
+    def _flush(self):
+        """
+        Add the pending keys to the counters.
+        """
+        if self.pending_size > 0:
+            keys = np.concatenate(self.pending)
+            for row in xrange(len(self.table)):
+                self.table[row] += np.bincount(self._columns(keys, row), 
+                        minlength=self.table.shape[1]).astype(np.uint32)
+        self.pending = list()
+        self.pending_size = 0
+
+
+    def add_matrix(self, matrix, lengths, mask=None):
+        """
+        Add the sequences in the ``uint8`` array *matrix*, as described for 
+        :py:meth:`PackedCounter.add_matrix`.
+        """
+        if mask is not None:
+            matrix = matrix[mask]
+            lengths = lengths[mask]
+        if len(lengths) == 0:
+            return
+        self.pending.append(sequence_hashes(matrix, lengths))
+        self.pending_size += len(lengths)
+        if self.pending_size >= MIN_PENDING_SIZE:
+            self._flush()
+
+
+    def estimate_matrix(self, matrix, lengths):
+        """
+        Return an array containing the estimated count for each sequence in 
+        the ``uint8`` array *matrix*, where *lengths* is an array containing 
+        the length of each sequence.
+        """
+        self._flush()
+        keys = sequence_hashes(matrix, lengths)
+        estimate = self.table[0][self._columns(keys, 0)]
+        for row in xrange(1, len(self.table)):
+            estimate = np.minimum(estimate, 
+                                  self.table[row][self._columns(keys, row)])
+        return estimate
+
+
+    def update(self, other):
+        """
+        Add the counts from the :py:class:`~seqlib.packed.CountMinSketch` 
+        *other*, which must have the same dimensions and seed.
+        """
+        self._flush()
+        other._flush()
+        self.table += other.table
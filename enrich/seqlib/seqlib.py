@@ -2,9 +2,44 @@ from __future__ import print_function
 import time
 import logging
 from enrich_error import EnrichError
-from datacontainer import DataContainer
+from datacontainer import DataContainer, fix_filename
 import os.path
+import multiprocessing
+import numpy as np
+import pandas as pd
 import enrich_plot
+from fqread import load_fastq_index, index_fastq, detect_compression, is_bgzf
+from spill import SpillCounter
+
+
+SHARDS_PER_PROCESS = 4 # number of record ranges for each worker process
+
+
+# library and FASTQ indexes used by worker processes in count_sharded, set 
+# before the worker processes are forked so they don't need to be pickled
+_shard_lib = None
+_shard_indexes = None
+
+
+def _count_shard(shard):
+    """
+    Worker process function for :py:meth:`SeqLib.count_sharded`. Counts the 
+    records from *shard* (a tuple containing the first and last record 
+    numbers) and returns a tuple containing the counts (see 
+    :py:meth:`SeqLib.shard_counts`), filter statistics, and number of 
+    aligner calls.
+    """
+    lib = _shard_lib
+    lib.reset_counts()
+    for key in lib.filter_stats:
+        lib.filter_stats[key] = 0
+    aligner = getattr(lib, 'aligner', None)
+    if aligner is not None:
+        aligner.calls = 0
+    lib.count_records(shard[0], shard[1], _shard_indexes)
+    return lib.shard_counts(), lib.filter_stats, \
+            aligner.calls if aligner is not None else 0
+
 
 
 class SeqLib(DataContainer):
@@ -21,6 +56,14 @@ class SeqLib(DataContainer):
 
         try:
             self.timepoint = int(config['timepoint'])
+            if 'decompression threads' in config['fastq']:
+                self.threads = int(config['fastq']['decompression threads'])
+            else:
+                self.threads = 0
+            if 'processes' in config['fastq']:
+                self.processes = int(config['fastq']['processes'])
+            else:
+                self.processes = 1
         except KeyError as key:
             raise EnrichError("Missing required config value '{key}'".format(key=key), 
                               self.name)
@@ -32,6 +75,14 @@ class SeqLib(DataContainer):
         else:
             self.report_filtered = False
 
+        if 'count budget' in config:
+            try:
+                self.count_budget = int(config['count budget'])
+            except ValueError as value:
+                raise EnrichError("Invalid parameter value {value}".format(value=value), self.name)
+        else:
+            self.count_budget = None
+
 
     def calculate(self):
         """
@@ -40,6 +91,150 @@ class SeqLib(DataContainer):
         raise NotImplementedError("must be implemented by subclass")
 
 
+    def count_records(self, start=None, stop=None, indexes=None):
+        """
+        Pure virtual method that reads, filters, and counts the FASTQ_ 
+        records numbered from *start* up to (but not including) *stop*. 
+        *indexes* is a list containing a :py:class:`~fqread.FastqIndex` (or 
+        ``None``) for each FASTQ_ file. Counts are added to the data 
+        returned by :py:meth:`shard_counts` and filtering results are added 
+        to the filter statistics.
+        """
+        raise NotImplementedError("must be implemented by subclass")
+
+
+    def spill_directory(self):
+        """
+        Return the directory for temporary count files created when the 
+        ``'count budget'`` is exceeded, or ``None`` to use the system 
+        temporary directory if there is no output directory.
+        """
+        if self.output_base is None:
+            return None
+        return os.path.join(self.output_base, "spill", 
+                            fix_filename(self.name))
+
+
+    def reset_counts(self):
+        """
+        Remove the counts made by :py:meth:`count_records`. By default, 
+        counts are stored in a :py:class:`~seqlib.spill.SpillCounter` in the 
+        ``'variants'`` entry of the ``df_dict``, limited to the 
+        ``'count budget'`` keys in memory.
+        """
+        self.df_dict['variants'] = SpillCounter(self.count_budget, 
+                                                self.spill_directory())
+
+
+    def shard_counts(self):
+        """
+        Return the counts made by :py:meth:`count_records`, to be passed to 
+        :py:meth:`merge_counts` in the main process.
+        """
+        return self.df_dict['variants']
+
+
+    def merge_counts(self, counts):
+        """
+        Add the *counts* returned by :py:meth:`shard_counts` in a worker 
+        process to this object's counts.
+        """
+        variants = self.df_dict['variants']
+        for part in counts.iter_partitions():
+            for key, count in part.iteritems():
+                try:
+                    variants[key] += count
+                except KeyError:
+                    variants[key] = count
+            variants.check_budget()
+
+
+    def counts_dataframe(self, counts):
+        """
+        Convert the :py:class:`~seqlib.spill.SpillCounter` *counts* into a 
+        :py:class:`pandas.DataFrame` with a ``'count'`` column, one 
+        partition at a time.
+        """
+        frames = [pd.DataFrame.from_dict(part, orient="index", dtype="int32")
+                  for part in counts.iter_partitions() if len(part) > 0]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['count'], dtype="int32")
+        elif len(frames) == 1:
+            df = frames[0]
+        else:
+            df = pd.concat(frames)
+        df.columns = ['count']
+        return df
+
+
+    def count_sharded(self, fnames):
+        """
+        Count the records in the FASTQ_ files *fnames* (read in parallel) 
+        using :py:meth:`count_records` in ``processes`` worker processes. 
+        The files are divided into ranges of records using an index (see 
+        :py:func:`~fqread.index_fastq`), which is created in memory if there 
+        is no index file. Counts from each range are combined with 
+        :py:meth:`merge_counts` and the filter statistics are added 
+        together, so the results are the same as counting in a single 
+        process.
+
+        Worker processes are forked, so this requires a platform that 
+        supports ``fork``.
+
+        Ranges can only be read without decompressing the preceding records 
+        if the files are uncompressed or BGZF-compressed (see 
+        :py:func:`~fqread.is_bgzf`). If any of the files use other 
+        compression, a warning is logged and the records are counted in the 
+        main process instead.
+        """
+        global _shard_lib, _shard_indexes
+
+        for fname in fnames:
+            compression = detect_compression(fname)
+            if compression is not None and \
+                    not (compression == "gz" and is_bgzf(fname)):
+                logging.warning("FASTQ file '{fname}' must be uncompressed or BGZF-compressed to count using multiple processes, counting in a single process [{name}]".format(fname=fname, name=self.name))
+                self.count_records()
+                return
+
+        indexes = list()
+        for fname in fnames:
+            index = load_fastq_index(fname)
+            if index is None:
+                logging.info("Indexing FASTQ file '{fname}' [{name}]".format(fname=fname, name=self.name))
+                index = index_fastq(fname, write=False)
+            indexes.append(index)
+
+        # align the ranges with index checkpoints in the first file
+        records = indexes[0].records
+        interval = indexes[0].interval
+        size = -(-records // (self.processes * SHARDS_PER_PROCESS))
+        size = max(interval, -(-size // interval) * interval)
+        shards = [(start, min(start + size, records)) 
+                  for start in xrange(0, records, size)]
+        logging.info("Counting {n} records in {s} ranges using {p} processes [{name}]".format(n=records, s=len(shards), p=self.processes, name=self.name))
+
+        _shard_lib = self
+        _shard_indexes = indexes
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for counts, filter_stats, calls in \
+                    pool.imap_unordered(_count_shard, shards):
+                self.merge_counts(counts)
+                for key in filter_stats:
+                    self.filter_stats[key] += filter_stats[key]
+                if getattr(self, 'aligner', None) is not None:
+                    self.aligner.calls += calls
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shard_lib = None
+            _shard_indexes = None
+
+
     def report_filtered_read(self, fq, filter_flags):
         """
         Write the :py:class:`~fqread.FQRead` object *fq* to the ``DEBUG``
@@ -54,6 +249,55 @@ class SeqLib(DataContainer):
                       name=self.name, read=fq))
 
 
+    def filter_batch(self, batch):
+        """
+        Apply the quality-based read filters (``'chastity'``, 
+        ``'min quality'``, and ``'avg quality'``) to the 
+        :py:class:`~fqread.FQBatch` *batch* and update the filter statistics 
+        for each filter. Returns a dictionary containing a boolean array for 
+        each filtering option, which is ``True`` for each read that fails 
+        the filter.
+
+        The ``'total'`` filter statistic is not updated, because subclasses 
+        may apply additional filters to the reads that pass.
+        """
+        filter_flags = dict()
+        for key in self.filters:
+            filter_flags[key] = np.zeros(len(batch), dtype=bool)
+
+        if self.filters.get('chastity', False):
+            filter_flags['chastity'] = np.invert(batch.is_chaste())
+        if self.filters.get('min quality', 0) > 0:
+            filter_flags['min quality'] = batch.min_quality() < \
+                    self.filters['min quality']
+        if self.filters.get('avg quality', 0) > 0:
+            filter_flags['avg quality'] = batch.mean_quality() < \
+                    self.filters['avg quality']
+
+        for key in ('chastity', 'min quality', 'avg quality'):
+            if key in filter_flags:
+                self.filter_stats[key] += int(filter_flags[key].sum())
+        return filter_flags
+
+
+    def report_filtered_batch(self, batch, filter_flags):
+        """
+        Update the ``'total'`` filter statistic for the 
+        :py:class:`~fqread.FQBatch` *batch* using the dictionary of boolean 
+        arrays *filter_flags* (see :py:meth:`filter_batch`). If filtered 
+        reads are being reported, each filtered read is written using 
+        :py:meth:`report_filtered_read`.
+        """
+        filtered = np.zeros(len(batch), dtype=bool)
+        for key in filter_flags:
+            filtered |= filter_flags[key]
+        self.filter_stats['total'] += int(filtered.sum())
+        if self.report_filtered:
+            for i in np.flatnonzero(filtered):
+                self.report_filtered_read(batch.record(i), 
+                        dict((k, filter_flags[k][i]) for k in filter_flags))
+
+
     def write_all(self):
         self.write_data()
 
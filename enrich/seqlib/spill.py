@@ -0,0 +1,169 @@
+from __future__ import print_function
+import errno
+import os
+import os.path
+import shutil
+import tempfile
+import marshal
+
+
+SPILL_PARTITIONS = 64 # number of run files used by a spilled SpillCounter
+
+
+def make_run_directory(directory=None):
+    """
+    Create and return a new temporary directory for run files inside 
+    *directory*, which is created if it doesn't exist (or the system default 
+    temporary directory if *directory* is ``None``). Worker processes may 
+    create and remove *directory* at the same time, so this is retried if it 
+    is removed before the temporary directory is created.
+    """
+    while True:
+        if directory is not None:
+            try:
+                os.makedirs(directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+        try:
+            return tempfile.mkdtemp(prefix="spill_", dir=directory)
+        except OSError as err:
+            if err.errno != errno.ENOENT or directory is None:
+                raise
+
+
+def remove_run_directory(run_directory, directory=None):
+    """
+    Remove the temporary directory *run_directory* created by 
+    :py:func:`make_run_directory`, and *directory* if it is now empty.
+    """
+    shutil.rmtree(run_directory, ignore_errors=True)
+    if directory is not None:
+        try:
+            os.rmdir(directory)
+        except OSError: # still in use
+            pass
+
+
+class SpillCounter(dict):
+    """
+    Dictionary for counting sequences that limits the number of keys held in
+    memory. When :py:meth:`check_budget` finds more than *budget* keys, the
+    counts are written to run files and the dictionary is cleared. Keys are
+    divided among *partitions* run files by their hash, so each key is
+    always written to the same file. The run files are created in a new
+    temporary directory inside *directory* (or the system default temporary
+    directory if *directory* is ``None``).
+
+    Counts are combined by :py:meth:`iter_partitions`, which loads one
+    partition at a time. If *budget* is ``None``, the counts are never
+    written to disk.
+
+    .. note:: The budget is only enforced when :py:meth:`check_budget` is \
+    called, so counting code should call it regularly (for example, once per \
+    batch of reads).
+    """
+    def __init__(self, budget=None, directory=None,
+                 partitions=SPILL_PARTITIONS):
+        dict.__init__(self)
+        self.budget = budget
+        self.directory = directory
+        self.partitions = partitions
+        self.run_directory = None
+        self.spills = 0
+
+
+    def add(self, key, count=1):
+        """
+        Add *count* to the count for *key*.
+        """
+        try:
+            self[key] += count
+        except KeyError:
+            self[key] = count
+
+
+    def check_budget(self):
+        """
+        Call :py:meth:`spill` if the number of keys in memory exceeds the
+        budget.
+        """
+        if self.budget is not None and len(self) > self.budget:
+            self.spill()
+
+
+    def is_spilled(self):
+        """
+        Returns ``True`` if any counts have been written to disk.
+        """
+        return self.run_directory is not None
+
+
+    def _run_file(self, i):
+        """
+        Return the name of the run file for partition *i*.
+        """
+        return os.path.join(self.run_directory, "run{i}".format(i=i))
+
+
+    def spill(self):
+        """
+        Append the counts in memory to the run files and clear the
+        dictionary.
+        """
+        if self.run_directory is None:
+            self.run_directory = make_run_directory(self.directory)
+        parts = [dict() for _ in xrange(self.partitions)]
+        for key, count in self.iteritems():
+            parts[hash(key) % self.partitions][key] = count
+        self.clear()
+        for i, part in enumerate(parts):
+            if len(part) > 0:
+                with open(self._run_file(i), "ab") as handle:
+                    marshal.dump(part, handle)
+        self.spills += 1
+
+
+    def iter_partitions(self):
+        """
+        Generator function that yields a dictionary containing the combined
+        counts for each partition. If the counts were never written to disk,
+        the object itself is the only partition. Otherwise the run files are
+        read one partition at a time and removed, and the object is left
+        empty.
+        """
+        if not self.is_spilled():
+            yield self
+            return
+        self.spill()
+        try:
+            for i in xrange(self.partitions):
+                fname = self._run_file(i)
+                if not os.path.exists(fname):
+                    continue
+                part = dict()
+                with open(fname, "rb") as handle:
+                    while True:
+                        try:
+                            run = marshal.load(handle)
+                        except EOFError:
+                            break
+                        for key, count in run.iteritems():
+                            try:
+                                part[key] += count
+                            except KeyError:
+                                part[key] = count
+                os.remove(fname)
+                yield part
+        finally:
+            self.discard()
+
+
+    def discard(self):
+        """
+        Remove the run files and clear the dictionary.
+        """
+        self.clear()
+        if self.run_directory is not None:
+            remove_run_directory(self.run_directory, self.directory)
+            self.run_directory = None
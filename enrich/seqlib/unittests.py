@@ -1,6 +1,132 @@
 import unittest
+import os
+import shutil
+import tempfile
+import json
+import multiprocessing
+import itertools
+import gzip
+import bz2
+import struct
+import zlib
+import sys
+import random
+import pickle
+import marshal
 import seqlib
+import fqread
+import numpy as np
+import pandas as pd
 from enrich_error import EnrichError
+from basic import BasicSeqLib
+from barcode import BarcodeSeqLib
+from spill import SpillCounter
+import packed
+from packed import PackedCounter, CountMinSketch, pack_strings, unpack_keys
+import barcodevariant
+from barcodevariant import BarcodeVariantSeqLib, BarcodeMap, \
+        PackedBarcodeMap, load_barcode_map, FILTERED_VARIANT
+
+# the stand-alone scripts are in the top-level directory, which must come 
+# first so that the enrich package is found instead of the enrich script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                os.pardir, os.pardir))
+import fastq_tools
+import fastq_benchmark
+
+
+# calculate() sorts counts using DataFrame.sort, which was removed in pandas 
+# 0.20
+requires_sort = unittest.skipIf(not hasattr(pd.DataFrame, "sort"), 
+                                "requires pandas with DataFrame.sort")
+
+
+# wild type sequence used by the variant tests (Met-Lys-Pro-Gly-Ter)
+WT_DNA = "ATGAAACCCGGGTAA"
+
+
+def write_fastq(fname, sequences, quality="I"):
+    """
+    Write a FASTQ_ file *fname* containing one record for each of the
+    *sequences*, with every base given the *quality* character.
+    """
+    with open(fname, "w") as handle:
+        for i, sequence in enumerate(sequences):
+            handle.write("@M:1:2:3:{i}:1#0/1\n{seq}\n+\n{qual}\n".format(
+                    i=i, seq=sequence, qual=quality * len(sequence)))
+
+
+def write_bgzf(fname, data, block_size=64):
+    """
+    Write *data* to the BGZF file *fname* in blocks of *block_size* 
+    uncompressed bytes, as ``bgzip`` would.
+    """
+    with open(fname, "wb") as handle:
+        for i in xrange(0, len(data), block_size):
+            block = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(block) + compressor.flush()
+            handle.write("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff")
+            handle.write(struct.pack("<H2sHH", 6, "BC", 2, len(cdata) + 25))
+            handle.write(cdata)
+            handle.write(struct.pack("<II", zlib.crc32(block) & 0xffffffff, 
+                                     len(block)))
+
+
+def sequence_batch(sequences):
+    """
+    Return an :py:class:`~fqread.FQBatch` containing a record for each of 
+    the *sequences*.
+    """
+    return fqread.FQBatch([("@M:1:2:3:{i}:1#0/1".format(i=i), x, "+", 
+                            "I" * len(x)) for i, x in enumerate(sequences)])
+
+
+def count_sequences(sequences):
+    """
+    Return a dictionary of the number of times each of the *sequences* 
+    occurs, ignoring case.
+    """
+    counts = dict()
+    for x in sequences:
+        counts[x.upper()] = counts.get(x.upper(), 0) + 1
+    return counts
+
+
+def _spill_counts(directory):
+    """
+    Count some keys in a :py:class:`~seqlib.spill.SpillCounter` that spills 
+    into *directory* and return the combined counts. Used by 
+    :py:class:`SpillCounterTests` in worker processes.
+    """
+    counter = SpillCounter(budget=1, directory=directory)
+    for i in xrange(20):
+        counter.add(i % 7)
+        counter.check_budget()
+    counts = dict()
+    for part in counter.iter_partitions():
+        counts.update(part)
+    return counts
+
+
+def write_map(fname, entries):
+    """
+    Write a barcode map file *fname* containing the (barcode, variant) 
+    tuples in *entries*.
+    """
+    with open(fname, "w") as handle:
+        for barcode, variant in entries:
+            handle.write("{bc}\t{v}\n".format(bc=barcode, v=variant))
+
+
+def mutate(sequence, n):
+    """
+    Return *sequence* with a substitution at each of the first *n* 
+    positions.
+    """
+    return "".join("G" if b == "C" else "C" for b in sequence[:n]) + \
+            sequence[n:]
+
 
 class SeqLibTests(unittest.TestCase):
 
@@ -9,3 +135,925 @@ class SeqLibTests(unittest.TestCase):
 
     def test_config(self):
         pass
+
+
+class ReadFastqTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reads = os.path.join(self.directory, "reads.fq")
+        self.sequences = [WT_DNA, mutate(WT_DNA, 3), "ACGT", WT_DNA[:7]] * 5
+        write_fastq(self.reads, self.sequences)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def records(self, fname, **options):
+        return [(fq.header, fq.sequence, fq.header2, fq.quality_string()) 
+                for fq in fqread.read_fastq(fname, **options)]
+
+    def test_mmap(self):
+        # small buffers split records across reads
+        mapped = self.records(self.reads, use_mmap=True)
+        buffered = self.records(self.reads, use_mmap=False, buffer_size=7)
+        self.assertEqual(mapped, buffered)
+        self.assertEqual([x[1] for x in mapped], self.sequences)
+
+
+    def test_threads(self):
+        with open(self.reads) as handle:
+            data = handle.read()
+        expected = self.records(self.reads)
+        gz = os.path.join(self.directory, "reads.fq.gz")
+        with gzip.open(gz, "wb") as handle:
+            handle.write(data)
+        self.assertEqual(self.records(gz, threads=1), expected)
+        bzip = os.path.join(self.directory, "reads.fq.bz2")
+        with bz2.BZ2File(bzip, "wb") as handle:
+            handle.write(data)
+        self.assertEqual(self.records(bzip, threads=1), expected)
+        bgz = os.path.join(self.directory, "blocked.fq.gz")
+        write_bgzf(bgz, data)
+        self.assertTrue(fqread.is_bgzf(bgz))
+        self.assertFalse(fqread.is_bgzf(gz))
+        for threads in (0, 1, 3):
+            self.assertEqual(self.records(bgz, threads=threads), expected)
+
+
+    def test_prefetch(self):
+        reverse = os.path.join(self.directory, "reverse.fq.gz")
+        with gzip.open(reverse, "wb") as handle:
+            for fq in fqread.read_fastq(self.reads):
+                fq.revcomp()
+                handle.write(str(fq) + "\n")
+        expected = [(str(f), str(r)) for f, r in 
+                    fqread.read_fastq_multi([self.reads, reverse])]
+        self.assertEqual(len(expected), len(self.sequences))
+        pairs = fqread.read_fastq_multi([self.reads, reverse], prefetch=True)
+        self.assertEqual([(str(f), str(r)) for f, r in pairs], expected)
+        # mismatched file lengths
+        short = os.path.join(self.directory, "short.fq")
+        write_fastq(short, self.sequences[:3])
+        pairs = fqread.read_fastq_multi([self.reads, short], prefetch=True)
+        self.assertEqual([x is None for x in itertools.islice(pairs, 4)], 
+                         [False, False, False, True])
+        pairs.close()
+
+
+    def test_index(self):
+        with open(self.reads) as handle:
+            data = handle.read()
+        gz = os.path.join(self.directory, "reads.fq.gz")
+        with gzip.open(gz, "wb") as handle:
+            handle.write(data)
+        bgz = os.path.join(self.directory, "blocked.fq.gz")
+        write_bgzf(bgz, data)
+        expected = self.records(self.reads)
+        for fname in (self.reads, gz, bgz):
+            self.assertEqual(fqread.load_fastq_index(fname), None)
+            index = fqread.index_fastq(fname, interval=3)
+            self.assertEqual(index.records, len(self.sequences))
+            self.assertEqual(index.locate(7)[2], 6)
+            loaded = fqread.load_fastq_index(fname)
+            self.assertEqual(loaded.restarts, index.restarts)
+            self.assertEqual(loaded.skips, index.skips)
+            for start, stop in ((None, 5), (0, 3), (4, 11), (6, 9), 
+                                (17, None), (19, 40), (25, None)):
+                self.assertEqual(self.records(fname, start=start, stop=stop), 
+                                 expected[start:stop])
+                self.assertEqual(self.records(fname, start=start, stop=stop,
+                                              index=index, threads=2), 
+                                 expected[start:stop])
+        # out of date indexes are ignored
+        write_fastq(self.reads, self.sequences[:3])
+        self.assertEqual(fqread.load_fastq_index(self.reads), None)
+
+
+    def test_writer(self):
+        expected = self.records(self.reads)
+        for name in ("copy.fq", "copy.fq.gz", "copy.fq.bz2"):
+            for threads in (0, 1):
+                fname = os.path.join(self.directory, name)
+                with fqread.FastqWriter(fname, buffer_size=50, 
+                                        threads=threads) as writer:
+                    for i, fq in enumerate(fqread.read_fastq(self.reads)):
+                        if i % 2 == 0:
+                            writer.write(fq)
+                        else:
+                            writer.write_record((fq.header, fq.sequence, 
+                                    fq.header2, fq.quality_string()))
+                self.assertEqual(self.records(fname), expected)
+        # modified quality values are written
+        fname = os.path.join(self.directory, "copy.fq")
+        fq = fqread.FQRead("@M:1:2:3:0:1#0/1", "ACGT", "+", "IIII")
+        fq.quality = [2, 7, 20, 40]
+        with fqread.FastqWriter(fname) as writer:
+            writer.write(fq)
+        self.assertEqual(self.records(fname), 
+                         [("@M:1:2:3:0:1#0/1", "ACGT", "+", "#(5I")])
+
+
+    def test_fastq_tools_batch(self):
+        fqs = list(fastq_tools.read_fastq(self.reads))
+        fqs.append(("@M:1:2:3:4:1#0/1", "ACGTA", "I5#(+"))
+        fqs.append(("@M:1:2:3:5:1#0/1", "", ""))
+        quality = fastq_tools.fastq_quality_batch(fqs)
+        minimum = fastq_tools.fastq_min_quality_batch(fqs)
+        mean = fastq_tools.fastq_mean_quality_batch(fqs)
+        self.assertEqual(quality.shape, (len(fqs), len(WT_DNA)))
+        for i, fq in enumerate(fqs[:-1]):
+            self.assertEqual(quality[i].compressed().tolist(), 
+                             fastq_tools.fastq_quality(fq))
+            self.assertEqual(minimum[i], fastq_tools.fastq_min_quality(fq))
+            self.assertAlmostEqual(mean[i], fastq_tools.fastq_mean_quality(fq))
+        self.assertEqual(quality[-1].count(), 0)
+        self.assertEqual(minimum[-1], 0)
+        self.assertTrue(np.isnan(mean[-1]))
+
+
+    def test_benchmark_data(self):
+        expected = None
+        for compression in fastq_benchmark.AVAILABLE_COMPRESSION_TYPES:
+            fname = fastq_benchmark.synthetic_fname(self.directory, 50, 20, 
+                                                    compression)
+            size = fastq_benchmark.write_synthetic_fastq(fname, 50, 20, 
+                                                         compression)
+            records = self.records(fname)
+            if expected is None:
+                expected = records
+                self.assertEqual(size, os.path.getsize(fname))
+            self.assertEqual(records, expected)
+        self.assertEqual(len(expected), 50)
+        self.assertTrue(all(len(x[1]) == 20 for x in expected))
+        report = fastq_benchmark.run_benchmark(50, [20], ["none"], [100], 1, 
+                                               self.directory)
+        self.assertEqual(len(report["results"]), 3)
+        self.assertEqual(sorted(x["records"] for x in report["results"]), 
+                         [50, 50, 100])
+
+
+    def test_detect_compression(self):
+        with open(self.reads) as handle:
+            data = handle.read()
+        expected = self.records(self.reads)
+        files = list()
+        # compression is detected from the contents, not the extension
+        fname = os.path.join(self.directory, "gz.fq")
+        with gzip.open(fname, "wb") as handle:
+            handle.write(data)
+        files.append(("gz", fname))
+        fname = os.path.join(self.directory, "bz2.fq.gz")
+        with bz2.BZ2File(fname, "wb") as handle:
+            handle.write(data)
+        files.append(("bz2", fname))
+        if fqread.lzma is not None:
+            fname = os.path.join(self.directory, "xz.fq.xz")
+            with fqread.lzma.LZMAFile(fname, "wb") as handle:
+                handle.write(data)
+            files.append(("xz", fname))
+        if fqread.zstandard is not None:
+            fname = os.path.join(self.directory, "zst.fq.zst")
+            with open(fname, "wb") as handle:
+                handle.write(fqread.zstandard.ZstdCompressor().compress(data))
+            files.append(("zst", fname))
+        self.assertEqual(fqread.detect_compression(self.reads), None)
+        for compression, fname in files:
+            self.assertEqual(fqread.detect_compression(fname), compression)
+            handle = fqread.open_compressed(fname)
+            try:
+                self.assertEqual(handle.read(), data)
+            finally:
+                handle.close()
+            self.assertEqual(self.records(fname), expected)
+            self.assertEqual(list(fastq_tools.read_fastq(fname)), 
+                             list(fastq_tools.read_fastq(self.reads)))
+
+
+class FQReadTests(unittest.TestCase):
+
+    def test_lazy_quality(self):
+        fq = fqread.FQRead("@M:1:2:3:0:1#0/1", "ACGT", "+", "I5#(")
+        self.assertEqual(fq.quality_string(), "I5#(")
+        self.assertEqual(fq.min_quality(), 2)
+        self.assertAlmostEqual(fq.mean_quality(), 17.25)
+        fq.trim(start=2)
+        self.assertEqual(fq.quality, [20, 2, 7])
+        fq.revcomp()
+        self.assertEqual(fq.quality, [7, 2, 20])
+        self.assertEqual(fq.quality_string(), "(#5")
+        fq.quality = [40, 40, 40]
+        self.assertEqual(fq.min_quality(), 40)
+        self.assertEqual(str(fq), "@M:1:2:3:0:1#0/1\nACG\n+\nIII")
+
+
+    def test_headers(self):
+        legacy = "@HWI-ST:4:1101:15:2080:1#0/1"
+        fq = fqread.FQRead(legacy, "A", "+", "I")
+        for key, value in fq.header_information().iteritems():
+            self.assertEqual(fqread.header_field(legacy, key), value)
+        self.assertEqual(fqread.header_field(legacy, "Chastity"), 1)
+        self.assertTrue(fqread.header_chastity(legacy))
+        self.assertFalse(fqread.header_chastity(
+                "@HWI-ST:4:1101:15:2080:0#0/1"))
+        casava = "@M0:12:000-A1:1:1101:15:2080 1:N:0:ACGT"
+        self.assertEqual(fqread.header_field(casava, "Tile"), 1101)
+        self.assertEqual(fqread.header_field(casava, "IndexSequence"), "ACGT")
+        self.assertEqual(fqread.header_field(casava, "Chastity"), 1)
+        self.assertTrue(fqread.header_chastity(casava))
+        self.assertFalse(fqread.header_chastity(
+                "@M0:12:000-A1:1:1101:15:2080 1:Y:0:ACGT"))
+        for header in ("@read1", "@M0:1101:15:2080 1:N:0:ACGT", 
+                       "@HWI-ST:15:2080:1#0/1", "@HWI-ST:4:1101:15:2080:1"):
+            self.assertEqual(fqread.split_header(header), None)
+            self.assertEqual(fqread.header_field(header, "Chastity"), None)
+            self.assertFalse(fqread.header_chastity(header))
+
+
+class FQBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        # mixed read lengths, including a zero-length read, and an unchaste 
+        # read
+        self.records = [("@M:1:2:3:0:1#0/1", "ACGTAC", "+", "I5I#I("),
+                        ("@M:1:2:3:1:0#0/1", "GGA", "+", "III"),
+                        ("@M:1:2:3:2:1#0/1", "", "+", ""),
+                        ("@M:1:2:3:3:1#0/1", "TTGCAAN", "+", "#IIIII5")]
+
+    def reads(self):
+        return [fqread.FQRead(*r) for r in self.records]
+
+    def test_matches_reads(self):
+        batch = fqread.FQBatch(self.records)
+        self.assertEqual(len(batch), 4)
+        self.assertFalse(batch.is_uniform())
+        self.assertEqual(batch.sequences(), [r[1] for r in self.records])
+        self.assertEqual(batch.sequences(batch.lengths > 3), 
+                         ["ACGTAC", "TTGCAAN"])
+        for i, fq in enumerate(self.reads()):
+            self.assertEqual(str(batch.record(i)), str(fq))
+        self.assertEqual(list(batch.min_quality()), 
+                         [fq.min_quality() for fq in self.reads()])
+        for x, y in zip(batch.mean_quality(), 
+                        [fq.mean_quality() for fq in self.reads()]):
+            self.assertAlmostEqual(x, y)
+        self.assertEqual(list(batch.is_chaste()), 
+                         [fq.is_chaste() for fq in self.reads()])
+
+    def test_trim_revcomp(self):
+        batch = fqread.FQBatch(self.records)
+        batch.trim(start=2, end=5)
+        batch.revcomp()
+        for i, fq in enumerate(self.reads()):
+            fq.trim(start=2, end=5)
+            fq.revcomp()
+            self.assertEqual(str(batch.record(i)), str(fq))
+
+    def test_filter_batch(self):
+        directory = tempfile.mkdtemp()
+        try:
+            reads = os.path.join(directory, "reads.fq")
+            write_fastq(reads, [WT_DNA])
+            lib = BasicSeqLib({'name' : "test", 'timepoint' : 0,
+                               'output directory' : directory,
+                               'fastq' : {'forward' : reads},
+                               'wild type' : {'sequence' : WT_DNA, 
+                                             'coding' : True},
+                               'filters' : {'chastity' : True, 
+                                            'min quality' : 10, 
+                                            'avg quality' : 30}})
+        finally:
+            shutil.rmtree(directory)
+        flags = lib.filter_batch(fqread.FQBatch(self.records))
+        self.assertEqual(list(flags['chastity']), [False, True, False, False])
+        self.assertEqual(list(flags['min quality']), 
+                         [True, False, True, True])
+        self.assertEqual(list(flags['avg quality']), 
+                         [True, False, True, False])
+        self.assertEqual(lib.filter_stats['min quality'], 3)
+
+
+class VariantSeqLibTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reads = os.path.join(self.directory, "reads.fq")
+        write_fastq(self.reads, [WT_DNA])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_lib(self, **options):
+        # configs are loaded from JSON files, so strings are unicode
+        config = {'name' : "test", 'timepoint' : 0,
+                  'output directory' : self.directory,
+                  'fastq' : {'forward' : self.reads},
+                  'wild type' : {'sequence' : WT_DNA, 'coding' : True},
+                  'filters' : {'max mutations' : 2}}
+        config.update(options)
+        return BasicSeqLib(json.loads(json.dumps(config)))
+
+    def write_variants(self):
+        """
+        Write reads containing the wild type and variants with one to three 
+        substitutions, and return the number of reads.
+        """
+        sequences = list()
+        for i in range(12) * 5: # each sequence is read 5 times
+            sequence = list(WT_DNA)
+            for j in xrange(i % 4):
+                pos = (i * 7 + j * 5) % len(WT_DNA)
+                sequence[pos] = "ACGT"[("ACGT".index(sequence[pos]) + 1 + 
+                                        i % 3) % 4]
+            sequences.append("".join(sequence))
+        sequences.append(WT_DNA[:-1])
+        write_fastq(self.reads, sequences)
+        return len(sequences)
+
+    def count(self, lib):
+        """
+        Count the variants in the reads and return a tuple containing a 
+        dictionary of variant counts and the filter statistics.
+        """
+        lib.reset_counts()
+        if lib.processes > 1:
+            lib.count_sharded([lib.reads])
+        else:
+            lib.count_records()
+        if lib.collapse_reads:
+            lib.count_collapsed()
+        counts = dict()
+        for part in lib.df_dict['variants'].iter_partitions():
+            counts.update(part)
+        return counts, lib.filter_stats
+
+    def test_collapse(self):
+        reads = self.write_variants()
+        fqread.index_fastq(self.reads, interval=10)
+        expected = self.count(self.make_lib())
+        self.assertEqual(sum(expected[0].values()) + 
+                         expected[1]['max mutations'], reads)
+        self.assertTrue(expected[1]['max mutations'] > 1)
+        for options in ({}, {'count budget' : 2}, 
+                        {'fastq' : {'forward' : self.reads, 'processes' : 3}}):
+            options['collapse reads'] = True
+            lib = self.make_lib(**options)
+            self.assertEqual(self.count(lib), expected)
+            self.assertEqual(lib.sequence_counts, None)
+
+    def test_substitution_table(self):
+        self.write_variants()
+        fqread.index_fastq(self.reads, interval=10)
+        n = len(WT_DNA)
+        for max_mutations, size in ((1, 1 + 3 * n), 
+                                    (2, 1 + 3 * n + 9 * n * (n - 1) / 2)):
+            filters = {'max mutations' : max_mutations}
+            expected = self.count(self.make_lib(filters=filters))
+            for fastq in ({}, {'processes' : 3}):
+                fastq['forward'] = self.reads
+                lib = self.make_lib(filters=filters, fastq=fastq, 
+                                    **{'substitution table' : True})
+                self.assertEqual(self.count(lib), expected)
+                self.assertEqual(len(lib.substitution_table), size)
+                for sequence, code in lib.substitution_table.iteritems():
+                    self.assertEqual(lib.encode_variant(
+                            (i, b) for i, b in enumerate(sequence) 
+                            if b != WT_DNA[i]), code)
+
+    def test_codon_translation(self):
+        lib = self.make_lib()
+        lib.reset_counts()
+        labels = [("CTG" + WT_DNA[3:], "c.1A>C (p.Met1Leu)"),
+                  ("CCG" + WT_DNA[3:], 
+                   "c.1A>C (p.Met1Pro), c.2T>C (p.Met1Pro)"),
+                  (WT_DNA[:8] + "A" + WT_DNA[9:], "c.9C>A (p.=)"),
+                  (WT_DNA[:3] + "T" + WT_DNA[4:], "c.4A>T (p.Lys2Ter)"),
+                  (WT_DNA[:12] + "C" + WT_DNA[13:], "c.13T>C (p.Ter5Gln)")]
+        for variant, label in labels * 2:
+            self.assertEqual(lib.variant_label(lib.count_variant(variant)), 
+                             label)
+        # the same change in different codons is cached separately
+        self.assertEqual(len(lib.mutation_cache), 6)
+        lib = self.make_lib(**{'wild type' : {'sequence' : WT_DNA, 
+                                              'coding' : False}})
+        lib.reset_counts()
+        self.assertEqual(lib.variant_label(lib.count_variant(
+                "CCG" + WT_DNA[3:])), "n.1A>C, n.2T>C")
+
+    def test_json_config(self):
+        lib = self.make_lib()
+        lib.reset_counts()
+        variant = lib.count_variant(WT_DNA[:4] + "G" + WT_DNA[5:])
+        self.assertEqual(lib.variant_label(variant), "c.5A>G (p.Lys2Arg)")
+        self.assertEqual(lib.variant_label(lib.count_variant(WT_DNA)), "_wt")
+
+    def test_mismatches(self):
+        lib = self.make_lib()
+        lib.reset_counts()
+        double = WT_DNA[:4] + "G" + WT_DNA[5:9] + "T" + WT_DNA[10:]
+        self.assertEqual(lib.variant_label(lib.count_variant(double)), 
+                         "c.5A>G (p.Lys2Arg), c.10G>T (p.Gly4Trp)")
+        lower = (WT_DNA[:4] + "G" + WT_DNA[5:]).lower()
+        self.assertEqual(lib.variant_label(lib.count_variant(lower, copies=3)),
+                         "c.5A>G (p.Lys2Arg)")
+        self.assertEqual(lib.variant_label(lib.count_variant(
+                WT_DNA[:6] + "N" + WT_DNA[7:])), "c.7C>N (p.Pro3???)")
+        self.assertEqual(lib.count_variant(mutate(WT_DNA, 3)), None)
+        self.assertEqual(lib.count_variant(WT_DNA[:-1]), None)
+        self.assertRaises(EnrichError, lib.count_variant, WT_DNA[:-1] + "Z")
+        self.assertRaises(EnrichError, lib.count_variant, "")
+        self.assertEqual(lib.count_variant(WT_DNA[:4] + "G" + WT_DNA[5:]), 
+                         lib.count_variant(lower))
+        counts = dict((lib.variant_label(k), v) for k, v in 
+                      lib.df_dict['variants'].iteritems())
+        self.assertEqual(counts, {"c.5A>G (p.Lys2Arg), c.10G>T (p.Gly4Trp)" : 1,
+                                  "c.5A>G (p.Lys2Arg)" : 5, 
+                                  "c.7C>N (p.Pro3???)" : 1})
+
+    def test_variant_codes(self):
+        lib = self.make_lib(filters={'max mutations' : 4})
+        lib.reset_counts()
+        for mutations in ([], [(0, "C")], [(1, "N"), (14, "G")], 
+                          [(3, "T"), (4, "G"), (8, "A"), (13, "C")]):
+            code = lib.encode_variant(mutations)
+            self.assertEqual(lib.decode_variant(code), mutations)
+            self.assertEqual(lib.count_variant(lib.variant_sequence(
+                    mutations)), code)
+            self.assertEqual(lib.variant_code(lib.variant_label(code)), code)
+        self.assertEqual(lib.variant_label(0), "_wt")
+        self.assertEqual(lib.variant_code("_wt"), 0)
+        self.assertEqual(lib.variant_code("c.4_6del (p.Lys2fs)"), None)
+
+    def test_coded_output(self):
+        lib = self.make_lib()
+        lib.reset_counts()
+        lib.count_variant(WT_DNA, copies=4)
+        lib.count_variant("CCG" + WT_DNA[3:], copies=2)
+        lib.count_variant("CTG" + WT_DNA[3:], copies=3)
+        lib.df_dict['variants'] = lib.counts_dataframe(lib.df_dict['variants'])
+        lib.df_dict['variants'].loc["c.4_6del (p.Lys2fs)"] = 5
+        expected_nt = {"_wt" : 4, "c.1A>C" : 5, "c.2T>C" : 2}
+        expected_aa = {"p.Met1Leu" : 3, "p.Met1Pro" : 2}
+        lib.count_mutations()
+        self.assertEqual(lib.df_dict['mutations_nt'][0].to_dict(), 
+                         expected_nt)
+        self.assertEqual(lib.df_dict['mutations_aa'][0].to_dict(), 
+                         expected_aa)
+
+        # variants are written and restored as HGVS strings
+        lib.dump_data(keys=['variants'])
+        with open(lib.df_files['variants']) as handle:
+            lines = handle.read().splitlines()
+        self.assertEqual(sorted(lines), sorted([
+                "sequence\tcount", "_wt\t4", 
+                "c.1A>C (p.Met1Pro), c.2T>C (p.Met1Pro)\t2", 
+                "c.1A>C (p.Met1Leu)\t3", "c.4_6del (p.Lys2fs)\t5"]))
+        lib.count_mutations()
+        self.assertEqual(lib.df_dict['mutations_nt'][0].to_dict(), 
+                         expected_nt)
+        self.assertEqual(lib.df_dict['mutations_aa'][0].to_dict(), 
+                         expected_aa)
+
+    def test_code_overflow(self):
+        # a 15 base wild type uses 7 bits per mutation, so at most 9 
+        # mutations fit in a code
+        lib = self.make_lib(filters={'max mutations' : len(WT_DNA)})
+        lib.reset_counts()
+        self.assertEqual(lib.max_coded_mutations, 9)
+        variant = lib.count_variant(mutate(WT_DNA, 9))
+        self.assertTrue(isinstance(variant, (int, long)))
+        self.assertTrue(variant < 2 ** 63)
+        self.assertEqual(len(lib.decode_variant(variant)), 9)
+        self.assertEqual(lib.variant_code(lib.variant_label(variant)), variant)
+        label = lib.count_variant(mutate(WT_DNA, 10))
+        self.assertTrue(isinstance(label, basestring))
+        self.assertEqual(len(label.split(", ")), 10)
+        self.assertEqual(label.split(", ")[0], "c.1A>C (p.Met1Pro)")
+        self.assertEqual(lib.variant_label(label), label)
+
+
+class SpillCounterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_merge(self):
+        keys = [str(i % 13) * (i % 3 + 1) for i in xrange(200)]
+        directory = os.path.join(self.directory, "spill")
+        counter = SpillCounter(budget=5, directory=directory, partitions=4)
+        for key in keys:
+            counter.add(key)
+            counter.check_budget()
+        self.assertTrue(counter.is_spilled())
+        self.assertTrue(counter.spills > 1)
+        counts = dict()
+        for part in counter.iter_partitions():
+            self.assertFalse(any(key in counts for key in part))
+            counts.update(part)
+        self.assertEqual(counts, count_sequences(keys))
+        self.assertEqual(len(counter), 0)
+        self.assertFalse(os.path.exists(directory))
+
+    def test_concurrent_spill(self):
+        # worker processes create and remove the same spill directory
+        spill_directory = os.path.join(self.directory, "spill", "test")
+        pool = multiprocessing.Pool(4)
+        try:
+            results = pool.map(_spill_counts, [spill_directory] * 32)
+        finally:
+            pool.close()
+            pool.join()
+        expected = dict((k, 3 if k < 6 else 2) for k in xrange(7))
+        for counts in results:
+            self.assertEqual(counts, expected)
+        self.assertFalse(os.path.exists(spill_directory))
+
+
+class PackedCounterTests(unittest.TestCase):
+
+    def setUp(self):
+        # includes sequences that can't be packed
+        self.sequences = ["ACGTAC", "acgtac", "ACGTAC", "ACGTA", "TTTTTT", 
+                          "ACGNAC", "", "A" * 40, "A" * 40, "A" * 32, 
+                          "CCCCCC", "ACGTAC", "T" * 32] * 3
+
+    def counts(self, counter):
+        sequences, counts = counter.results()
+        self.assertEqual(len(sequences), len(set(sequences)))
+        return dict(zip(sequences, counts))
+
+    def test_pack(self):
+        sequences = ["ACGTACGTAC", "TTTTTTTTTT", "ACGTTGCAAA"]
+        keys, valid = pack_strings(sequences, 10)
+        self.assertTrue(valid.all())
+        self.assertEqual(list(unpack_keys(keys, 10)), sequences)
+        keys, valid = pack_strings(["acgt", "ACNT"], 4)
+        self.assertEqual(list(valid), [True, False])
+        self.assertEqual(unpack_keys(keys[:1], 4)[0], "ACGT")
+
+    def test_counts(self):
+        counter = PackedCounter()
+        for i in xrange(0, len(self.sequences), 5):
+            batch = sequence_batch(self.sequences[i:i + 5])
+            counter.add_matrix(batch.sequence, batch.lengths, 
+                               batch.lengths != 6)
+            counter.add_matrix(batch.sequence, batch.lengths, 
+                               batch.lengths == 6)
+        self.assertEqual(self.counts(counter), count_sequences(self.sequences))
+
+    def test_spill(self):
+        directory = tempfile.mkdtemp()
+        try:
+            spill_directory = os.path.join(directory, "spill")
+            counters = [PackedCounter(budget=2, directory=spill_directory, 
+                                      partitions=4) for _ in xrange(2)]
+            for i in xrange(0, len(self.sequences), 4):
+                batch = sequence_batch(self.sequences[i:i + 4])
+                counter = counters[i // 4 % 2]
+                counter.add_matrix(batch.sequence, batch.lengths)
+                counter.spill()
+                counter.check_budget()
+            self.assertTrue(counters[0].is_spilled())
+            self.assertTrue(counters[0].other.is_spilled())
+            counters[0].update(counters[1])
+            self.assertFalse(counters[1].is_spilled())
+            self.assertEqual(self.counts(counters[0]), 
+                             count_sequences(self.sequences))
+            self.assertFalse(os.path.exists(spill_directory))
+        finally:
+            shutil.rmtree(directory)
+
+
+class BarcodeSeqLibTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reads = os.path.join(self.directory, "reads.fq")
+        # barcodes with a range of abundances, and every 7th read fails the 
+        # quality filter
+        rng = random.Random(0)
+        self.barcodes = ["".join(rng.choice("ACGT") for _ in xrange(10)) 
+                         for _ in xrange(12)]
+        with open(self.reads, "w") as handle:
+            for i in xrange(300):
+                barcode = self.barcodes[min(int(rng.expovariate(0.4)), 11)]
+                quality = "#" if i % 7 == 0 else "I"
+                handle.write("@M:1:2:3:{i}:1#0/1\n{bc}GGGG\n+\n{q}\n".format(
+                        i=i, bc=barcode, q=quality * 14))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_lib(self, fastq=None, barcodes=None, **options):
+        config = {'name' : "test", 'timepoint' : 0,
+                  'output directory' : self.directory,
+                  'fastq' : {'forward' : self.reads, 'length' : 10},
+                  'barcodes' : {},
+                  'filters' : {'min quality' : 20}}
+        config['fastq'].update(fastq or {})
+        config['barcodes'].update(barcodes or {})
+        config.update(options)
+        return BarcodeSeqLib(json.loads(json.dumps(config)))
+
+    def count(self, lib):
+        """
+        Count the barcodes and return a tuple containing a dictionary of 
+        barcode counts and the filter statistics.
+        """
+        lib.reset_counts()
+        lib.count_all()
+        barcodes, counts = lib.barcode_counter.results()
+        return dict(zip(barcodes, counts)), lib.filter_stats
+
+    def test_sharded(self):
+        expected = self.count(self.make_lib())
+        self.assertEqual(sum(expected[0].values()), 300 - 43)
+        self.assertEqual(expected[1]['min quality'], 43)
+        fqread.index_fastq(self.reads, interval=10)
+        self.assertEqual(self.count(self.make_lib(fastq={'processes' : 3})),
+                         expected)
+        # gzip files can't be divided into ranges
+        gz = os.path.join(self.directory, "reads.fq.gz")
+        with open(self.reads) as handle:
+            with gzip.open(gz, "wb") as output:
+                output.write(handle.read())
+        self.assertEqual(self.count(self.make_lib(
+                fastq={'forward' : gz, 'processes' : 3})), expected)
+
+    def test_count_budget(self):
+        expected = self.count(self.make_lib())
+        fqread.index_fastq(self.reads, interval=10)
+        # merge the packed keys after every batch so the budget is checked
+        min_pending_size = packed.MIN_PENDING_SIZE
+        packed.MIN_PENDING_SIZE = 0
+        try:
+            for fastq in ({}, {'processes' : 3}):
+                lib = self.make_lib(fastq=fastq, **{'count budget' : 3})
+                self.assertEqual(self.count(lib), expected)
+                self.assertFalse(os.path.exists(lib.spill_directory()))
+        finally:
+            packed.MIN_PENDING_SIZE = min_pending_size
+
+    def test_sketch(self):
+        batch = next(fqread.read_fastq_batches(self.reads, batch_size=300))
+        sketch = CountMinSketch(width=16, depth=2)
+        halves = [CountMinSketch(width=16, depth=2) for _ in xrange(2)]
+        for i in xrange(0, len(batch), 50):
+            rows = np.arange(len(batch)) // 50 == i // 50
+            sketch.add_matrix(batch.sequence, batch.lengths, rows)
+            halves[i // 50 % 2].add_matrix(batch.sequence, batch.lengths, rows)
+        expected = count_sequences(batch.sequences())
+        estimates = sketch.estimate_matrix(batch.sequence, batch.lengths)
+        for sequence, estimate in zip(batch.sequences(), estimates):
+            self.assertTrue(estimate >= expected[sequence])
+        halves[0].update(halves[1])
+        self.assertTrue(np.array_equal(halves[0].table, sketch.table))
+
+        # two passes keep the exact count of every abundant barcode
+        counts, filter_stats = self.count(self.make_lib())
+        expected = dict((k, v) for k, v in counts.iteritems() if v >= 10)
+        for barcodes in ({'sketch' : True}, 
+                         {'sketch' : True, 'sketch width' : 4}):
+            barcodes['min count'] = 10
+            lib = self.make_lib(barcodes=barcodes)
+            lib.sketch_pass = True
+            lib.reset_counts()
+            lib.count_all()
+            lib.sketch_pass = False
+            for key in lib.filter_stats:
+                lib.filter_stats[key] = 0
+            counts, stats = self.count(lib)
+            self.assertEqual(stats, filter_stats)
+            self.assertEqual(dict((k, v) for k, v in counts.iteritems() 
+                                  if k in expected), expected)
+            self.assertTrue(all(v < 10 for k, v in counts.iteritems() 
+                                if k not in expected))
+            if 'sketch width' not in barcodes: # no overestimates
+                self.assertEqual(counts, expected)
+
+
+class BarcodeMapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.mapfile = os.path.join(self.directory, "map.txt")
+        self.entries = [("AAAAAA", WT_DNA), ("CCCCCC", mutate(WT_DNA, 1)), 
+                        ("ACGTAC", WT_DNA), ("AAAAAAAA", mutate(WT_DNA, 2))]
+        write_map(self.mapfile, self.entries)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_packed_interchangeable(self):
+        barcode_map = load_barcode_map(self.mapfile)
+        packed_map = load_barcode_map(self.mapfile, packed=True)
+        self.assertTrue(isinstance(barcode_map, BarcodeMap))
+        self.assertTrue(isinstance(packed_map, PackedBarcodeMap))
+        self.assertEqual(sorted(packed_map.keys()), sorted(barcode_map.keys()))
+        self.assertEqual(sorted(packed_map.iterkeys()), 
+                         sorted(barcode_map.iterkeys()))
+        self.assertEqual(len(packed_map), len(barcode_map))
+        for barcode, variant in self.entries:
+            self.assertEqual(packed_map[barcode], variant)
+            self.assertEqual(barcode_map[barcode], variant)
+        self.assertFalse("GGGGGG" in packed_map)
+        self.assertEqual(packed_map.get("GGGGGG"), None)
+
+    def test_packed_pickle(self):
+        packed_map = load_barcode_map(self.mapfile, packed=True)
+        packed_map.bc_variant_strings["AAAAAA"] = "_wt"
+        copy = pickle.loads(pickle.dumps(packed_map, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(sorted(copy.keys()), sorted(packed_map.keys()))
+        self.assertEqual(copy["CCCCCC"], packed_map["CCCCCC"])
+        self.assertEqual(copy.bc_variant_strings, {"AAAAAA" : "_wt"})
+
+    def test_packed_out_of_date(self):
+        packed_map = load_barcode_map(self.mapfile, packed=True)
+        self.assertTrue(packed_map.is_current())
+        del packed_map
+        write_map(self.mapfile, self.entries + [("GGGGGG", WT_DNA)])
+        packed_map = load_barcode_map(self.mapfile, packed=True)
+        self.assertTrue(packed_map.is_current())
+        self.assertEqual(packed_map["GGGGGG"], WT_DNA)
+        self.assertEqual(len(packed_map), len(self.entries) + 1)
+
+    def test_parse(self):
+        lines = ["# comment line", "", "aaaaaa\t" + WT_DNA.lower(), 
+                 "CCCCCC  " + mutate(WT_DNA, 1), "   ", 
+                 "ACGTAC\t" + WT_DNA[:5] + "N" + WT_DNA[6:], 
+                 "AAAAAA\t" + WT_DNA]
+        expected = {"AAAAAA" : WT_DNA, "CCCCCC" : mutate(WT_DNA, 1), 
+                    "ACGTAC" : WT_DNA[:5] + "N" + WT_DNA[6:]}
+        gz = os.path.join(self.directory, "map.txt.gz")
+        with gzip.open(gz, "wb") as handle:
+            handle.write("\n".join(lines))
+        chunk_size = barcodevariant.MAP_CHUNK_SIZE
+        try:
+            for size in (chunk_size, 7, 40):
+                barcodevariant.MAP_CHUNK_SIZE = size
+                self.assertEqual(BarcodeMap(gz), expected)
+        finally:
+            barcodevariant.MAP_CHUNK_SIZE = chunk_size
+
+    def test_parse_errors(self):
+        errors = [
+            (["AAAAAA\t" + WT_DNA, "AAAAAA\t" + mutate(WT_DNA, 1)], 
+             "assigned to multiple unique variants"),
+            (["AAAAAA\t" + WT_DNA, "CCCCCC"], 
+             "Unexpected barcode-variant line format"),
+            (["AAAAAA\t" + WT_DNA + "\tx"], 
+             "Unexpected barcode-variant line format"),
+            (["AANAAA\t" + WT_DNA], 
+             "Barcode DNA sequence contains unexpected characters"),
+            (["AAAAAA\t" + WT_DNA + "X"], 
+             "Variant DNA sequence contains unexpected characters"),
+            # conflicts before the first invalid line are reported first
+            (["AAAAAA\t" + WT_DNA, "AAAAAA\t" + mutate(WT_DNA, 1), 
+              "CCCCCC"], "assigned to multiple unique variants"),
+            (["CCCCCC", "AAAAAA\tX"], 
+             "Unexpected barcode-variant line format")]
+        for lines, message in errors:
+            with open(self.mapfile, "w") as handle:
+                handle.write("\n".join(lines) + "\n")
+            with self.assertRaises(EnrichError) as context:
+                BarcodeMap(self.mapfile)
+            self.assertTrue(message in str(context.exception))
+
+    def test_cache(self):
+        cache = self.mapfile + ".bcc"
+        barcode_map = BarcodeMap(self.mapfile, cache=True)
+        self.assertTrue(os.path.isfile(cache))
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), barcode_map)
+
+        # replace the cached pairs to check that the cache is loaded
+        with open(cache, "rb") as handle:
+            key = marshal.load(handle)
+        with open(cache, "wb") as handle:
+            marshal.dump(key, handle)
+            marshal.dump({"TTTTTT" : WT_DNA}, handle)
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), 
+                         {"TTTTTT" : WT_DNA})
+
+        # a new modification time with the same contents keeps the cache
+        mtime = os.path.getmtime(self.mapfile)
+        os.utime(self.mapfile, (mtime + 10, mtime + 10))
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), 
+                         {"TTTTTT" : WT_DNA})
+        with open(cache, "rb") as handle:
+            self.assertEqual(marshal.load(handle)[0][3], 
+                             os.path.getmtime(self.mapfile))
+
+        # changed contents invalidate the cache
+        write_map(self.mapfile, self.entries + [("GGGGGG", WT_DNA)])
+        os.utime(self.mapfile, (mtime + 10, mtime + 10))
+        expected = dict(self.entries + [("GGGGGG", WT_DNA)])
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), expected)
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), expected)
+
+        # invalid caches are ignored
+        with open(cache, "wb") as handle:
+            handle.write("invalid")
+        self.assertEqual(BarcodeMap(self.mapfile, cache=True), expected)
+
+    def test_rescue(self):
+        for packed in (False, True):
+            barcode_map = load_barcode_map(self.mapfile, packed=packed)
+            targets = barcode_map.rescue_many(["AAAAAT", "CCCACC", "GGGGGG", 
+                                               "AAAAAAAT", "AAAAAA"])
+            self.assertEqual(list(targets), ["AAAAAA", "CCCCCC", None, 
+                                             "AAAAAAAA", None])
+
+    def test_ambiguous_rescue(self):
+        # ACGTAA is a single substitution from both ACGTAC and ACGAAA, and 
+        # ACAAAA from both AAAAAA and ACGAAA
+        write_map(self.mapfile, self.entries + [("ACGAAA", WT_DNA)])
+        for packed in (False, True):
+            barcode_map = load_barcode_map(self.mapfile, packed=packed)
+            targets = barcode_map.rescue_many(["ACGTAA", "ACGAAT", "ACAAAA"])
+            self.assertEqual(list(targets), [None, "ACGAAA", None])
+
+
+class BarcodeVariantSeqLibTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reads = os.path.join(self.directory, "reads.fq")
+        self.mapfile = os.path.join(self.directory, "map.txt")
+        write_map(self.mapfile, [("AAAAAA", WT_DNA), 
+                                 ("CCCCCC", mutate(WT_DNA, 1)), 
+                                 ("GGGGGG", mutate(WT_DNA, 1)), 
+                                 ("TTTTTT", mutate(WT_DNA, 3)), 
+                                 ("ACACAC", mutate(WT_DNA, 2))])
+        # CATCAT is unmapped, and AAAAAT is one substitution from AAAAAA
+        write_fastq(self.reads, [x + "GGGG" for x in 
+                ["AAAAAA"] * 5 + ["CCCCCC"] * 3 + ["GGGGGG"] * 2 + 
+                ["TTTTTT"] * 4 + ["ACACAC", "CATCAT", "CATCAT", "AAAAAT", 
+                                  "AAAAAT"]])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_lib(self, barcodes=None, **options):
+        config = {'name' : "test", 'timepoint' : 0,
+                  'output directory' : self.directory,
+                  'fastq' : {'forward' : self.reads, 'length' : 6},
+                  'barcodes' : {'map file' : self.mapfile},
+                  'wild type' : {'sequence' : WT_DNA, 'coding' : True},
+                  'filters' : {'max mutations' : 2}}
+        config['barcodes'].update(barcodes or {})
+        config.update(options)
+        return BarcodeVariantSeqLib(json.loads(json.dumps(config)))
+
+    def variant_counts(self, lib):
+        return dict(zip(lib.index_labels('variants'), 
+                        lib.df_dict['variants']['count']))
+
+    @requires_sort
+    def test_aggregation(self):
+        for packed in (False, True):
+            self.check_aggregation(self.make_lib(
+                    barcodes={'packed map' : packed}))
+
+    def check_aggregation(self, lib):
+        lib.calculate()
+        single = lib.variant_label(lib.count_variant(mutate(WT_DNA, 1)))
+        double = lib.variant_label(lib.count_variant(mutate(WT_DNA, 2)))
+        self.assertEqual(self.variant_counts(lib), 
+                         {"_wt" : 5, single : 5, double : 1})
+        self.assertEqual(lib.filter_stats['max mutations'], 4)
+        self.assertEqual(lib.barcode_map.variants[single], 
+                         set(["CCCCCC", "GGGGGG"]))
+        self.assertEqual(lib.barcode_map.bc_variant_strings["TTTTTT"], 
+                         FILTERED_VARIANT)
+        self.assertEqual(lib.barcode_map.bc_variant_strings["AAAAAA"], "_wt")
+
+    @requires_sort
+    def test_rescue(self):
+        lib = self.make_lib(barcodes={'rescue mismatches' : True})
+        lib.calculate()
+        counts = self.variant_counts(lib)
+        self.assertEqual(counts["_wt"], 7)
+        self.assertEqual(sum(counts.values()), 13)
+        # the sketch keeps rare barcodes that can be rescued
+        barcodes = {'rescue mismatches' : True, 'min count' : 3}
+        lib = self.make_lib(barcodes=barcodes)
+        lib.calculate()
+        expected = self.variant_counts(lib)
+        self.assertEqual(expected["_wt"], 7)
+        barcodes['sketch'] = True
+        lib = self.make_lib(barcodes=barcodes)
+        lib.calculate()
+        self.assertEqual(self.variant_counts(lib), expected)
+
+    def test_keep_rare_barcodes(self):
+        batch = sequence_batch(["AAAAAT", "CATCAT", "AAAAAA", "GTGTGT", 
+                                "AAAAAAAA"])
+        mask = np.array([True, True, True, True, False])
+        lib = self.make_lib()
+        self.assertEqual(list(lib.keep_rare_barcodes(batch, mask)), 
+                         [False] * 4)
+        lib = self.make_lib(barcodes={'rescue mismatches' : True})
+        self.assertEqual(list(lib.keep_rare_barcodes(batch, mask)), 
+                         [True, False, True, False])
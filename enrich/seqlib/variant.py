@@ -5,12 +5,26 @@ from sys import stdout, stderr
 from enrich_error import EnrichError
 from aligner import Aligner
 from seqlib import SeqLib
+from spill import SpillCounter
+from datacontainer import DataContainer
+import numpy as np
+import numbers
+import logging
 import pandas as pd
 
 
 # Variant string for counting wild type sequences
 WILD_TYPE_VARIANT = "_wt"
 
+# Characters allowed in variant DNA sequences
+VARIANT_DNA_CHARS = "ACGTNXacgtnx"
+
+# Variant bases in the order used by integer mutation codes
+VARIANT_BASES = "ACGTNX"
+
+# Maximum number of bits in an integer variant code, so codes fit in int64
+VARIANT_CODE_BITS = 63
+
 # Standard codon table for translating wild type and variant DNA sequences
 codon_table = {
         'TTT':'F', 'TCT':'S', 'TAT':'Y', 'TGT':'C',
@@ -76,9 +90,17 @@ class VariantSeqLib(SeqLib):
         if parent:
             SeqLib.__init__(self, config)
         self.wt_dna = None
+        self.wt_bytes = None
         self.wt_protein = None
+        self.mutation_bits = None
+        self.max_coded_mutations = None
         self.aligner = None
         self.aligner_cache = None
+        self.sequence_counts = None
+        self.substitution_table = None
+        self.mutation_cache = dict()
+        self.variant_labels = dict()
+        self.variant_codes = dict()
 
         try:
             self.set_wt(config['wild type']['sequence'], 
@@ -88,6 +110,9 @@ class VariantSeqLib(SeqLib):
                     self.aligner = Aligner()
                     self.aligner_cache = dict()
 
+            self.collapse_reads = config.get('collapse reads', False)
+            self.use_substitution_table = config.get('substitution table', 
+                                                     False)
         except KeyError as key:
             raise EnrichError("Missing required config value '{key}'".format(key), 
                               self.name)
@@ -126,7 +151,10 @@ class VariantSeqLib(SeqLib):
             raise EnrichError("WT DNA sequence contains incomplete codons", 
                               self.name)
         
-        self.wt_dna = sequence.upper()
+        self.wt_dna = str(sequence.upper()) # JSON config strings are unicode
+        self.wt_bytes = np.frombuffer(self.wt_dna, dtype=np.uint8)
+        self.mutation_bits = (len(self.wt_dna) << 3).bit_length()
+        self.max_coded_mutations = VARIANT_CODE_BITS // self.mutation_bits
         if coding:
             self.wt_protein = ""
             for i in xrange(0, len(self.wt_dna), 3):
@@ -135,6 +163,340 @@ class VariantSeqLib(SeqLib):
             self.wt_protein = None
 
 
+    def reset_counts(self):
+        """
+        Remove the counts made by :py:meth:`count_records`. If the 
+        ``'collapse reads'`` option is set, the read sequences are counted 
+        in a separate :py:class:`~seqlib.spill.SpillCounter` before variants 
+        are called by :py:meth:`count_collapsed`. If the 
+        ``'substitution table'`` option is set, the table is built by 
+        :py:meth:`build_substitution_table` if it doesn't exist.
+        """
+        SeqLib.reset_counts(self)
+        if self.use_substitution_table and self.substitution_table is None:
+            # build before worker processes are forked
+            self.build_substitution_table()
+        if self.collapse_reads:
+            self.sequence_counts = SpillCounter(self.count_budget, 
+                                                self.spill_directory())
+        else:
+            self.sequence_counts = None
+
+
+    def shard_counts(self):
+        """
+        Return the counts made by :py:meth:`count_records`, which are the 
+        read sequence counts if the ``'collapse reads'`` option is set.
+        """
+        if self.collapse_reads:
+            return self.sequence_counts
+        else:
+            return SeqLib.shard_counts(self)
+
+
+    def merge_counts(self, counts):
+        """
+        Add the *counts* returned by :py:meth:`shard_counts` in a worker 
+        process to this object's counts.
+        """
+        if self.collapse_reads:
+            for part in counts.iter_partitions():
+                for sequence, count in part.iteritems():
+                    self.sequence_counts.add(sequence, count)
+                self.sequence_counts.check_budget()
+        else:
+            SeqLib.merge_counts(self, counts)
+
+
+    def count_sequence(self, variant_dna):
+        """
+        Count the *variant_dna* sequence from a read that passed the quality 
+        filters. If the ``'collapse reads'`` option is set, the sequence is 
+        only tallied, and the variant is called later by 
+        :py:meth:`count_collapsed`. Otherwise, this calls 
+        :py:meth:`count_variant`. Returns ``None`` if the variant was 
+        discarded due to excess mismatches.
+        """
+        if self.collapse_reads:
+            self.sequence_counts.add(variant_dna)
+            return variant_dna
+        else:
+            return self.count_variant(variant_dna)
+
+
+    def check_budget(self):
+        """
+        Write the counts to disk if they exceed the ``'count budget'`` (see 
+        :py:meth:`SpillCounter.check_budget 
+        <seqlib.spill.SpillCounter.check_budget>`).
+        """
+        self.df_dict['variants'].check_budget()
+        if self.sequence_counts is not None:
+            self.sequence_counts.check_budget()
+
+
+    def count_collapsed(self):
+        """
+        Call :py:meth:`count_variant` once for each unique read sequence 
+        tallied by :py:meth:`count_sequence`, using the number of reads as 
+        the number of copies. Reads with variants that have too many 
+        mutations are added to the ``'max mutations'`` and ``'total'`` 
+        filter statistics.
+        """
+        unique = 0
+        for part in self.sequence_counts.iter_partitions():
+            unique += len(part)
+            for sequence, count in part.iteritems():
+                if self.count_variant(sequence, copies=count) is None:
+                    self.filter_stats['max mutations'] += count
+                    self.filter_stats['total'] += count
+                    if self.report_filtered:
+                        self.report_filtered_variant(sequence, count)
+            self.df_dict['variants'].check_budget()
+        self.sequence_counts = None
+        logging.info("Called variants for {n} unique sequences [{name}]".format(
+                n=unique, name=self.name))
+
+
+    def report_filtered_variant(self, variant, count):
+        """
+        Outputs a summary of the filtered variant to *handle*. Internal filter 
+        names are converted to messages using the ``DataContainer._filter_messages`` 
+        dictionary. Related to :py:meth:`SeqLib.report_filtered`.
+        """
+        logging.debug("Filtered variant (quantity={n}) ({messages}) [{name}]\n{read!s}".format(
+                    n=count, messages=DataContainer._filter_messages['max mutations'], name=self.name, read=variant))
+
+
+    def format_mutation(self, pos, change, variant_aa=None):
+        """
+        Return the HGVS string for the mutation *change* (such as ``'A>G'``) 
+        at position *pos* in the wild type DNA sequence. For coding 
+        sequences, *variant_aa* is the single-letter code for the amino acid 
+        encoded by the variant codon containing *pos* (or ``'?'`` for an 
+        incomplete codon), and is not used for indels.
+        """
+        ref_dna_pos = pos + self.reference_offset + 1
+        if not self.is_coding():
+            return "n.{pos}{change}".format(pos=ref_dna_pos, change=change)
+        ref_pro_pos = (pos + self.reference_offset) / 3 + 1
+        mut = "c.{pos}{change}".format(pos=ref_dna_pos, change=change)
+        if has_indel(change):
+            mut += " (p.{pre}{pos}fs)".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos)
+        elif variant_aa == self.wt_protein[pos / 3]:
+            mut += " (p.=)"
+        else:
+            mut += " (p.{pre}{pos}{post})".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos,
+                     post=aa_codes[variant_aa])
+        return mut
+
+
+    def mutation_string(self, pos, change, variant_dna):
+        """
+        Return the HGVS string for the mutation *change* at position *pos* 
+        in the wild type, where *variant_dna* is the variant sequence. For 
+        coding sequences, only the variant codon containing *pos* is 
+        translated, and the result is cached by position, change, and 
+        codon so that repeated mutations are only formatted once.
+        """
+        if not self.is_coding() or has_indel(change):
+            return self.format_mutation(pos, change)
+        start = pos - pos % 3
+        key = (pos, change, variant_dna[start:start + 3])
+        try:
+            return self.mutation_cache[key]
+        except KeyError:
+            # garbage codons due to indels are translated as '?'
+            mut = self.format_mutation(pos, change, 
+                                       codon_table.get(key[2], '?'))
+            self.mutation_cache[key] = mut
+            return mut
+
+
+    def encode_variant(self, mutations):
+        """
+        Return the integer code for the variant with the substitutions in 
+        *mutations*, a list of (position, base) tuples sorted by position.
+
+        Each substitution is coded as ``(position << 3 | base) + 1``, where 
+        *base* is the index of the variant base in ``VARIANT_BASES``, and the 
+        substitution codes are packed into the variant code using 
+        ``mutation_bits`` bits apiece, starting with the lowest position. The 
+        wild type is coded as 0. Codes are only defined for variants that are 
+        the same length as the wild type and have at most 
+        ``max_coded_mutations`` substitutions, so that the code fits in 
+        ``VARIANT_CODE_BITS`` bits; use :py:meth:`variant_label` to get the 
+        HGVS string.
+        """
+        code = 0
+        shift = 0
+        for pos, base in mutations:
+            code |= ((pos << 3 | VARIANT_BASES.index(base)) + 1) << shift
+            shift += self.mutation_bits
+        return code
+
+
+    def decode_variant(self, code):
+        """
+        Return the list of (position, base) tuples for the variant *code* 
+        created by :py:meth:`encode_variant`.
+        """
+        mask = (1 << self.mutation_bits) - 1
+        mutations = list()
+        while code:
+            m = (code & mask) - 1
+            mutations.append((m >> 3, VARIANT_BASES[m & 7]))
+            code >>= self.mutation_bits
+        return mutations
+
+
+    def variant_sequence(self, mutations):
+        """
+        Return the DNA sequence of the wild type with the substitutions in 
+        *mutations*, a list of (position, base) tuples.
+        """
+        sequence = list(self.wt_dna)
+        for pos, base in mutations:
+            sequence[pos] = base
+        return "".join(sequence)
+
+
+    def variant_label(self, variant):
+        """
+        Return the HGVS string for *variant*, which is either an integer code 
+        returned by :py:meth:`count_variant` or an HGVS string (for variants 
+        containing indels). Labels are built once and stored in the 
+        ``variant_labels`` dictionary, and the codes are stored in the 
+        ``variant_codes`` dictionary so that they can be recovered by 
+        :py:meth:`variant_code`.
+        """
+        if not isinstance(variant, numbers.Integral):
+            return variant
+        code = int(variant)
+        try:
+            return self.variant_labels[code]
+        except KeyError:
+            pass
+        if code == 0:
+            label = WILD_TYPE_VARIANT
+        else:
+            mutations = self.decode_variant(code)
+            sequence = self.variant_sequence(mutations)
+            label = ", ".join(self.mutation_string(pos, 
+                    "{pre}>{post}".format(pre=self.wt_dna[pos], post=base), 
+                    sequence) for pos, base in mutations)
+        self.variant_labels[code] = label
+        self.variant_codes[label] = code
+        return label
+
+
+    def variant_code(self, variant):
+        """
+        Return the integer code for *variant*, which is either a code or an 
+        HGVS string that was created by :py:meth:`variant_label`. Returns 
+        ``None`` if *variant* is any other string, such as a variant 
+        containing indels.
+        """
+        if isinstance(variant, numbers.Integral):
+            return int(variant)
+        elif variant == WILD_TYPE_VARIANT:
+            return 0
+        else:
+            return self.variant_codes.get(variant)
+
+
+    def protein_changes(self, code):
+        """
+        Return a list of (protein position, wild type amino acid, variant 
+        amino acid) tuples for the substitutions in the variant *code* that 
+        change the encoded amino acid. Amino acids are single-letter codes, 
+        and incomplete codons are ``'?'``. Protein positions are numbered as 
+        in :py:meth:`format_mutation`.
+        """
+        mutations = self.decode_variant(code)
+        sequence = self.variant_sequence(mutations)
+        changes = list()
+        for pos, base in mutations:
+            start = pos - pos % 3
+            pre = self.wt_protein[pos / 3]
+            post = codon_table.get(sequence[start:start + 3], '?')
+            if post != pre:
+                changes.append(((pos + self.reference_offset) / 3 + 1, 
+                                pre, post))
+        return changes
+
+
+    def nonsense_position(self, variant):
+        """
+        Return the lowest non-negative protein position of a change to stop 
+        in *variant* (see :py:meth:`variant_code`), or ``None`` if there is no 
+        such change or the variant has no code.
+        """
+        code = self.variant_code(variant)
+        if code is None or not self.is_coding():
+            return None
+        positions = [pos for pos, pre, post in self.protein_changes(code) 
+                     if post == '*' and pos >= 0]
+        if len(positions) > 0:
+            return min(positions)
+        else:
+            return None
+
+
+    def index_labels(self, key):
+        """
+        Return the labels written by :py:meth:`write_data 
+        <datacontainer.DataContainer.write_data>` for the index of the 
+        :py:class:`pandas.DataFrame` *key*. Variant codes are converted to 
+        HGVS strings using :py:meth:`variant_label`.
+        """
+        if key == 'variants':
+            return pd.Index([self.variant_label(x) for x in 
+                             self.df_dict[key].index], dtype=object)
+        else:
+            return SeqLib.index_labels(self, key)
+
+
+    def build_substitution_table(self):
+        """
+        Build the dictionary used by :py:meth:`count_variant` to look up the 
+        variant code for every sequence with one or two substitutions 
+        relative to the wild type (up to the ``'max mutations'`` filter 
+        value), as well as the wild type itself.
+
+        For a wild type sequence of *n* bases, the table contains about 
+        4.5 x *n* squared sequences.
+        """
+        wt = self.wt_dna
+        max_mutations = min(2, self.filters['max mutations'], 
+                            self.max_coded_mutations)
+        self.substitution_table = {wt : 0}
+        if max_mutations < 1:
+            return
+
+        singles = list()
+        for i in xrange(len(wt)):
+            for base in "ACGT":
+                if base == wt[i]:
+                    continue
+                sequence = wt[:i] + base + wt[i + 1:]
+                code = self.encode_variant([(i, base)])
+                self.substitution_table[sequence] = code
+                singles.append((i, base, code))
+        if max_mutations < 2:
+            return
+
+        for a, (i, base_i, code_i) in enumerate(singles):
+            for j, base_j, code_j in singles[a + 1:]:
+                if j == i:
+                    continue
+                sequence = wt[:i] + base_i + wt[i + 1:j] + base_j + wt[j + 1:]
+                self.substitution_table[sequence] = \
+                        code_i | code_j << self.mutation_bits
+        logging.info("Built substitution table for {n} variants [{name}]".format(
+                n=len(self.substitution_table), name=self.name))
+
+
     def align_variant(self, variant_dna):
         """
         Use the local :py:class:`~seqlib.aligner.Aligner` instance to align the *variant_dna* to the 
@@ -181,76 +543,78 @@ class VariantSeqLib(SeqLib):
         alignment is performed using :py:meth:`align_variant` if this option 
         has been selected in the configuration.
 
-        Each variant is stored as a tab-delimited string of mutations in HGVS 
-        format. Returns a list of HGSV variant strings. Returns an empty list 
-        if the variant is wild type. Returns None if the variant was discarded
-        due to excess mismatches.
+        Variants that are compared to the wild type base-by-base are counted 
+        using the integer code created by :py:meth:`encode_variant`, and 
+        aligned variants (or variants with too many substitutions to fit in a 
+        code) are counted using their HGVS string. Returns the code 
+        or string, which can be converted to an HGVS string using 
+        :py:meth:`variant_label`. The wild type is coded as 0. Returns None 
+        if the variant was discarded due to excess mismatches.
+
+        Variants that are the same length as the wild type are compared to it 
+        as byte arrays in a single operation. If the ``'substitution table'`` 
+        option is set, variants in the table built by 
+        :py:meth:`build_substitution_table` are looked up instead.
         """
-        if not re.match("^[ACGTNXacgtnx]+$", variant_dna):
+        try:
+            variant_dna = str(variant_dna) # compared as a byte array
+        except UnicodeEncodeError:
+            variant_dna = None
+        if variant_dna is None or len(variant_dna) == 0 or \
+                len(variant_dna.translate(None, VARIANT_DNA_CHARS)) > 0:
             raise EnrichError("Variant DNA sequence contains unexpected "
                               "characters", self.name)
 
         variant_dna = variant_dna.upper()
 
+        if self.use_substitution_table:
+            if self.substitution_table is None:
+                self.build_substitution_table()
+            variant = self.substitution_table.get(variant_dna)
+            if variant is not None:
+                try:
+                    self.df_dict['variants'][variant] += copies
+                except KeyError:
+                    self.df_dict['variants'][variant] = copies
+                return variant
+
         if len(variant_dna) != len(self.wt_dna):
             if self.aligner is not None:
                 mutations = self.align_variant(variant_dna)
             else:
                 return None
         else:
-            mutations = list()
-            for i in xrange(len(variant_dna)):
-                if variant_dna[i] != self.wt_dna[i]:
-                    mutations.append((i, "{pre}>{post}".format(pre=self.wt_dna[i], post=variant_dna[i])))
+            mismatches = np.flatnonzero(np.frombuffer(variant_dna, 
+                    dtype=np.uint8) != self.wt_bytes)
+            if len(mismatches) > self.filters['max mutations']:
+                if self.aligner is not None:
+                    mutations = self.align_variant(variant_dna)
                     if len(mutations) > self.filters['max mutations']:
-                        if self.aligner is not None:
-                            mutations = self.align_variant(variant_dna)
-                            if len(mutations) > self.filters['max mutations']:
-                                # too many mutations post-alignment
-                                return None
-                            else:
-                                # stop looping over this variant
-                                break
-                        else:
-                            # too many mutations and not using aligner
-                            return None
-
-        mutation_strings = list()
-        if self.is_coding():
-            variant_protein = ""
-            for i in xrange(0, len(variant_dna), 3):
-                try:
-                    variant_protein += codon_table[variant_dna[i:i + 3]]
-                except KeyError: # garbage codon due to indel
-                    variant_protein += '?'
-
-            for pos, change in mutations:
-                ref_dna_pos = pos + self.reference_offset + 1
-                ref_pro_pos = (pos + self.reference_offset) / 3 + 1
-                mut = "c.{pos}{change}".format(pos=ref_dna_pos, change=change)
-                if has_indel(change):
-                    mut += " (p.{pre}{pos}fs)".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos)
-                elif variant_protein[pos / 3] == self.wt_protein[pos / 3]:
-                    mut += " (p.=)"
+                        # too many mutations post-alignment
+                        return None
                 else:
-                    mut += " (p.{pre}{pos}{post})".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos,
-                             post=aa_codes[variant_protein[pos / 3]])
-                mutation_strings.append(mut)
-        else:
-            for pos, change in mutations:
-                ref_dna_pos = pos + self.reference_offset + 1
-                mut = "n.{pos}{change}".format(pos=ref_dna_pos, change=change)
-                mutation_strings.append(mut)
+                    # too many mutations and not using aligner
+                    return None
+            elif len(mismatches) <= self.max_coded_mutations:
+                mutations = None
+                variant = self.encode_variant((i, variant_dna[i]) 
+                                              for i in mismatches.tolist())
+            else:
+                mutations = [(i, "{pre}>{post}".format(pre=self.wt_dna[i], 
+                              post=variant_dna[i])) for i in mismatches]
+
+        if mutations is not None: # counted as strings
+            if len(mutations) > 0:
+                variant = ', '.join(self.mutation_string(pos, change, 
+                        variant_dna) for pos, change in mutations)
+            else:
+                variant = 0
 
-        if len(mutation_strings) > 0:
-            variant_string = ', '.join(mutation_strings)
-        else:
-            variant_string = WILD_TYPE_VARIANT
         try:
-            self.df_dict['variants'][variant_string] += copies
+            self.df_dict['variants'][variant] += copies
         except KeyError:
-            self.df_dict['variants'][variant_string] = copies
-        return variant_string
+            self.df_dict['variants'][variant] = copies
+        return variant
 
 
     def count_mutations(self, include_indels=False):
@@ -258,6 +622,11 @@ class VariantSeqLib(SeqLib):
         Count the individual mutations in all variants. If *include_indels* is ``False``, all mutations in a variant that contains 
         an insertion/deletion/duplication will not be counted. For coding sequences, amino acid substitutions are counted
         independently of the corresponding nucleotide change.
+
+        Variants with an integer code (see :py:meth:`variant_code`) are 
+        tallied by decoding the substitutions, and the HGVS strings for the 
+        mutations are only created once the tallies are complete. Other 
+        variants are tallied by splitting their HGVS strings.
         """
         # restore the counts if they were saved to disk
         restored = False
@@ -266,12 +635,13 @@ class VariantSeqLib(SeqLib):
             self.restore_data(keys=['variants'])
 
         # create new dictionaries
-        self.df_dict['mutations_nt'] = dict()
-        if self.is_coding():
-            self.df_dict['mutations_aa'] = dict()
+        mutations_nt = dict()
+        mutations_aa = dict()
 
         if not include_indels:
-            mask = self.df_dict['variants'].index.map(has_indel)
+            mask = np.array([not isinstance(x, numbers.Integral) and 
+                             has_indel(x) for x in 
+                             self.df_dict['variants'].index], dtype=bool)
             variant_data = self.df_dict['variants'][np.invert(mask)]
             del mask
         else:
@@ -281,34 +651,62 @@ class VariantSeqLib(SeqLib):
         if restored:
             self.dump_data(keys=['variants'])
 
-        if self.is_coding():
-            for variant, count in variant_data.iterrows():
-                count = count['count'] # get the element from the Series
+        for variant, count in zip(variant_data.index, variant_data['count']):
+            code = self.variant_code(variant)
+            if code == 0:
+                nt_changes = [WILD_TYPE_VARIANT]
+                aa_changes = list()
+            elif code is not None:
+                nt_changes = self.decode_variant(code)
+                if self.is_coding():
+                    # amino acid changes at negative positions are not counted
+                    aa_changes = set(c for c in self.protein_changes(code) 
+                                     if c[0] >= 0 and c[2] != '?')
+            else:
                 mutations = variant.split(", ")
-                # get just the nucleotide changes
-                for m in mutations:
-                    m = m.split(" (")[0]
-                    try:
-                        self.df_dict['mutations_nt'][m] += count
-                    except KeyError:
-                        self.df_dict['mutations_nt'][m] = count
-                # get the amino acid changes
-                aa_changes = re.findall("p\.[A-Z][a-z][a-z]\d+[A-Z][a-z][a-z]", variant)
-                aa_changes = set(aa_changes) # make unique
+                if self.is_coding():
+                    # get just the nucleotide changes
+                    nt_changes = [m.split(" (")[0] for m in mutations]
+                    # get the amino acid changes
+                    aa_changes = set(re.findall("p\.[A-Z][a-z][a-z]\d+[A-Z][a-z][a-z]", variant))
+                else:
+                    nt_changes = mutations
+            for m in nt_changes:
+                try:
+                    mutations_nt[m] += count
+                except KeyError:
+                    mutations_nt[m] = count
+            if self.is_coding():
                 for a in aa_changes:
                     try:
-                        self.df_dict['mutations_aa'][a] += count
-                    except KeyError:
-                        self.df_dict['mutations_aa'][a] = count
-        else:
-            for variant, count in variant_data.iterrows():
-                count = count['count'] # get the element from the Series
-                mutations = variant.split(", ")
-                for m in mutations:
-                    try:
-                        self.df_dict['mutations_nt'][m] += count
+                        mutations_aa[a] += count
                     except KeyError:
-                        self.df_dict['mutations_nt'][m] = count
+                        mutations_aa[a] = count
+
+        # convert the decoded changes to HGVS strings
+        prefix = "c" if self.is_coding() else "n"
+        self.df_dict['mutations_nt'] = dict()
+        for m, count in mutations_nt.iteritems():
+            if isinstance(m, tuple):
+                pos, base = m
+                m = "{prefix}.{pos}{pre}>{post}".format(prefix=prefix, 
+                        pos=pos + self.reference_offset + 1, 
+                        pre=self.wt_dna[pos], post=base)
+            try:
+                self.df_dict['mutations_nt'][m] += count
+            except KeyError:
+                self.df_dict['mutations_nt'][m] = count
+        if self.is_coding():
+            self.df_dict['mutations_aa'] = dict()
+            for a, count in mutations_aa.iteritems():
+                if isinstance(a, tuple):
+                    pos, pre, post = a
+                    a = "p.{pre}{pos}{post}".format(pre=aa_codes[pre], 
+                            pos=pos, post=aa_codes[post])
+                try:
+                    self.df_dict['mutations_aa'][a] += count
+                except KeyError:
+                    self.df_dict['mutations_aa'][a] = count
 
         self.df_dict['mutations_nt'] = \
                 pd.DataFrame.from_dict(self.df_dict['mutations_nt'], 
@@ -2,7 +2,7 @@ from __future__ import print_function
 from sys import stderr
 import argparse
 import os.path
-from fqread import read_fastq_multi
+from fqread import read_fastq_multi, FastqWriter
 
 
 def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
@@ -20,7 +20,7 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
     fq_handles = dict() # output file handles and index read sequences
     if forward is not None and reverse is not None:
         fq_iterator = read_fastq_multi([index, forward, reverse], 
-                                       match_lengths=True)
+                                       match_lengths=True, prefetch=True)
         for s in sequences:
             name, ext = os.path.splitext(os.path.basename(index))
             index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
@@ -37,10 +37,12 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
             reverse_name = os.path.join(outdir, reverse_name)
 
             fq_handles[s] = \
-                (open(index_name, "w"), open(forward_name, "w"),
-                 open(reverse_name, "w"))
+                (FastqWriter(index_name, threads=1), 
+                 FastqWriter(forward_name, threads=1),
+                 FastqWriter(reverse_name, threads=1))
     elif forward is not None:
-        fq_iterator = read_fastq_multi([index, forward], match_lengths=True)
+        fq_iterator = read_fastq_multi([index, forward], match_lengths=True,
+                                       prefetch=True)
         for s in sequences:
             name, ext = os.path.splitext(os.path.basename(index))
             index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
@@ -52,9 +54,11 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
             forward_name = os.path.join(outdir, forward_name)
 
             fq_handles[s] = \
-                (open(index_name, "w"), open(forward_name, "w"))
+                (FastqWriter(index_name, threads=1), 
+                 FastqWriter(forward_name, threads=1))
     elif reverse is not None:
-        fq_iterator = read_fastq_multi([index, reverse], match_lengths=True)
+        fq_iterator = read_fastq_multi([index, reverse], match_lengths=True,
+                                       prefetch=True)
         for s in sequences:
             name, ext = os.path.splitext(os.path.basename(index))
             index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
@@ -66,7 +70,8 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
             reverse_name = os.path.join(outdir, reverse_name)
 
             fq_handles[s] = \
-                (open(index_name, "w"), open(reverse_name, "w"))
+                (FastqWriter(index_name, threads=1), 
+                 FastqWriter(reverse_name, threads=1))
     else:
         print("Error: no forward or reverse files specified for split_fastq",
               file=stderr)
@@ -92,7 +97,7 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
 
         if match:
             for i in xrange(len(t)):
-                print(t[i], file=fq_handles[match][i])
+                fq_handles[match][i].write(t[i])
 
     # close all the files
     for handle_tuple in fq_handles.values():
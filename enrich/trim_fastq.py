@@ -2,7 +2,7 @@ from __future__ import print_function
 from sys import stderr
 import argparse
 import os.path
-from fqread import read_fastq
+from fqread import read_fastq, FastqWriter
 
 
 def trim_fastq(outdir, files, start, end, length):
@@ -33,13 +33,13 @@ def trim_fastq(outdir, files, start, end, length):
         name, ext = os.path.splitext(os.path.basename(f))
         outfile_name = name + ".trim" + ext
         outfile_name = os.path.join(outdir, outfile_name)
-        with open(outfile_name, "w") as handle:
+        with FastqWriter(outfile_name, threads=1) as writer:
             for read in read_fastq(f):
                 if length_mode:
                     read.trim_length(length, start)
                 else:
                     read.trim(start, end)
-                print(read, file=handle)
+                writer.write(read)
 
 
 
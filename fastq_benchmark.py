@@ -0,0 +1,246 @@
+"""
+fastq_benchmark.py
+
+Measures FASTQ reading throughput on synthetic data
+
+Generates FASTQ files with a chosen number of records, read length and
+compression (plain, gzip, bzip2, and xz or zstd if the modules are
+installed), then times fqread.read_fastq, fqread.read_fastq_multi and
+fastq_tools.read_fastq across a range of buffer sizes. Results (records per
+second and MB per second of uncompressed FASTQ) are written as JSON.
+"""
+
+
+from __future__ import print_function
+from sys import stderr
+import os
+import os.path
+import gzip
+import bz2
+import json
+import time
+import random
+import tempfile
+import shutil
+import platform
+import argparse
+from enrich import fqread
+import fastq_tools
+
+
+COMPRESSION_TYPES = ("none", "gz", "bz2", "xz", "zst")
+
+
+# compression types that can be generated with the installed modules
+AVAILABLE_COMPRESSION_TYPES = tuple(c for c in COMPRESSION_TYPES
+        if not (c == "xz" and fqread.lzma is None) and
+           not (c == "zst" and fqread.zstandard is None))
+
+
+DEFAULT_BUFFER_SIZES = (10000, 100000, 1000000)
+
+
+class ZstdWriter(object):
+    """
+    Minimal file-like object that writes a zstd compressed file.
+    """
+    def __init__(self, fname):
+        self.handle = open(fname, "wb")
+        self.writer = fqread.zstandard.ZstdCompressor().stream_writer(
+                self.handle)
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(fqread.zstandard.FLUSH_FRAME)
+        self.handle.close()
+
+
+def write_synthetic_fastq(fname, records, read_length, compression="none",
+                          seed=0):
+    """
+    Write a FASTQ file containing random reads.
+
+    Headers use the pre-1.8 Illumina format with about 90% of reads chaste.
+    Returns the size of the uncompressed data in bytes.
+    """
+    rng = random.Random(seed)
+    if compression == "gz":
+        handle = gzip.GzipFile(fname, "wb")
+    elif compression == "bz2":
+        handle = bz2.BZ2File(fname, "wb")
+    elif compression == "xz":
+        handle = fqread.lzma.LZMAFile(fname, "wb")
+    elif compression == "zst":
+        handle = ZstdWriter(fname)
+    else:
+        handle = open(fname, "wb")
+
+    size = 0
+    block = list()
+    for i in xrange(records):
+        chastity = 1 if rng.random() < 0.9 else 0
+        sequence = ''.join(rng.choice("ACGT") for _ in xrange(read_length))
+        quality = ''.join(chr(33 + rng.randint(2, 40))
+                          for _ in xrange(read_length))
+        record = "@SYN:1:{tile}:{x}:{y}:{c}#0/1\n{s}\n+\n{q}\n".format(
+                tile=i // 100000 + 1, x=i % 1000, y=i // 1000, c=chastity,
+                s=sequence, q=quality)
+        block.append(record)
+        size += len(record)
+        if len(block) == 10000:
+            handle.write(''.join(block))
+            block = list()
+    handle.write(''.join(block))
+    handle.close()
+    return size
+
+
+def synthetic_fname(directory, records, read_length, compression, mate=1):
+    """
+    Return the path to the synthetic FASTQ file with the given parameters.
+    """
+    fname = "synthetic_{n}x{l}_R{m}.fq".format(n=records, l=read_length,
+                                                m=mate)
+    if compression != "none":
+        fname += "." + compression
+    return os.path.join(directory, fname)
+
+
+def time_reader(reader, repeats):
+    """
+    Run the generator function reader to completion repeats times.
+
+    Returns the number of items produced and the fastest time in seconds.
+    """
+    best = None
+    count = 0
+    for _ in xrange(repeats):
+        start = time.time()
+        count = 0
+        for _ in reader():
+            count += 1
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+
+def benchmark_file(fname, mate_fname, nbytes, buffer_sizes, repeats):
+    """
+    Benchmark each reader on fname across buffer_sizes.
+
+    mate_fname is the second file read by fqread.read_fastq_multi. Returns a
+    list of result dictionaries.
+    """
+    readers = [
+        ("fqread.read_fastq", 1,
+         lambda b: lambda: fqread.read_fastq(fname, buffer_size=b)),
+        ("fqread.read_fastq_multi", 2,
+         lambda b: lambda: fqread.read_fastq_multi([fname, mate_fname],
+                                                   buffer_size=b)),
+        ("fastq_tools.read_fastq", 1,
+         lambda b: lambda: fastq_tools.read_fastq(fname, buffer_size=b)),
+    ]
+
+    results = list()
+    for name, files, make_reader in readers:
+        for buffer_size in buffer_sizes:
+            count, elapsed = time_reader(make_reader(buffer_size), repeats)
+            records = count * files
+            results.append({"reader" : name,
+                            "buffer size" : buffer_size,
+                            "records" : records,
+                            "seconds" : elapsed,
+                            "records per second" : records / elapsed,
+                            "MB per second" : nbytes * files / elapsed / 1e6})
+            print("{reader:<25} {fname:<40} buffer={b:<8} {r:>12.0f} rec/s "
+                  "{mb:>8.1f} MB/s".format(reader=name,
+                  fname=os.path.basename(fname), b=buffer_size,
+                  r=results[-1]["records per second"],
+                  mb=results[-1]["MB per second"]), file=stderr)
+    return results
+
+
+def run_benchmark(records, read_lengths, compressions, buffer_sizes, repeats,
+                  directory):
+    """
+    Generate the synthetic files in directory and benchmark each of them.
+
+    Returns a dictionary containing the benchmark parameters, platform
+    information, and results.
+    """
+    results = list()
+    for read_length in read_lengths:
+        for compression in compressions:
+            fnames = list()
+            for mate in (1, 2):
+                fname = synthetic_fname(directory, records, read_length,
+                                        compression, mate)
+                nbytes = write_synthetic_fastq(fname, records, read_length,
+                                               compression, seed=mate)
+                fnames.append(fname)
+            for result in benchmark_file(fnames[0], fnames[1], nbytes,
+                                         buffer_sizes, repeats):
+                result["read length"] = read_length
+                result["compression"] = compression
+                result["file size"] = os.path.getsize(fnames[0])
+                result["uncompressed size"] = nbytes
+                results.append(result)
+
+    return {"parameters" : {"records" : records,
+                            "read lengths" : list(read_lengths),
+                            "compression" : list(compressions),
+                            "buffer sizes" : list(buffer_sizes),
+                            "repeats" : repeats},
+            "platform" : {"python" : platform.python_version(),
+                          "machine" : platform.machine(),
+                          "system" : platform.platform(),
+                          "processor" : platform.processor()},
+            "results" : results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FASTQ reading "
+                                     "on synthetic data.")
+    parser.add_argument("-n", "--records", metavar="N", type=int,
+                        default=100000, help="records per synthetic file")
+    parser.add_argument("-l", "--read-length", metavar="N", type=int,
+                        nargs="+", default=[100], dest="read_lengths",
+                        help="read lengths to generate")
+    parser.add_argument("-c", "--compression",
+                        choices=AVAILABLE_COMPRESSION_TYPES, nargs="+",
+                        default=list(AVAILABLE_COMPRESSION_TYPES),
+                        help="compression types to generate")
+    parser.add_argument("-b", "--buffer-size", metavar="N", type=int,
+                        nargs="+", default=list(DEFAULT_BUFFER_SIZES),
+                        dest="buffer_sizes", help="buffer sizes to test")
+    parser.add_argument("-r", "--repeats", metavar="N", type=int, default=3,
+                        help="timing repeats (fastest is reported)")
+    parser.add_argument("-d", "--directory", metavar="DIR",
+                        help="directory for synthetic files (default is a "
+                        "temporary directory that is removed afterwards)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        default="fastq_benchmark.json",
+                        help="JSON output file")
+
+    args = parser.parse_args()
+
+    if args.directory is None:
+        directory = tempfile.mkdtemp(prefix="fastq_benchmark_")
+    else:
+        directory = args.directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    try:
+        report = run_benchmark(args.records, args.read_lengths,
+                               args.compression, args.buffer_sizes,
+                               args.repeats, directory)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+    with open(args.output, "w") as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
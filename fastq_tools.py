@@ -14,7 +14,11 @@ import string
 import re
 from itertools import izip_longest
 from array import array
-import gzip
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from enrich.fqread import open_compressed
 
 __all__ = ["check_fastq_extension", 
            "fastq_quality", 
@@ -28,7 +32,10 @@ __all__ = ["check_fastq_extension",
            "trim_fastq", 
            "trim_fastq_length",
            "fastq_min_quality", 
-           "fastq_mean_quality"]
+           "fastq_mean_quality",
+           "fastq_quality_batch",
+           "fastq_min_quality_batch",
+           "fastq_mean_quality_batch"]
 
 
 # Matches FASTQ headers based on the following pattern (modify as needed):
@@ -57,7 +64,10 @@ def check_fastq_extension(fname, quiet=False, error_handle=stderr):
     Prints an error message to error_handle, suppressed if quiet is True.
     """
     if os.path.isfile(fname):
-        ext = os.path.splitext(fname)[-1].lower()
+        path, ext = os.path.splitext(fname)
+        ext = ext.lower()
+        if ext in (".gz", ".bz2", ".xz", ".zst"):
+            ext = os.path.splitext(path)[-1].lower()
         if ext in (".fq", ".fastq"):
             return True
         else:
@@ -88,10 +98,7 @@ def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE):
     read_fastq_multi instead.
     """
     try:
-	if fname.endswith(".gz") == True:
-		handle = gzip.open(fname, "rU")
-	else:
-        	handle = open(fname, "U")
+        handle = open_compressed(fname) # detects gzip, bzip2, xz and zstd
     except IOError:
         print("Error: could not open FASTQ file '%s'" % fname, file=stderr)
         return
@@ -103,7 +110,7 @@ def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE):
 
     while not eof:
         buf = handle.read(buffer_size)
-        if len(buf) < buffer_size:
+        if len(buf) == 0: # decompressors can return short reads before EOF
             eof = True
 
         buf = leftover + buf # prepend partial record from previous buffer
@@ -285,3 +292,72 @@ def fastq_mean_quality(fq, base=33):
     return float(sum(fastq_quality(fq))) / len(fq[1])
 
 
+def _fastq_quality_values(fqs, base=33):
+    """
+    Convert the quality strings of a list of FASTQ tuples to a single 
+    NumPy array of integers.
+
+    Returns the array of quality values for all reads (in order) and an 
+    array containing the length of each read.
+    """
+    if np is None:
+        raise ImportError("NumPy is required for batch quality functions")
+    qualities = [fq[2] for fq in fqs]
+    lengths = np.fromiter((len(q) for q in qualities), dtype=np.int64, 
+                          count=len(qualities))
+    values = np.frombuffer(''.join(qualities), dtype=np.uint8)
+    return values.astype(np.int16) - base, lengths
+
+
+def fastq_quality_batch(fqs, base=33):
+    """
+    Convert the quality strings of a list of FASTQ tuples to a 2-D NumPy 
+    masked array with one row per read.
+
+    Rows for reads shorter than the longest read are padded with masked 
+    values. base is 33 for Sanger and Illumina 1.8, or 64 for Illumina 1.3 
+    and 1.5.
+    """
+    values, lengths = _fastq_quality_values(fqs, base)
+    width = lengths.max() if len(lengths) > 0 else 0
+    if np.all(lengths == width):
+        return np.ma.masked_array(values.reshape(len(lengths), width))
+    padding = np.arange(width) >= lengths[:, np.newaxis]
+    quality = np.zeros(padding.shape, dtype=values.dtype)
+    quality[~padding] = values
+    return np.ma.masked_array(quality, mask=padding)
+
+
+def fastq_min_quality_batch(fqs, base=33):
+    """
+    Return a NumPy array containing the minimum base quality in each read 
+    in the list of FASTQ tuples.
+
+    Reads with no bases have a minimum quality of 0.
+    """
+    values, lengths = _fastq_quality_values(fqs, base)
+    result = np.zeros(len(lengths), dtype=values.dtype)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        starts = np.cumsum(lengths) - lengths
+        result[nonempty] = np.minimum.reduceat(values, starts[nonempty])
+    return result
+
+
+def fastq_mean_quality_batch(fqs, base=33):
+    """
+    Return a NumPy array containing the average base quality in each read 
+    in the list of FASTQ tuples.
+
+    Reads with no bases have an average quality of NaN.
+    """
+    values, lengths = _fastq_quality_values(fqs, base)
+    result = np.empty(len(lengths), dtype=float)
+    result.fill(np.nan)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        starts = np.cumsum(lengths) - lengths
+        result[nonempty] = np.add.reduceat(values.astype(np.int64), 
+                                           starts[nonempty])
+        result[nonempty] /= lengths[nonempty]
+    return result